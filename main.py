@@ -3,32 +3,61 @@ import argparse
 import numpy as np
 import torch
 
-from src.attack_results import AttackResults
+from src import registry
+from src.attack_results import AttackResults, CurvesAggregator
+from src.attacks.base import BaseAttack, ExtraResultsDict, make_sample_rngs
+from src.attacks.queries_counter import QueriesCounter
+from src.eligible_index import EligibleSampler
+from src.model_wrappers import ModelWrapper
 from src.setup import setup_attack, setup_model_and_data, setup_out_dir
 
 
-def main(args):
+def attack_sample(args, model: ModelWrapper, attack: BaseAttack, xi: torch.Tensor, yi: torch.Tensor, i: int,
+                  device: torch.device) -> tuple[torch.Tensor, QueriesCounter, float, bool, ExtraResultsDict]:
     targeted = True if args.targeted == '1' else False
+
+    # The randomness of each sample only depends on its index, so that runs on different shards give the same
+    # results as a single run
+    rngs = make_sample_rngs(args.seed, i, device)
+    attack.set_sample_rngs(rngs)
+
+    target = rngs.numpy_generator.integers(model.n_class) * torch.ones(
+        yi.shape, dtype=torch.long).to(device) if targeted else None
+    while target and torch.sum(target == yi) > 0:
+        print('re-generate target label')
+        target = rngs.numpy_generator.integers(model.n_class) * torch.ones(len(xi), dtype=torch.long).to(device)
+
+    model.num_queries = 0
+    with torch.no_grad():
+        return attack(model, xi, yi, target)
+
+
+def main(args):
     early_stopping = False if args.early == '0' else True
 
     print(args)
 
-    device = torch.device("cuda")
+    device = torch.device(args.device)
 
     model, test_loader = setup_model_and_data(args, device)
     exp_out_dir = setup_out_dir(args)
     attack = setup_attack(args)
-    attack_results = AttackResults(exp_out_dir)
-
-    seeds = np.random.randint(10000, size=10000)
+    curves_aggregator = CurvesAggregator(exp_out_dir) if args.live_curves == '1' else None
+    attack_results = AttackResults(exp_out_dir, curves_aggregator=curves_aggregator)
 
     count = 0
     misclassified = 0
     negatives = 0
 
+    # If the samples are filtered by the eligible samples index, they are known to be positive and correctly
+    # classified, and `i` is still the position of the sample in the unfiltered order
+    eligible_sampler = test_loader.sampler if isinstance(test_loader.sampler, EligibleSampler) else None
+
     for i, batch in enumerate(test_loader):
         if count == args.num:
             break
+        if eligible_sampler is not None:
+            i = eligible_sampler.current_position
 
         if isinstance(batch, dict):
             xi, yi = batch["image"], batch["label"]
@@ -38,27 +67,17 @@ def main(args):
         print(f"Sample {i}, class: {yi.item()}, attacks count: {count}")
         xi, yi = xi.to(device), yi.to(device)
 
-        if model.n_class == 2 and yi.item() == 0:
+        if eligible_sampler is None and model.n_class == 2 and yi.item() == 0:
             negatives += 1
             print("Skipping as item is negative")
             continue
 
-        if model.predict_label(xi) != yi:
+        if eligible_sampler is None and model.predict_label(xi) != yi:
             misclassified += 1
             print("Skipping as item is misclassified")
             continue
 
-        np.random.seed(seeds[count])
-
-        target = np.random.randint(model.n_class) * torch.ones(yi.shape,
-                                                               dtype=torch.long).to(device) if targeted else None
-        while target and torch.sum(target == yi) > 0:
-            print('re-generate target label')
-            target = np.random.randint(model.n_class) * torch.ones(len(xi), dtype=torch.long).to(device)
-
-        model.num_queries = 0
-        with torch.no_grad():
-            adv, queries_counter, dist, succ, extra_results = attack(model, xi, yi, target)
+        adv, queries_counter, dist, succ, extra_results = attack_sample(args, model, attack, xi, yi, i, device)
 
         if args.save_img_every is not None and count % args.save_img_every == 0:
             np.save(exp_out_dir / f"{i}_adv.npy", adv[0].cpu().numpy())
@@ -77,9 +96,11 @@ def main(args):
         #     attack_results.simulated_self.log_results(i)
 
     attack_results.save_results(verbose=True)
+    if curves_aggregator is not None:
+        curves_aggregator.close()
 
 
-if __name__ == "__main__":
+def make_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description='Hard Label Attacks')
     parser.add_argument('--attack', default='rays', type=str, help='The attack to run')
     parser.add_argument('--dataset', default='imagenet', type=str, help='Dataset')
@@ -89,12 +110,36 @@ if __name__ == "__main__":
     parser.add_argument('--max-queries', default=None, type=int, help='Maximum queries for the attack')
     parser.add_argument('--max-unsafe-queries', default=None, type=int, help='Maximum unsafe queries for the attack')
     parser.add_argument('--batch', default=1, type=int, help='attack batch size.')
+    parser.add_argument('--seed',
+                        default=0,
+                        type=int,
+                        help='Seed of the run. The random number generators used to attack each sample are derived '
+                        'from it and from the index of the sample')
     parser.add_argument('--epsilon', default=None, type=float, help='attack strength')
     parser.add_argument('--early',
                         default='1',
                         type=str,
                         help='early stopping (stop attack once the adversarial example is found)')
-    parser.add_argument('--search', default='binary', type=str, help='Type of search to use, binary or line')
+    parser.add_argument('--search',
+                        default='binary',
+                        type=str,
+                        help='Type of search to use, binary, line or eggs_dropping')
+    parser.add_argument('--eggs-dropping-max-eggs',
+                        default=2,
+                        type=int,
+                        help='Maximum number of bad queries of each eggs dropping search. The number of bad queries '
+                        'which minimizes the worst-case cost of the search is used. With the defaults, the schedule '
+                        'is the one of the two eggs dropping search')
+    parser.add_argument('--bad-query-cost-ratio',
+                        default=1.,
+                        type=float,
+                        help='Cost of a bad query relative to a good one, used to schedule the eggs dropping search')
+    parser.add_argument('--adaptive-line-search-batch',
+                        default='1',
+                        type=str,
+                        help='Whether the batches of the batched line searches start small and grow while all their '
+                        'queries are safe, instead of always having the maximum size. The queries which are counted '
+                        'are the same, but fewer queries after the boundary are computed and discarded')
     parser.add_argument('--line-search-tol',
                         default=None,
                         type=float,
@@ -109,149 +154,117 @@ if __name__ == "__main__":
         default='/data/imagenet/val',
         type=str,
     )
+    parser.add_argument('--sample-cache-dir',
+                        default=None,
+                        type=str,
+                        help='Directory with the preprocessed samples built by `scripts/build_sample_cache.py`. If '
+                        'given, the samples are loaded from `{sample-cache-dir}/{dataset}` when the cache is valid')
+    parser.add_argument('--eligible-index-dir',
+                        default=None,
+                        type=str,
+                        help='Directory with the indices of the eligible samples (i.e., correctly classified and '
+                        'positive) built by `scripts/build_eligible_index.py`. If given and valid, only the eligible '
+                        'samples are loaded and attacked, in the same order as without it')
     parser.add_argument(
         '--save-img-every',
         default=50,
         type=int,
     )
+    parser.add_argument('--live-curves',
+                        default='0',
+                        type=str,
+                        help='Whether the arrays of the best distance and of the total queries at each bad query, '
+                        'which are used by `plot_dist_vs_queries.py`, should be updated after each sample')
+    parser.add_argument('--trace-recording',
+                        default='full',
+                        type=str,
+                        choices=['full', 'change_points'],
+                        help='Whether the traces keep the distances after each query (`distances_traces.json`), or '
+                        'only the number of queries of each run of queries with the same phase and outcome, and the '
+                        'queries which improve the best distance (`change_points_traces.json`)')
     parser.add_argument('--strong-preprocessing',
                         default='0',
                         type=str,
                         help='Whether strong preprocessing (i.e., JPEG, Resize, Crop) '
                         'should be applied before feeding the image to the classifier')
+    parser.add_argument('--strong-preprocessing-jpeg-quality',
+                        default=75,
+                        type=int,
+                        help='JPEG quality of the strong preprocessing')
+    parser.add_argument('--strong-preprocessing-resize',
+                        default=None,
+                        type=int,
+                        help='Size the smaller side of the images is resized to by the strong preprocessing, before '
+                        'center-cropping them back to their original size. Defaults to the original size / 0.875')
+    parser.add_argument('--strong-preprocessing-workers',
+                        default=None,
+                        type=int,
+                        help='Number of threads used to JPEG-compress the queries in the strong preprocessing')
+    parser.add_argument('--device', default='cuda', type=str, help='Device to run the model and the attack on')
+    parser.add_argument('--model-backend',
+                        default='torch',
+                        type=str,
+                        choices=['torch', 'quantized', 'onnx'],
+                        help='Backend to run the model with. `quantized` uses an int8 CPU version of the model, '
+                        'meant for fast exploratory sweeps. `onnx` runs the model exported with '
+                        '`scripts/export_onnx.py` with ONNX Runtime')
+    parser.add_argument('--quantization-calibration-size',
+                        default=256,
+                        type=int,
+                        help='Number of images used to calibrate the quantized model (and to report its agreement '
+                        'with the float model)')
+    parser.add_argument('--quantized-checkpoints-dir',
+                        default='checkpoints/quantized',
+                        type=str,
+                        help='Where the quantized models are cached')
+    parser.add_argument('--model-micro-batch-size',
+                        default=None,
+                        type=int,
+                        help='Maximum number of images given to the model at once. By default, batches are given as '
+                        'they are, and they are split automatically (halving the size) if the model runs out of memory')
+    parser.add_argument('--onnx-model-path',
+                        default=None,
+                        type=str,
+                        help='Path of the ONNX model, defaults to `checkpoints/onnx/{dataset}.onnx`')
+    parser.add_argument('--onnx-intra-op-threads',
+                        default=0,
+                        type=int,
+                        help='Number of threads used by ONNX Runtime within each op (0 lets ONNX Runtime decide)')
+    parser.add_argument('--onnx-inter-op-threads',
+                        default=0,
+                        type=int,
+                        help='Number of threads used by ONNX Runtime across ops (0 lets ONNX Runtime decide)')
     parser.add_argument('--model-threshold', default=0.25, type=float, help='The threshold to use for the API model')
     parser.add_argument('--discrete',
                         default='0',
                         type=str,
                         help='Whether the attack should work in discrete space (i.e., int8)')
-    parser.add_argument('--rays-flip-squares',
+    parser.add_argument('--uint8-queries',
                         default='0',
                         type=str,
-                        help='Whether the attack should flip squares and not chunks of a 1-d vector')
-    parser.add_argument('--rays-flip-rand-pixels',
-                        default='0',
-                        type=str,
-                        help='Whether the attack should flip random pixels not chunks of a 1-d vector')
-    parser.add_argument('--max-iter', default=None, type=int, help='Number of iterations for HSJA, OPT and SignOPT')
-    parser.add_argument('--hsja-stepsize-search',
-                        default='geometric_progression',
+                        help='Whether the queries of discrete attacks are given to the model as uint8 (instead of '
+                        'float32) images, which the model dequantizes and normalizes in one step. The attacks still '
+                        'build their queries as float32, which are rounded to uint8 right before the model is queried, '
+                        'so this does not reduce the memory used by the attacks')
+    parser.add_argument('--discrete-codec',
+                        default='png',
                         type=str,
-                        help='Stepsize search for HSJA')
-    parser.add_argument('--hsja-max-num-evals', default=1e4, type=int, help='Max number of evaluations for HSJA')
-    parser.add_argument('--hsja-init-num-evals', default=100, type=int, help='Max number of evaluations for HSJA')
-    parser.add_argument('--hsja-gamma',
-                        default=10_000,
-                        type=float,
-                        help='gamma parameter for HSJA (used for the binary search threshold)')
-    parser.add_argument('--hsja-delta',
+                        choices=['png', 'jpeg', 'webp'],
+                        help='Format in which the queries of discrete attacks are encoded and decoded. Lossless '
+                        'formats only round the queries to int8')
+    parser.add_argument('--discrete-codec-quality',
                         default=None,
-                        type=float,
-                        help='Whether to use a fixed delta for gradient estimation in HSJA, '
-                        'an adaptive delta is used if this is None')
-    parser.add_argument('--hsja-grad-est-mode',
-                        default='hsja',
-                        type=str,
-                        help='Gradient estimation mode for HSJA, one of `hsja`, `opt` or `sign_opt`')
-    parser.add_argument('--hsja-n-searches',
-                        default=2,
-                        type=int,
-                        help='Number of searches for OPT and Sign OPT',
-                        choices=[1, 2])
-    parser.add_argument('--hsja-bias-coef',
-                        default=0.0,
-                        type=float,
-                        help='bias coefficient for HSJA (used to move boundary point farther before gradient estimation.)')
-    parser.add_argument('--hsja-lower-bad-query-bound',
-                        default=10,
-                        type=int,
-                        help='desired lower bound on the number of bad queries in the gradient esitmation phase.')
-    parser.add_argument('--hsja-upper-bad-query-bound',
-                        default=20,
-                        type=int,
-                        help='desired upper bound on the number of bad queries in the gradient esitmation phase.')
-    parser.add_argument('--hsja-bias-coef-change-rate',
-                        default=0.1,
-                        type=float,
-                        help='used to change the bias coefficient adaptively.')
-    
-    parser.add_argument('--opt-alpha', default=0.2, type=float, help='alpha parameter for OPT and Sign OPT')
-    parser.add_argument('--opt-beta', default=0.01, type=float, help='beta parameter for OPT and Sign OPT')
-    parser.add_argument(
-        '--opt-grad-est-search',
-        default=None,
-        type=str,
-        help='What search should be used for gradient estimation in OPT. Default is what it specified with --search')
-    parser.add_argument(
-        '--opt-step-size-search',
-        default=None,
-        type=str,
-        help='What search should be used for step size search in OPT. Default is what it specified with --search')
-    parser.add_argument('--opt-line-search-overshoot',
-                        default=2.5,
-                        type=float,
-                        help='Line search overshoot for OPT and Sign OPT')
-    parser.add_argument('--opt-n-searches',
-                        default=2,
-                        type=int,
-                        help='Number of searches for OPT and Sign OPT',
-                        choices=[1, 2])
-    parser.add_argument('--opt-max-search-steps',
-                        default=10_000,
-                        type=int,
-                        help='Max number of line search steps for OPT and Sign OPT')
-    parser.add_argument('--opt-bs', default=100, type=int, help='Batch size for for OPT and Sign OPT')
-    parser.add_argument('--opt-num-grad-queries', default=10, type=int, help='Number of gradient queries for OPT')
-    parser.add_argument('--opt-num-init-directions', default=100, type=int, help='Number of init directions OPT')
-    parser.add_argument('--opt-get-one-init-direction',
-                        default='0',
-                        type=str,
-                        help='Whether OPT should stop when it finds one good initial direction')
-    parser.add_argument('--sign-opt-num-grad-queries',
-                        default=200,
                         type=int,
-                        help='Number of gradient queries for Sign OPT')
-    parser.add_argument('--sign-opt-momentum', default=0., type=float, help='Momentum for Sign OPT')
-    
-    
-    parser.add_argument('--geoda-n-searches',
-                        default=2,
-                        type=int,
-                        help='Number of searches for GeoDA',
-                        choices=[1, 2])
-    parser.add_argument('--geoda-theta',
-                        default=1e-4,
-                        type=float,
-                        help='Theta parameter for GeoDA')
-    parser.add_argument('--geoda-delta',
-                        default=2e-4,
-                        type=float,
-                        help='Delta parameter for GeoDA')
-    parser.add_argument('--geoda-max-num-evals', default=1e4, type=int, help='Max number of evaluations for GeoDA')
-    parser.add_argument('--geoda-init-num-evals', default=100, type=int, help='GeoDA init num evals')
-    parser.add_argument('--geoda-bias-coef',
-                        default=0.0,
-                        type=float,
-                        help='bias coefficient for GeoDA (used to move boundary point further before gradient estimation.)')
-    parser.add_argument('--geoda-lower-bad-query-bound',
-                        default=10,
-                        type=int,
-                        help='desired lower bound on the number of bad queries in the gradient esitmation phase.')
-    parser.add_argument('--geoda-upper-bad-query-bound',
-                        default=20,
+                        help='Quality of the lossy discrete codec, defaults to the one of PIL')
+    parser.add_argument('--discrete-codec-workers',
+                        default=None,
                         type=int,
-                        help='desired upper bound on the number of bad queries in the gradient esitmation phase.')
-    parser.add_argument('--geoda-bias-coef-change-rate',
-                        default=0.1,
-                        type=float,
-                        help='used to change the bias coefficient adaptively.')
-    parser.add_argument('--geoda-dim-reduc-factor',
-                        default=1e0,
-                        type=float,
-                        help='Dimension reduciton factor for creating subspace in GeoDA')
-    parser.add_argument('--geoda-search-radius-increase',
-                        default=1.1,
-                        type=float,
-                        help='Multiplier used to increase search radius')
-    
-    _args = parser.parse_args()
+                        help='Number of threads used to encode and decode the queries with lossy codecs')
+    parser.add_argument('--max-iter', default=None, type=int, help='Number of iterations for HSJA, OPT and SignOPT')
+    registry.add_attack_arguments(parser)
+    return parser
+
+
+if __name__ == "__main__":
+    _args = make_parser().parse_args()
     main(_args)
@@ -1,8 +1,9 @@
 import argparse
 from io import TextIOWrapper
+import itertools
 import json
 from pathlib import Path
-from typing import Any, Iterator
+from typing import Any, Iterable, Iterator, TypeVar
 import warnings
 
 import ijson
@@ -11,9 +12,15 @@ import numpy as np
 import pandas as pd
 import tqdm
 from ijson.common import IncompleteJSONError
-from scipy.stats import linregress
 
-from src.attacks.queries_counter import CurrentDistanceInfo, WrongCurrentDistanceInfo
+from src.attack_results import CHANGE_POINTS_TRACES_FILENAME, PHASES_EXCLUDED_FROM_CURVES, get_trace_curves
+from src.attacks.queries_counter import (CurrentDistanceInfo, QueriesRun, RunLengthDistances,
+                                         WrongCurrentDistanceInfo)
+from src.best_distance_traces import BestDistanceTraces
+from src.distance_arrays import (DEFAULT_BOOTSTRAP_RESAMPLES, MAX_BAD_QUERIES_TRADEOFF_PLOT, MAX_QUERIES,
+                                 MAX_UNSAFE_QUERIES, bootstrap_columnwise_median_ci, columnwise_median,
+                                 complete_tradeoff_arrays, load_array, median_distance_per_cost,
+                                 total_queries_at_bad_queries, write_rows_to_npy)
 from src.json_list import JSONList
 from src.utils import read_sha256sum, sha256sum, write_sha256sum
 from src.attacks.hsja import HSJAttackPhase
@@ -22,58 +29,66 @@ from src.attacks.opt import OPTAttackPhase
 OPENED_FILES: list[TextIOWrapper] = []
 MAX_SAMPLES = 1000
 
-MAX_BAD_QUERIES_TRADEOFF_PLOT = 5000
+T = TypeVar("T")
 
 
-def expand_array_with_interpolation(array: np.ndarray, total_entries: int, last_k: int = 100) -> np.ndarray:
-    to_expand = total_entries - len(array)
-    linear_regression_results = linregress(np.arange(len(array))[-last_k:], array[-last_k:])
-    range_to_expand = np.arange(len(array), len(array) + to_expand)
-    expansion = range_to_expand * linear_regression_results.slope + linear_regression_results.intercept  # type: ignore
-    full_array = np.concatenate((array, expansion))
-    assert len(full_array) == total_entries
-    return full_array
+def get_unsafe_mask(distances: list[dict[str, Any]]) -> np.ndarray:
+    return np.fromiter((not distance["safe"] for distance in distances), dtype=bool, count=len(distances))
 
 
-def get_good_to_bad_queries_array_individual_simulated(distances: list[dict[str, Any]]) -> np.ndarray:
-    queries: list[bool] = []
-    n_unsafe_queries = 0
-    for distance in distances:
-        if distance["equivalent_simulated_queries"] == 0:
-            continue
-        if not distance["safe"]:
-            n_unsafe_queries += distance["equivalent_simulated_queries"]
-        queries += [not distance["safe"]] * distance["equivalent_simulated_queries"]
-        if n_unsafe_queries >= MAX_BAD_QUERIES_TRADEOFF_PLOT:
-            break
-
-    tot_queries_per_bad_query = np.arange(1, len(queries) + 1)[np.array(queries)]
-    if n_unsafe_queries < MAX_BAD_QUERIES_TRADEOFF_PLOT:
-        tot_queries_per_bad_query = expand_array_with_interpolation(tot_queries_per_bad_query,
-                                                                    MAX_BAD_QUERIES_TRADEOFF_PLOT)
-    return tot_queries_per_bad_query
-
-
-def get_good_to_bad_queries_array_individual(distances: list[dict[str, Any]]) -> np.ndarray:
-    queries: list[bool] = []
-    n_unsafe_queries = 0
-    for distance in distances:
-        if not distance["safe"]:
-            n_unsafe_queries += 1
-        queries.append(not distance["safe"])
-        if n_unsafe_queries >= MAX_BAD_QUERIES_TRADEOFF_PLOT:
-            break
-    if n_unsafe_queries < MAX_BAD_QUERIES_TRADEOFF_PLOT:
-        ...  # warnings.warn(f"Only {n_unsafe_queries} unsafe queries found")
+def get_simulated_total_queries_at_bad_queries(distances: list[dict[str, Any]]) -> np.ndarray:
+    simulated_distances = RunLengthDistances.from_dicts(distances)
+    # Stop after the run in which the limit of unsafe queries is reached
+    n_runs = np.searchsorted(simulated_distances.unsafe_ends, MAX_BAD_QUERIES_TRADEOFF_PLOT, side="left") + 1
+    simulated_distances = simulated_distances.truncate(n_runs)
+    n_unsafe_queries = simulated_distances.total_unsafe_queries
+
+    total_queries = np.full(MAX_BAD_QUERIES_TRADEOFF_PLOT, np.nan)
+    # Samples whose last run goes over the limit are left empty, and then discarded
+    if n_unsafe_queries <= MAX_BAD_QUERIES_TRADEOFF_PLOT:
+        bad_queries = np.arange(1, n_unsafe_queries + 1)
+        total_queries[:n_unsafe_queries] = simulated_distances.total_queries_at_unsafe(bad_queries)
+    return total_queries
+
+
+def get_good_to_bad_queries_arrays_batch(items: list[list[dict[str, Any]]], simulated: bool) -> np.ndarray:
+    """Tradeoff arrays of a batch of samples, extrapolated to `MAX_BAD_QUERIES_TRADEOFF_PLOT` bad queries. The samples
+    that cannot be extrapolated are discarded."""
+    if simulated:
+        total_queries = np.stack([get_simulated_total_queries_at_bad_queries(distances) for distances in items])
+    else:
+        total_queries = total_queries_at_bad_queries(list(map(get_unsafe_mask, items)),
+                                                     MAX_BAD_QUERIES_TRADEOFF_PLOT)
+    return complete_tradeoff_arrays(total_queries)
+
+
+def has_only_change_points_traces(exp_path: Path) -> bool:
+    return not (exp_path / "distances_traces.json").exists() and (exp_path / CHANGE_POINTS_TRACES_FILENAME).exists()
+
+
+def load_change_points_traces(exp_path: Path) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """Best distance after each bad query and mask of the bad queries of the samples of an experiment run with
+    `--trace-recording change_points`."""
+    print(f"Loading change points from {exp_path / CHANGE_POINTS_TRACES_FILENAME}")
+    f = (exp_path / CHANGE_POINTS_TRACES_FILENAME).open("r")
+    OPENED_FILES.append(f)
+    for trace in ijson.items(f, "item", use_float=True):
+        yield get_trace_curves([QueriesRun(*run) for run in trace["runs"]], trace["change_points"])
+
+
+def check_not_simulated_change_points(exp_path: Path, simulated: bool) -> None:
+    if simulated and has_only_change_points_traces(exp_path):
+        raise ValueError(f"Cannot simulate the queries of {exp_path}, as only the change points are recorded")
 
-    tot_queries_per_bad_query = np.arange(1, len(queries) + 1)[np.array(queries)]
-    if n_unsafe_queries < MAX_BAD_QUERIES_TRADEOFF_PLOT:
-        tot_queries_per_bad_query = expand_array_with_interpolation(tot_queries_per_bad_query,
-                                                                    MAX_BAD_QUERIES_TRADEOFF_PLOT)
-    return tot_queries_per_bad_query
+
+def batched(iterable: Iterable[T], n: int) -> Iterator[list[T]]:
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
 
 
 TRADEOFF_ARRAY_NAME = "tradeoff_array{}.npy"
+TRADEOFF_BATCH_SIZE = 64
 
 
 def get_good_to_bad_queries_array(exp_path: Path, simulated: bool) -> np.ndarray:
@@ -83,23 +98,26 @@ def get_good_to_bad_queries_array(exp_path: Path, simulated: bool) -> np.ndarray
         array_name = TRADEOFF_ARRAY_NAME.format("")
     if (exp_path / array_name).exists():
         print(f"Loading tradeoff array from {exp_path / array_name}")
-        return np.load(exp_path / array_name)
+        return load_array(exp_path / array_name)
 
     print(f"Generating tradeoff array for {exp_path}")
-    original_distances_filename = are_distances_wrong(
-        exp_path) and "distances_traces_fixed.json" or "distances_traces.json"
-    f = (exp_path / original_distances_filename).open("r")
-    OPENED_FILES.append(f)
-    items = ijson.items(f, "item", use_float=True)
-    if not simulated:
-        arrays_iter = map(get_good_to_bad_queries_array_individual, items)
+    check_not_simulated_change_points(exp_path, simulated)
+    if has_only_change_points_traces(exp_path):
+        unsafe_masks = (unsafe_mask for _, unsafe_mask in load_change_points_traces(exp_path))
+        arrays_batches = map(
+            lambda batch: complete_tradeoff_arrays(total_queries_at_bad_queries(batch, MAX_BAD_QUERIES_TRADEOFF_PLOT)),
+            batched(unsafe_masks, TRADEOFF_BATCH_SIZE))
     else:
-        arrays_iter = map(get_good_to_bad_queries_array_individual_simulated, items)
-
-    arrays_iter = filter(lambda x: len(x) == MAX_BAD_QUERIES_TRADEOFF_PLOT, arrays_iter)
-    final_array = np.fromiter(tqdm.tqdm(arrays_iter, total=MAX_SAMPLES),
-                              dtype=np.dtype((float, MAX_BAD_QUERIES_TRADEOFF_PLOT)))
-    np.save(exp_path / array_name, final_array)
+        original_distances_filename = are_distances_wrong(
+            exp_path) and "distances_traces_fixed.json" or "distances_traces.json"
+        f = (exp_path / original_distances_filename).open("r")
+        OPENED_FILES.append(f)
+        items = ijson.items(f, "item", use_float=True)
+        arrays_batches = map(lambda batch: get_good_to_bad_queries_arrays_batch(batch, simulated),
+                             batched(items, TRADEOFF_BATCH_SIZE))
+    arrays_iter = (array for arrays_batch in arrays_batches for array in arrays_batch)
+    final_array = write_rows_to_npy(exp_path / array_name, tqdm.tqdm(arrays_iter, total=MAX_SAMPLES),
+                                    MAX_BAD_QUERIES_TRADEOFF_PLOT, float)
     print(f"Saved tradeoff array to {exp_path / array_name}")
     return final_array
 
@@ -224,7 +242,14 @@ def get_simulated_array(exp_path: Path, unsafe_only: bool, simulate_ideal_line:
                                                          "_unsafe_only" if unsafe_only else "")
     if (exp_path / array_filename).exists():
         print("Loading simulated distances from file")
-        return np.load(exp_path / array_filename)
+        return load_array(exp_path / array_filename)
+    simulated_distances = load_simulated_distances(exp_path, unsafe_only, simulate_ideal_line)
+    return convert_distances_to_array(simulated_distances, unsafe_only, exp_path / array_filename)
+
+
+def load_simulated_distances(exp_path: Path, unsafe_only: bool,
+                             simulate_ideal_line: bool = False) -> Iterator[list[CurrentDistanceInfo]]:
+    check_not_simulated_change_points(exp_path, simulated=True)
     original_distances_filename = are_distances_wrong(
         exp_path) and "distances_traces_fixed.json" or "distances_traces.json"
     f = (exp_path / original_distances_filename).open("r")
@@ -251,9 +276,7 @@ def get_simulated_array(exp_path: Path, unsafe_only: bool, simulate_ideal_line:
         assert unsafe_only
         print("Generating simulated distances with ideal line search")
         simulated_distances = generate_ideal_line_simulated_distances(raw_results)
-    array = convert_distances_to_array(simulated_distances, unsafe_only)
-    save_distances_array(exp_path, array, True, False, array_filename)
-    return array
+    return simulated_distances
 
 
 def wrap_ijson_iterator(iterator: Iterator[list[dict[str, Any]]]) -> Iterator[list[dict[str, Any]]]:
@@ -312,37 +335,27 @@ def are_distances_wrong(exp_path: Path) -> bool:
     return t.split("\"safe\": ")[1][0] == "["
 
 
-def pad_to_len(list_: list[float], n: int) -> np.ndarray:
-    to_pad = n - len(list_)
-    if to_pad > 0:
-        return np.pad(np.asarray(list_), (0, to_pad), "edge")
-    return np.asarray(list_[:n])
-
-
-MAX_UNSAFE_QUERIES = 15_000
-MAX_QUERIES = 50_000
-
-
-def convert_distances_to_array(distances: Iterator[list[CurrentDistanceInfo]], unsafe_only: bool) -> np.ndarray:
+def get_best_distance_up_to_query(distances: Iterator[list[CurrentDistanceInfo]],
+                                  unsafe_only: bool) -> Iterator[list[float]]:
     if unsafe_only:
         queries_to_plot = map(lambda sample_distances: list(filter(lambda query: not query.safe, sample_distances)),
                               distances)
     else:
         queries_to_plot = distances
+    return map(lambda sample_distances: [x.best_distance for x in sample_distances], queries_to_plot)
+
 
+def convert_distances_to_array(distances: Iterator[list[CurrentDistanceInfo]], unsafe_only: bool,
+                               array_path: Path) -> np.ndarray:
     if not unsafe_only:
         plot_up_to = MAX_QUERIES
     else:
         plot_up_to = MAX_UNSAFE_QUERIES
 
-    best_distance_up_to_query = map(lambda sample_distances: [x.best_distance for x in sample_distances],
-                                    queries_to_plot)
+    best_distance_up_to_query = get_best_distance_up_to_query(distances, unsafe_only)
 
-    print("Converting distances to array")
-    limited_queries_to_plot = np.fromiter(tqdm.tqdm((pad_to_len(l_, plot_up_to) for l_ in best_distance_up_to_query),
-                                                    total=MAX_SAMPLES),
-                                          dtype=np.dtype((float, plot_up_to)))
-    return limited_queries_to_plot
+    print(f"Converting distances to array in {array_path}")
+    return write_rows_to_npy(array_path, tqdm.tqdm(best_distance_up_to_query, total=MAX_SAMPLES), plot_up_to)
 
 
 def load_distances_from_json(exp_path: Path, checksum_check: bool) -> Iterator[list[CurrentDistanceInfo]]:
@@ -376,7 +389,7 @@ def load_distances_from_json(exp_path: Path, checksum_check: bool) -> Iterator[l
     return map(lambda x: list(map(lambda y: CurrentDistanceInfo(**y), x)), raw_results)
 
 
-PHASES = {HSJAttackPhase.gradient_estimation_search_start}
+PHASES = PHASES_EXCLUDED_FROM_CURVES
 
 
 def filter_distances_based_on_phase(
@@ -385,38 +398,79 @@ def filter_distances_based_on_phase(
         yield list(filter(lambda x: x.phase not in PHASES, sample_distances))
 
 
+def is_derived_file_outdated(source_path: Path, checksum_path: Path) -> bool:
+    """Whether a file derived from `source_path` was computed from a different version of it. If the checksum of the
+    version it was computed from was not saved, it is considered outdated."""
+    return not checksum_path.exists() or sha256sum(source_path) != read_sha256sum(checksum_path)
+
+
 def load_distances_from_array(exp_path: Path, unsafe_only: bool, check_checksum: bool) -> np.ndarray:
     array_path = exp_path / f"distances_array{'_unsafe_only' if unsafe_only else ''}.npy"
+    if has_only_change_points_traces(exp_path):
+        if not unsafe_only:
+            raise ValueError(f"Only the distances after the bad queries can be loaded from the change points of "
+                             f"{exp_path}")
+        if array_path.exists():
+            return load_array(array_path)
+        print(f"Converting change points to array in {array_path}")
+        best_distances = (best_distances for best_distances, _ in load_change_points_traces(exp_path))
+        return write_rows_to_npy(array_path, tqdm.tqdm(best_distances, total=MAX_SAMPLES), MAX_UNSAFE_QUERIES)
     recompute_array = not array_path.exists()
     if recompute_array:
         print("The distances array file does not exist. Reading distances_traces.json and re-creating the array.")
     checksum_filename = f"distances_traces-to_numpy{'-unsafe_only' if unsafe_only else ''}.json.sha256"
-    if check_checksum and array_path.exists() and sha256sum(exp_path / "distances_traces.json") != read_sha256sum(
-            exp_path / checksum_filename):
+    # The arrays made during the run (with `--live-curves 1`) have no checksum, and are re-created
+    if check_checksum and array_path.exists() and is_derived_file_outdated(exp_path / "distances_traces.json",
+                                                                           exp_path / checksum_filename):
         print("The distances array is outdated. Re-reading distances_traces.json and re-creating the array.")
         recompute_array = True
     if recompute_array:
         print("Converting the distances to arrays")
         distances = load_distances_from_json(exp_path, check_checksum)
         filtered_distances = filter_distances_based_on_phase(distances)
-        distances = convert_distances_to_array(filtered_distances, unsafe_only)
-        save_distances_array(exp_path, distances, unsafe_only, check_checksum)
+        distances = convert_distances_to_array(filtered_distances, unsafe_only, array_path)
+        if check_checksum:
+            save_distances_array_checksum(exp_path, unsafe_only)
         return distances
-    return np.load(array_path)
+    return load_array(array_path)
+
 
+BEST_DISTANCE_TRACES_FILENAME = "{}best_distance_traces_unsafe_only.npz"
 
-def save_distances_array(exp_path: Path,
-                         distances_array: np.ndarray,
-                         unsafe_only: bool,
-                         save_checksum: bool,
-                         filename: str | None = None):
-    filename = filename or f"distances_array{'_unsafe_only' if unsafe_only else ''}.npy"
-    np.save(exp_path / filename, distances_array)
-    if save_checksum:
-        checksum_filename = f"distances_traces-to_numpy{'-unsafe_only' if unsafe_only else ''}.json.sha256"
-        print(f"Saving checksum of distances_traces.json to {checksum_filename}")
-        checksum_file_destination = exp_path / checksum_filename
-        write_sha256sum(exp_path / "distances_traces.json", checksum_file_destination)
+
+def get_best_distance_traces(exp_path: Path, simulate: bool, checksum_check: bool) -> BestDistanceTraces:
+    """Loads the change points of the best distance after each bad query, without making the dense arrays."""
+    traces_path = exp_path / BEST_DISTANCE_TRACES_FILENAME.format("simulated_" if simulate else "")
+    only_change_points = has_only_change_points_traces(exp_path)
+    source_path = exp_path / (CHANGE_POINTS_TRACES_FILENAME if only_change_points else "distances_traces.json")
+    checksum_path = exp_path / f"{source_path.stem}-to_{traces_path.stem}{source_path.suffix}.sha256"
+    if traces_path.exists():
+        if not checksum_check or not is_derived_file_outdated(source_path, checksum_path):
+            print(f"Loading best distance traces from {traces_path}")
+            return BestDistanceTraces.load(traces_path)
+        print(f"The best distance traces are outdated. Re-reading {source_path.name} and re-creating them.")
+    if only_change_points:
+        best_distance_up_to_query = (best_distances for best_distances, _ in load_change_points_traces(exp_path))
+    else:
+        if simulate:
+            distances = load_simulated_distances(exp_path, unsafe_only=True)
+        else:
+            distances = filter_distances_based_on_phase(load_distances_from_json(exp_path, checksum_check))
+        best_distance_up_to_query = get_best_distance_up_to_query(distances, unsafe_only=True)
+    print(f"Converting distances to best distance traces in {traces_path}")
+    traces = BestDistanceTraces.from_samples(tqdm.tqdm(best_distance_up_to_query, total=MAX_SAMPLES))
+    traces.save(traces_path)
+    if checksum_check:
+        print(f"Saving checksum of {source_path.name} to {checksum_path.name}")
+        write_sha256sum(source_path, checksum_path)
+    return traces
+
+
+def save_distances_array_checksum(exp_path: Path, unsafe_only: bool):
+    checksum_filename = f"distances_traces-to_numpy{'-unsafe_only' if unsafe_only else ''}.json.sha256"
+    print(f"Saving checksum of distances_traces.json to {checksum_filename}")
+    checksum_file_destination = exp_path / checksum_filename
+    write_sha256sum(exp_path / "distances_traces.json", checksum_file_destination)
 
 
 COLORS_STYLES_MARKERS = {
@@ -471,9 +525,13 @@ TOT_MARKERS = 5
 LEGEND_FONTSIZE = 'medium'
 
 
+N_CI_POINTS = 200
+
+
 def plot_median_distances_per_query(exp_paths: list[Path], names: list[str] | None, max_queries: int | None,
                                     max_samples: int | None, unsafe_only: bool, out_path: Path, checksum_check: bool,
-                                    to_simulate: list[int] | None, to_simulate_ideal: int | None, draw_legend: str):
+                                    to_simulate: list[int] | None, to_simulate_ideal: int | None, draw_legend: str,
+                                    bootstrap_resamples: int | None = None):
     names = names or ["" for _ in exp_paths]
     distances_arrays = []
 
@@ -521,8 +579,8 @@ def plot_median_distances_per_query(exp_paths: list[Path], names: list[str] | No
             warnings.warn(f"Could not find color, style, marker for {name}. Using default.")
             color, style, marker = None, None, None
         n_to_plot = max_queries or distances.shape[1]
-        median_distances = np.median(distances[:n_samples_to_plot, :n_to_plot], axis=0)
-        full_median_distances = np.median(distances[:n_samples_to_plot], axis=0)
+        full_median_distances = columnwise_median(distances, n_samples_to_plot)
+        median_distances = full_median_distances[:n_to_plot]
         for epsilon in epsilons:
             if ((full_median_distances) < epsilon).any():
                 queries_per_epsilon_df = pd.concat([
@@ -556,13 +614,19 @@ def plot_median_distances_per_query(exp_paths: list[Path], names: list[str] | No
             name = name.replace("RayS (", "").replace(")", "")
         if "opt" in out_path.stem:
             name = name.replace("OPT (", "").replace(")", "")
-        ax.plot(median_distances,
-                label=name if "ideal" not in name else None,
-                color=color,
-                linestyle=style,
-                marker=marker,
-                markevery=(marker_start, markers_frequency),
-                linewidth=linewidth)
+        line, = ax.plot(median_distances,
+                        label=name if "ideal" not in name else None,
+                        color=color,
+                        linestyle=style,
+                        marker=marker,
+                        markevery=(marker_start, markers_frequency),
+                        linewidth=linewidth)
+        if bootstrap_resamples is not None:
+            # The band is computed on a subset of the queries, which is enough for it to look smooth
+            ci_queries = np.unique(np.linspace(0, n_to_plot - 1, N_CI_POINTS).astype(int))
+            lower_bound, upper_bound = bootstrap_columnwise_median_ci(distances, n_samples_to_plot, ci_queries,
+                                                                      bootstrap_resamples)
+            ax.fill_between(ci_queries, lower_bound, upper_bound, color=line.get_color(), alpha=0.2, linewidth=0)
 
     if "ablation" not in str(out_path):
         queries_per_epsilon_df.to_csv(out_path.parent / f"queries_per_epsilon_{out_path.stem}.csv", index=False)
@@ -644,7 +708,7 @@ def plot_bad_vs_good_queries(exp_paths: list[Path], names: list[str] | None, out
             warnings.warn(f"Could not find color, style, marker for {name}. Using default.")
             color, style, marker = None, None, None
 
-        full_median_distances = np.median(array[:n_samples_to_plot], axis=0)
+        full_median_distances = columnwise_median(array, n_samples_to_plot)
         for epsilon in epsilons:
             if ((full_median_distances) < epsilon).any():
                 queries_per_epsilon_df = pd.concat([
@@ -675,7 +739,7 @@ def plot_bad_vs_good_queries(exp_paths: list[Path], names: list[str] | None, out
         n_to_plot = max_queries or distances.shape[1]
         markers_frequency = n_to_plot // TOT_MARKERS
         marker_start = markers_frequency // len(names) * i
-        ax.plot(np.median(distances, axis=0),
+        ax.plot(full_median_distances[:queries_to_plot],
                 label=name,
                 color=color,
                 linestyle=style,
@@ -697,6 +761,19 @@ def plot_bad_vs_good_queries(exp_paths: list[Path], names: list[str] | None, out
     fig.show()
 
 
+def get_tradeoff_and_distances_arrays(exp_path: Path, i: int, to_simulate: list[int] | None,
+                                      to_simulate_ideal: int | None,
+                                      checksum_check: bool) -> tuple[np.ndarray, np.ndarray]:
+    tradeoff_array = get_good_to_bad_queries_array(exp_path, to_simulate is not None and i in to_simulate)
+    if to_simulate is not None and i in to_simulate:
+        distances_array = get_simulated_array(exp_path, unsafe_only=True)
+    elif to_simulate_ideal is not None and i == to_simulate_ideal:
+        distances_array = get_simulated_array(exp_path, unsafe_only=True, simulate_ideal_line=True)
+    else:
+        distances_array = load_distances_from_array(exp_path, unsafe_only=True, check_checksum=checksum_check)
+    return tradeoff_array, distances_array
+
+
 def plot_distance_per_cost(exp_paths: list[Path], names: list[str] | None, out_path: Path, max_samples: int | None,
                            to_simulate: list[int] | None, to_simulate_ideal: bool, draw_legend: str, max_queries: int,
                            query_cost: float, bad_query_cost: float, checksum_check: bool):
@@ -704,13 +781,8 @@ def plot_distance_per_cost(exp_paths: list[Path], names: list[str] | None, out_p
     arrays_to_plot = []
 
     for i, exp_path in enumerate(exp_paths):
-        tradeoff_array = get_good_to_bad_queries_array(exp_path, to_simulate is not None and i in to_simulate)
-        if to_simulate is not None and i in to_simulate:
-            distances_array = get_simulated_array(exp_paths[i], unsafe_only=True)
-        elif to_simulate_ideal is not None and i == to_simulate_ideal:
-            distances_array = get_simulated_array(exp_paths[i], unsafe_only=True, simulate_ideal_line=True)
-        else:
-            distances_array = load_distances_from_array(exp_path, unsafe_only=True, check_checksum=checksum_check)
+        tradeoff_array, distances_array = get_tradeoff_and_distances_arrays(exp_path, i, to_simulate,
+                                                                            to_simulate_ideal, checksum_check)
         queries_to_plot = min(tradeoff_array.shape[1], max_queries, distances_array.shape[1])
         bad_cost_array = np.arange(1, queries_to_plot + 1) * bad_query_cost
         overall_queries_cost_array = tradeoff_array[:, :queries_to_plot] * query_cost
@@ -750,8 +822,8 @@ def plot_distance_per_cost(exp_paths: list[Path], names: list[str] | None, out_p
         markers_frequency = XLIM // TOT_MARKERS
         marker_start = markers_frequency // len(names) * i
 
-        median_cost = np.median(cost_array[:n_samples_to_plot], axis=0)
-        median_distance = np.median(distances_array[:n_samples_to_plot], axis=0)
+        median_cost = columnwise_median(cost_array, n_samples_to_plot)
+        median_distance = columnwise_median(distances_array, n_samples_to_plot)
         plot_range = np.arange(1, XLIM + 1)
         median_cost_interpolated = np.interp(plot_range, median_cost, median_distance)
 
@@ -784,29 +856,107 @@ def plot_distance_per_cost(exp_paths: list[Path], names: list[str] | None, out_p
     fig.show()
 
 
+DEFAULT_COST_RATIOS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+N_SWEEP_COSTS = 20
+
+
+def sweep_distance_per_cost(exp_paths: list[Path], names: list[str] | None, out_path: Path, max_samples: int | None,
+                            to_simulate: list[int] | None, to_simulate_ideal: int | None, max_queries: int | None,
+                            cost_ratios: list[float], costs: list[float] | None, checksum_check: bool) -> None:
+    """Computes the median distance vs. cost curves of all the experiments for all the ratios between the cost of a bad
+    query and the one of any query, at once. Saves the distances at each cost to a CSV, together with the best
+    experiment, and the ratios at which the best experiment changes, and plots a heatmap of the distance of each
+    experiment relative to the first one."""
+    names = names or [str(exp_path) for exp_path in exp_paths]
+    median_total_queries_list, median_distances_list = [], []
+    for i, exp_path in enumerate(exp_paths):
+        tradeoff_array, distances_array = get_tradeoff_and_distances_arrays(exp_path, i, to_simulate,
+                                                                            to_simulate_ideal, checksum_check)
+        median_total_queries_list.append(columnwise_median(tradeoff_array, max_samples))
+        median_distances_list.append(columnwise_median(distances_array, max_samples))
+    n_bad_queries = min(map(len, median_total_queries_list + median_distances_list))
+    n_bad_queries = min(n_bad_queries, max_queries or n_bad_queries)
+    median_total_queries = np.stack([queries[:n_bad_queries] for queries in median_total_queries_list])
+    median_distances = np.stack([distances[:n_bad_queries] for distances in median_distances_list])
+
+    if costs is None:
+        # Costs covered by all the experiments for all the ratios
+        min_cost = (median_total_queries[:, 0] + max(cost_ratios)).max()
+        max_cost = (median_total_queries[:, -1] + min(cost_ratios) * n_bad_queries).min()
+        costs = np.geomspace(min_cost, max(min_cost, max_cost), N_SWEEP_COSTS).tolist()
+    distances_per_cost = median_distance_per_cost(median_total_queries, median_distances, cost_ratios, costs)
+
+    ratios_grid, costs_grid = np.meshgrid(cost_ratios, costs, indexing="ij")
+    results_df = pd.DataFrame({"ratio": ratios_grid.ravel(), "cost": costs_grid.ravel()})
+    for name, distances in zip(names, distances_per_cost):
+        results_df[name] = distances.ravel()
+    reached = ~np.isnan(distances_per_cost).all(axis=0)
+    best_experiments = np.argmin(np.where(np.isnan(distances_per_cost), np.inf, distances_per_cost), axis=0)
+    results_df["best"] = np.where(reached, np.asarray(names, dtype=object)[best_experiments], None).ravel()
+    results_df.to_csv(out_path.parent / f"cost_sweep_{out_path.stem}.csv", index=False)
+
+    crossovers = []
+    for j, cost in enumerate(costs):
+        for k in range(1, len(cost_ratios)):
+            if reached[k - 1, j] and reached[k, j] and best_experiments[k - 1, j] != best_experiments[k, j]:
+                crossovers.append({
+                    "cost": cost,
+                    "ratio_before": cost_ratios[k - 1],
+                    "ratio_after": cost_ratios[k],
+                    "best_before": names[best_experiments[k - 1, j]],
+                    "best_after": names[best_experiments[k, j]],
+                })
+    crossovers_df = pd.DataFrame(crossovers,
+                                 columns=["cost", "ratio_before", "ratio_after", "best_before", "best_after"])
+    crossovers_df.to_csv(out_path.parent / f"cost_crossovers_{out_path.stem}.csv", index=False)
+    print(crossovers_df.to_string(index=False))
+
+    n_plots = max(len(exp_paths) - 1, 1)
+    fig, axs = plt.subplots(1, n_plots, figsize=(PLOTS_WIDTH * n_plots, PLOTS_HEIGHT), squeeze=False)
+    relative_distances = np.log2(distances_per_cost[1:] / distances_per_cost[:1])
+    max_abs_relative_distance = np.nanmax(np.abs(relative_distances), initial=1e-3)
+    for ax, name, relative_distance in zip(axs[0], names[1:], relative_distances):
+        mesh = ax.pcolormesh(costs,
+                             cost_ratios,
+                             relative_distance,
+                             cmap="RdBu_r",
+                             vmin=-max_abs_relative_distance,
+                             vmax=max_abs_relative_distance,
+                             shading="nearest")
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.tick_params(axis="x", which="minor", labelbottom=False)
+        ax.set_xlabel("Cost (in queries)")
+        ax.set_ylabel("$c_{bad} / c_0$")
+        ax.set_title(f"{name} vs. {names[0]}", fontsize="medium")
+        fig.colorbar(mesh, ax=ax, label="log$_2$ distance ratio")
+    fig.savefig(str(out_path), bbox_inches="tight")
+
+
 def get_median_distances_at_queries(exp_path: Path, queries: list[int], name: str, max_samples: int,
-                                    simulate: bool) -> None:
-    if simulate:
-        distances = get_simulated_array(exp_path, True)
-    else:
-        distances = load_distances_from_array(exp_path, True, False)
+                                    simulate: bool, checksum_check: bool,
+                                    bootstrap_resamples: int | None = None) -> None:
+    traces = get_best_distance_traces(exp_path, simulate, checksum_check)
+    distances_at_queries = traces.best_distance_at(queries, max_samples)
+    median_distances = np.median(distances_at_queries, axis=0)
+    if bootstrap_resamples is not None:
+        lower_bounds, upper_bounds = bootstrap_columnwise_median_ci(distances_at_queries,
+                                                                    n_resamples=bootstrap_resamples)
     tradeoff_array = get_good_to_bad_queries_array(exp_path, simulate)
+    scale = 255 if "/linf/" in str(exp_path) else 1
     final_string = f"| {name} |"
-    for query in queries:
-        median_distance = np.median(distances[:max_samples, query])
+    for i, (query, median_distance) in enumerate(zip(queries, median_distances)):
         total_queries = np.median(tradeoff_array[:max_samples, query - 1])
-        if "/linf/" in str(exp_path):
-            median_distance *= 255
-        final_string += f" {median_distance:.2f} <sub><sup>({total_queries:.1e})</sup></sub> |"
+        final_string += f" {median_distance * scale:.2f}"
+        if bootstrap_resamples is not None:
+            final_string += f" [{lower_bounds[i] * scale:.2f}, {upper_bounds[i] * scale:.2f}]"
+        final_string += f" <sub><sup>({total_queries:.1e})</sup></sub> |"
     print(final_string)
 
 
 def get_median_queries_at_distance(exp_path: Path, distances: list[float], name: str, max_samples: int,
-                                   simulate: bool) -> None:
-    if simulate:
-        distances_array = get_simulated_array(exp_path, True)
-    else:
-        distances_array = load_distances_from_array(exp_path, True, False)
+                                   simulate: bool, checksum_check: bool) -> None:
+    traces = get_best_distance_traces(exp_path, simulate, checksum_check)
     tradeoff_array = get_good_to_bad_queries_array(exp_path, simulate)
     for distance in distances:
         if "/linf/" in str(exp_path):
@@ -815,8 +965,10 @@ def get_median_queries_at_distance(exp_path: Path, distances: list[float], name:
         else:
             distance_for_array = distance
             norm = "l2"
-        median_distances = np.median(distances_array[:max_samples], axis=0)
-        queries_for_distance = np.argmax(median_distances < distance_for_array)
+        queries_for_distance = traces.median_first_query_below(distance_for_array, MAX_UNSAFE_QUERIES, max_samples)
+        if queries_for_distance is None:
+            warnings.warn(f"{name} does not reach a median distance of {distance}")
+            continue
         total_queries = np.median(tradeoff_array[:max_samples, queries_for_distance - 1])
         distance_string = f"{name},{norm},{distance},{queries_for_distance},{int(total_queries)}"
         print(distance_string)
@@ -826,7 +978,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("plot_type",
                         type=str,
-                        choices=["distance", "tradeoff", "cost", "distances_at_queries", "queries_at_distance"],
+                        choices=[
+                            "distance", "tradeoff", "cost", "cost_sweep", "distances_at_queries", "queries_at_distance"
+                        ],
                         default="distance")
     parser.add_argument("--exp-paths", type=Path, nargs="+", required=True)
     parser.add_argument("--names", type=str, nargs="+", required=False, default=None)
@@ -840,6 +994,10 @@ if __name__ == "__main__":
     parser.add_argument("--draw-legend", type=str, required=False, default="")
     parser.add_argument("--query-cost", type=float, required=False, default=None)
     parser.add_argument("--bad-query-cost", type=float, required=False, default=None)
+    parser.add_argument("--cost-ratios", type=float, nargs="+", required=False, default=DEFAULT_COST_RATIOS)
+    parser.add_argument("--costs", type=float, nargs="+", required=False, default=None)
+    parser.add_argument("--bootstrap-ci", action="store_true", default=False)
+    parser.add_argument("--bootstrap-resamples", type=int, required=False, default=DEFAULT_BOOTSTRAP_RESAMPLES)
     parser.add_argument("--queries", type=int, nargs="+", required=False, default=[100, 200, 500, 1000])
     parser.add_argument("--distances", type=float, nargs="+", required=False, default=[10, 20])
 
@@ -848,7 +1006,8 @@ if __name__ == "__main__":
         assert args.out_path is not None
         plot_median_distances_per_query(args.exp_paths, args.names, args.max_queries, args.max_samples,
                                         args.unsafe_only, args.out_path, args.checksum_check, args.to_simulate,
-                                        args.to_simulate_ideal, args.draw_legend)
+                                        args.to_simulate_ideal, args.draw_legend,
+                                        args.bootstrap_resamples if args.bootstrap_ci else None)
     elif args.plot_type == "tradeoff":
         assert args.out_path is not None
         plot_bad_vs_good_queries(args.exp_paths, args.names, args.out_path, args.max_samples, args.to_simulate,
@@ -860,12 +1019,18 @@ if __name__ == "__main__":
         plot_distance_per_cost(args.exp_paths, args.names, args.out_path, args.max_samples, args.to_simulate,
                                args.to_simulate_ideal, args.draw_legend, args.max_queries, args.query_cost,
                                args.bad_query_cost, args.checksum_check)
+    elif args.plot_type == "cost_sweep":
+        assert args.out_path is not None
+        sweep_distance_per_cost(args.exp_paths, args.names, args.out_path, args.max_samples, args.to_simulate,
+                                args.to_simulate_ideal, args.max_queries, args.cost_ratios, args.costs,
+                                args.checksum_check)
     elif args.plot_type == "distances_at_queries":
         get_median_distances_at_queries(args.exp_paths[0], args.queries, args.names[0], args.max_samples,
-                                        args.to_simulate is not None)
+                                        args.to_simulate is not None, args.checksum_check,
+                                        args.bootstrap_resamples if args.bootstrap_ci else None)
     elif args.plot_type == "queries_at_distance":
         get_median_queries_at_distance(args.exp_paths[0], args.distances, args.names[0], args.max_samples,
-                                       args.to_simulate is not None)
+                                       args.to_simulate is not None, args.checksum_check)
     else:
         raise ValueError(f"Unknown plot type {args.plot_type}")
 
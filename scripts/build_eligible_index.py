@@ -0,0 +1,33 @@
+import sys
+from argparse import Namespace
+from pathlib import Path
+
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from main import make_parser
+from src.eligible_index import compute_eligible_indices, get_eligible_index_path, save_eligible_index
+from src.setup import get_eligible_index_fingerprint, setup_model_and_data
+
+
+def main(args):
+    if args.eligible_index_dir is None:
+        raise ValueError("`--eligible-index-dir` must be specified")
+    device = torch.device(args.device)
+    # The samples must not be filtered by a possibly existing index
+    model, test_loader = setup_model_and_data(Namespace(**(vars(args) | {"eligible_index_dir": None})), device)
+    eligible_indices = compute_eligible_indices(model, test_loader.dataset, device, args.classification_batch_size,
+                                                args.num_workers)
+    index_path = get_eligible_index_path(Path(args.eligible_index_dir), args)
+    save_eligible_index(index_path, eligible_indices, get_eligible_index_fingerprint(args))
+    print(f"Saved {len(eligible_indices)} eligible samples out of {len(test_loader.dataset)} "  # type: ignore
+          f"to {index_path}")
+
+
+if __name__ == "__main__":
+    # Takes the same arguments as `main.py` (only those about the model and the data are used)
+    parser = make_parser()
+    parser.add_argument("--classification-batch-size", type=int, default=256)
+    parser.add_argument("--num-workers", type=int, default=8)
+    args = parser.parse_args()
+    main(args)
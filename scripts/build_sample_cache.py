@@ -0,0 +1,27 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+from src.dataset import DATASETS
+from src.sample_cache import build_sample_cache
+
+
+def main(args):
+    make_dataset, make_fingerprint = DATASETS[args.dataset]
+    cache_dir = args.output_dir / args.dataset
+    build_sample_cache(make_dataset(args.data_dir), cache_dir, make_fingerprint(args.data_dir), args.batch_size,
+                       args.num_workers)
+    print(f"Saved preprocessed samples to {cache_dir}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", type=str, required=True, choices=list(DATASETS.keys()))
+    # Must be the same `--data-dir` given to `main.py`
+    parser.add_argument("--data-dir", type=str, required=True)
+    parser.add_argument("--output-dir", type=Path, required=True)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=8)
+    args = parser.parse_args()
+    main(args)
@@ -1,3 +1,4 @@
+import os
 import sys
 from pathlib import Path
 
@@ -5,12 +6,11 @@ import numpy as np
 import torch
 import tqdm
 from torch import nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from torchvision.datasets import ImageNet
-from transformers import CLIPProcessor
 
 sys.path.append(str(Path(__file__).parent.parent))
-from src.arch.clip_laion_nsfw import CLIPNSFWDetector
+from src.arch.clip_laion_nsfw import CLIPNSFWDetector, load_image_processor
 
 
 def get_filename(path: str, data_dir: str, split: str) -> str:
@@ -18,34 +18,89 @@ def get_filename(path: str, data_dir: str, split: str) -> str:
     return Path(path).relative_to(base_path).as_posix()
 
 
+def get_shard_range(shard_id: int, num_shards: int, n_samples: int) -> range:
+    return range(shard_id * n_samples // num_shards, (shard_id + 1) * n_samples // num_shards)
+
+
+def get_shard_path(shards_dir: Path, shard_id: int, num_shards: int) -> Path:
+    return shards_dir / f"shard_{shard_id:05d}_of_{num_shards:05d}.npy"
+
+
 @torch.no_grad()
-def compute_outputs(model: nn.Module, dataloader: DataLoader, device: torch.device) -> torch.Tensor:
-    outputs = torch.tensor([], device=device)
+def compute_outputs(model: nn.Module, dataloader: DataLoader, device: torch.device, n_samples: int) -> np.ndarray:
+    outputs = np.empty(n_samples, dtype=np.float32)
+    start = 0
     for x, _ in tqdm.tqdm(dataloader):
-        y = model(x.to(device)).flatten()
-        outputs = torch.cat((outputs, y))
+        y = model(x.to(device)).flatten().cpu().numpy()
+        outputs[start:start + len(y)] = y
+        start += len(y)
+    assert start == n_samples
     return outputs
 
 
-def main(args):
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-
-    def transform(batch):
-        preprocessed_images = processor(images=batch, return_tensors="pt",
-                                        padding=True)["pixel_values"][0]  # type: ignore
-        return preprocessed_images
+def compute_shard(model: nn.Module, ds: ImageNet, shard_id: int, args) -> None:
+    """Computes and saves the outputs of a shard. The outputs are first written to a temporary file, so that a
+    shard file exists only if the shard is complete."""
+    shard_range = get_shard_range(shard_id, args.num_shards, len(ds))
+    dl = DataLoader(Subset(ds, shard_range), batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+    print(f"Computing shard {shard_id} ({len(shard_range)} images)")
+    outputs = compute_outputs(model, dl, torch.device(args.device), len(shard_range))
+    shard_path = get_shard_path(args.shards_dir, shard_id, args.num_shards)
+    tmp_shard_path = shard_path.with_suffix(f".{os.getpid()}.tmp")
+    with tmp_shard_path.open("wb") as f:
+        np.save(f, outputs)
+    os.replace(tmp_shard_path, shard_path)
 
-    ds = ImageNet(root=args.data_dir, split=args.split, transform=transform)
-    dl = DataLoader(ds, batch_size=args.batch_size, shuffle=False, num_workers=32)
 
-    device = torch.device(args.device)
-    model = CLIPNSFWDetector().to(device)
-    outputs = compute_outputs(model, dl, device).detach().cpu().numpy()
+def merge_shards(ds: ImageNet, args) -> None:
+    outputs = np.empty(len(ds), dtype=np.float32)
+    for shard_id in range(args.num_shards):
+        shard_range = get_shard_range(shard_id, args.num_shards, len(ds))
+        shard_outputs = np.load(get_shard_path(args.shards_dir, shard_id, args.num_shards))
+        assert len(shard_outputs) == len(shard_range)
+        outputs[shard_range.start:shard_range.stop] = shard_outputs
     sorted_indices = np.argsort(-outputs)  # - to sort in descending order
     sorted_outputs = outputs[sorted_indices]
     imgs = list(map(lambda x: (get_filename(x[0], args.data_dir, args.split), x[1]), ds.imgs))
     imgs = np.array(imgs)[sorted_indices].tolist()
     np.savez(args.output, outputs=sorted_outputs, imgs=imgs)
+    print(f"Saved the outputs of {len(outputs)} images to {args.output}")
+
+
+def main(args):
+    processor = load_image_processor("b32")
+
+    def transform(batch):
+        preprocessed_images = processor(images=batch, return_tensors="pt")["pixel_values"][0]  # type: ignore
+        return preprocessed_images
+
+    ds = ImageNet(root=args.data_dir, split=args.split, transform=transform)
+    if args.shards_dir is None:
+        args.shards_dir = args.output.parent / f"{args.output.stem}_shards"
+    args.shards_dir.mkdir(parents=True, exist_ok=True)
+
+    shard_ids = args.shard_ids if args.shard_ids is not None else range(args.num_shards)
+    # Completed shards are skipped, so that the script can be restarted
+    remaining_shard_ids = [
+        shard_id for shard_id in shard_ids if not get_shard_path(args.shards_dir, shard_id, args.num_shards).exists()
+    ]
+    print(f"{len(shard_ids) - len(remaining_shard_ids)} shards already computed, "
+          f"{len(remaining_shard_ids)} remaining")
+    if remaining_shard_ids:
+        device = torch.device(args.device)
+        model = CLIPNSFWDetector().to(device).eval()
+        for shard_id in remaining_shard_ids:
+            compute_shard(model, ds, shard_id, args)
+
+    missing_shard_ids = [
+        shard_id for shard_id in range(args.num_shards)
+        if not get_shard_path(args.shards_dir, shard_id, args.num_shards).exists()
+    ]
+    if missing_shard_ids:
+        print(f"Not merging the outputs, as {len(missing_shard_ids)} shards are still missing "
+              "(e.g., being computed on other machines)")
+        return
+    merge_shards(ds, args)
 
 
 if __name__ == "__main__":
@@ -55,6 +110,15 @@ if __name__ == "__main__":
     parser.add_argument("--split", type=str, required=True)
     parser.add_argument("--batch-size", type=int, default=2048)
     parser.add_argument("--output", type=Path, required=True)
-    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--num-shards", type=int, default=1)
+    # To split the computation across machines, give a different subset of the shards to each machine. The outputs
+    # are merged by the run which finds all the shards completed
+    parser.add_argument("--shard-ids", type=int, nargs="+", default=None)
+    parser.add_argument("--shards-dir",
+                        type=Path,
+                        default=None,
+                        help="Where the outputs of each shard are saved, defaults to `{output}_shards`")
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
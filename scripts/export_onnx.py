@@ -0,0 +1,28 @@
+import sys
+from pathlib import Path
+
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from src.model_wrappers.onnx_model import export_onnx_model
+from src.setup import DEFAULT_ONNX_CHECKPOINT_PATH, load_inner_model
+
+
+def main(args):
+    output = args.output or Path(DEFAULT_ONNX_CHECKPOINT_PATH.format(dataset=args.dataset))
+    model = load_inner_model(args.dataset, torch.device("cpu"))
+    export_onnx_model(model, output, args.input_size)
+    print(f"Exported {args.dataset} model to {output}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset",
+                        type=str,
+                        required=True,
+                        choices=["resnet_imagenet", "binary_imagenet", "imagenet_nsfw"])
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--input-size", type=int, default=224)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,193 @@
+import argparse
+import os
+import socket
+import sys
+import time
+import traceback
+from argparse import Namespace
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import torch
+from torch.utils import data
+
+sys.path.append(str(Path(__file__).parent.parent))
+from main import attack_sample, make_parser
+from src.attack_results import AttackResults, CurvesAggregator
+from src.attacks.base import BaseAttack
+from src.eligible_index import EligibleSampler
+from src.model_wrappers import ModelWrapper
+from src.model_wrappers.general_model import QueriesInterrupted
+from src.setup import setup_attack, setup_data, setup_model_and_data, setup_out_dir
+from src.work_queue import (DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS, DEFAULT_MAX_CLOCK_SKEW_SECONDS, WorkQueue,
+                            keep_lease)
+
+
+def coordinate(args: Namespace, queue_dir: Path, n_positions: int | None, max_attempts: int) -> None:
+    if args.batch != 1:
+        raise ValueError("The work queue can only be used with `--batch 1`")
+    n_positions = n_positions or args.num
+    test_loader = setup_data(args)
+    if isinstance(test_loader.sampler, EligibleSampler):
+        # Only the eligible samples are attacked, so exactly `args.num` of them are needed
+        positions = []
+        for _ in test_loader.sampler:
+            if len(positions) == n_positions:
+                break
+            positions.append(test_loader.sampler.current_position)
+    else:
+        positions = list(range(min(n_positions, len(test_loader.dataset))))  # type: ignore
+    WorkQueue.create(queue_dir, vars(args), positions, max_attempts)
+    print(f"Created a queue with {len(positions)} samples in {queue_dir}")
+
+
+def run_task(args: Namespace, model: ModelWrapper, attack: BaseAttack, sample: Any, position: int,
+             check_eligibility: bool, device: torch.device) -> dict[str, Any]:
+    batch = data.default_collate([sample])
+    if isinstance(batch, dict):
+        xi, yi = batch["image"], batch["label"]
+    else:
+        xi, yi = batch
+    xi, yi = xi.to(device), yi.to(device)
+    if check_eligibility and model.n_class == 2 and yi.item() == 0:
+        return {"outcome": "negative"}
+    if check_eligibility and model.predict_label(xi) != yi:
+        return {"outcome": "misclassified"}
+    adv, queries_counter, dist, succ, extra_results = attack_sample(args, model, attack, xi, yi, position, device)
+    result = {
+        "outcome": "attacked",
+        "queries_counter": queries_counter,
+        "distance": dist,
+        "success": succ,
+        "extra_results": extra_results,
+    }
+    if args.save_img_every is not None:
+        result |= {"adv": adv[0].cpu().numpy(), "x": xi[0].cpu().numpy()}
+    return result
+
+
+def work(queue: WorkQueue, worker: str, device_name: str | None, lease_seconds: float, poll_seconds: float) -> None:
+    args = Namespace(**queue.config)
+    if device_name is not None:
+        args.device = device_name
+    device = torch.device(args.device)
+    model, test_loader = setup_model_and_data(args, device)
+    attack = setup_attack(args)
+    # The tasks are positions in the order of the unfiltered samples, as in `main.py`
+    eligible_sampler = test_loader.sampler if isinstance(test_loader.sampler, EligibleSampler) else None
+    order = list(eligible_sampler.base_sampler if eligible_sampler is not None else test_loader.sampler)
+
+    while True:
+        position = queue.claim(worker, lease_seconds)
+        if position is None:
+            if queue.is_finished():
+                break
+            # Some tasks are running on other workers, and they are claimed again if their lease expires
+            time.sleep(poll_seconds)
+            continue
+        print(f"Worker {worker} running sample {position}")
+        with keep_lease(queue, position, worker, lease_seconds) as lease_lost:
+            # If the lease is lost, the sample is run again by another worker, so the attack stops at its next query
+            model.interrupt = lease_lost
+            try:
+                result = run_task(args, model, attack, test_loader.dataset[order[position]], position,
+                                  eligible_sampler is None, device)
+                if lease_lost.is_set():
+                    raise QueriesInterrupted
+                queue.save_result(position, result)
+            except QueriesInterrupted:
+                print(f"The lease of sample {position} was lost, it is run again")
+                continue
+            except Exception:
+                print(f"Sample {position} failed")
+                traceback.print_exc()
+                queue.fail(position, worker, traceback.format_exc())
+                continue
+            finally:
+                model.interrupt = None
+        if not queue.complete(position, worker):
+            print(f"The lease of sample {position} expired before it was completed, it is run again")
+    print(f"Worker {worker} finished: {queue.counts()}")
+
+
+def finalize(queue: WorkQueue) -> None:
+    if not queue.is_finished():
+        raise ValueError(f"The queue is not finished yet: {queue.counts()}")
+    failed_tasks = queue.failed_tasks()
+    if failed_tasks:
+        for position, error in failed_tasks.items():
+            print(f"Sample {position} failed with: {error}")
+        raise ValueError(f"{len(failed_tasks)} samples failed, the results would not match a run of `main.py`")
+    args = Namespace(**queue.config)
+    early_stopping = False if args.early == '0' else True
+    exp_out_dir = setup_out_dir(args)
+    curves_aggregator = CurvesAggregator(exp_out_dir) if args.live_curves == '1' else None
+    attack_results = AttackResults(exp_out_dir, curves_aggregator=curves_aggregator)
+
+    count = 0
+    for position in queue.done_tasks():
+        if count == args.num:
+            break
+        result = queue.load_result(position)
+        if result["outcome"] != "attacked":
+            print(f"Skipping sample {position} as item is {result['outcome']}")
+            continue
+        if args.save_img_every is not None and count % args.save_img_every == 0:
+            np.save(exp_out_dir / f"{position}_adv.npy", result["adv"])
+            np.save(exp_out_dir / f"{position}.npy", result["x"])
+        if result["success"] or not early_stopping:
+            attack_results = attack_results.update_with_success(result["distance"], result["queries_counter"],
+                                                                result["extra_results"])
+        else:
+            attack_results = attack_results.update_with_failure(result["distance"], result["queries_counter"],
+                                                                result["extra_results"])
+        attack_results.log_results(count)
+        attack_results.save_results(verbose=False)
+        count += 1
+
+    if count < args.num:
+        print(f"Only {count} samples out of {args.num} were attacked, more can be queued with `--n-positions`")
+    attack_results.save_results(verbose=True)
+    if curves_aggregator is not None:
+        curves_aggregator.close()
+
+
+if __name__ == "__main__":
+    # The coordinator takes the same arguments as `main.py`, which are stored in the queue and used by the workers and
+    # by the finalizer
+    parser = argparse.ArgumentParser(description="Runs the attack on a queue of samples shared by several workers")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    coordinator_parser = subparsers.add_parser("coordinator", help="Creates the queue with the samples to attack")
+    coordinator_parser.add_argument("--queue-dir", type=Path, required=True)
+    coordinator_parser.add_argument("--n-positions",
+                                    type=int,
+                                    default=None,
+                                    help="Number of samples to queue (by default, `--num`). Unless an eligible "
+                                    "samples index is used, some of them are skipped, so more than `--num` are needed")
+    coordinator_parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS)
+    worker_parser = subparsers.add_parser("worker", help="Runs the tasks of the queue until it is finished")
+    worker_parser.add_argument("--queue-dir", type=Path, required=True)
+    worker_parser.add_argument("--worker-id", type=str, default=f"{socket.gethostname()}-{os.getpid()}")
+    worker_parser.add_argument("--device", type=str, default=None, help="Overrides the device given to the queue")
+    worker_parser.add_argument("--lease-seconds", type=float, default=DEFAULT_LEASE_SECONDS)
+    worker_parser.add_argument("--poll-seconds", type=float, default=30.)
+    worker_parser.add_argument("--max-clock-skew-seconds",
+                               type=float,
+                               default=DEFAULT_MAX_CLOCK_SKEW_SECONDS,
+                               help="Margin after which the expired leases are claimed again. The clocks of the "
+                               "workers must be synchronized (e.g., with NTP) up to this margin")
+    finalizer_parser = subparsers.add_parser("finalize", help="Assembles the results as `main.py` saves them")
+    finalizer_parser.add_argument("--queue-dir", type=Path, required=True)
+    queue_args, main_args = parser.parse_known_args()
+    if queue_args.command == "coordinator":
+        coordinate(make_parser().parse_args(main_args), queue_args.queue_dir, queue_args.n_positions,
+                   queue_args.max_attempts)
+    else:
+        if main_args:
+            parser.error(f"unrecognized arguments: {' '.join(main_args)}")
+        if queue_args.command == "worker":
+            queue = WorkQueue(queue_args.queue_dir, max_clock_skew_seconds=queue_args.max_clock_skew_seconds)
+            work(queue, queue_args.worker_id, queue_args.device, queue_args.lease_seconds, queue_args.poll_seconds)
+        else:
+            finalize(WorkQueue(queue_args.queue_dir))
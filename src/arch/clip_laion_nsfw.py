@@ -1,11 +1,72 @@
+from pathlib import Path
+from typing import NamedTuple
+
 import torch
 from torch import nn
-from transformers import CLIPModel
+from transformers import CLIPModel, CLIPVisionConfig, CLIPVisionModel
+
+try:
+    from transformers import CLIPImageProcessor
+except ImportError:  # transformers < 4.26
+    from transformers import CLIPFeatureExtractor as CLIPImageProcessor
 
 BASE_CHECKPOINT_PATH = "{checkpoints_dir}/clip_autokeras_nsfw_{model}"
+MERGED_CHECKPOINT_PATH = "{checkpoints_dir}/clip_nsfw_detector_{model}.pth"
 PRETRAINED_URL_NAMES = {"b32": "base-patch32", "l14": "large-patch14"}
 
 
+class CLIPVisionOutput(NamedTuple):
+    image_embeds: torch.Tensor
+
+
+class _CLIPVisionModelWithProjection(nn.Module):
+    """Same as `transformers.CLIPVisionModelWithProjection`, with the same names of the weights, as it is only available
+    from transformers 4.25. The size of the projection is taken from `config.projection_dim`."""
+
+    def __init__(self, config: CLIPVisionConfig) -> None:
+        super().__init__()
+        self.config = config
+        vision_model = CLIPVisionModel(config)
+        # Before transformers 5, the vision transformer is wrapped in `CLIPVisionModel.vision_model`
+        self.vision_model = getattr(vision_model, "vision_model", vision_model)
+        self.visual_projection = nn.Linear(config.hidden_size, config.projection_dim, bias=False)
+
+    @classmethod
+    def from_pretrained(cls, name: str) -> "_CLIPVisionModelWithProjection":
+        # The projection is only in the checkpoint of the whole model, whose text tower is then discarded
+        clip_model = CLIPModel.from_pretrained(name)
+        config = clip_model.config.vision_config
+        config.projection_dim = clip_model.config.projection_dim
+        vision_model = cls(config)
+        vision_model.vision_model = clip_model.vision_model
+        vision_model.visual_projection = clip_model.visual_projection
+        return vision_model
+
+    def forward(self, pixel_values: torch.Tensor) -> CLIPVisionOutput:  # type: ignore
+        pooled_output = self.vision_model(pixel_values=pixel_values).pooler_output
+        return CLIPVisionOutput(self.visual_projection(pooled_output))
+
+
+try:
+    from transformers import CLIPVisionModelWithProjection
+except ImportError:  # transformers < 4.25
+    CLIPVisionModelWithProjection = _CLIPVisionModelWithProjection  # type: ignore
+
+
+def get_pretrained_name(model: str) -> str:
+    return f"openai/clip-vit-{PRETRAINED_URL_NAMES[model]}"
+
+
+def load_image_processor(model: str = "b32") -> CLIPImageProcessor:
+    """Loads only the image processor, and not the tokenizer as `CLIPProcessor` would."""
+    return CLIPImageProcessor.from_pretrained(get_pretrained_name(model))
+
+
+def _load_pretrained_vision_model(model: str) -> CLIPVisionModelWithProjection:
+    # The weights of the text tower in the checkpoint are not loaded
+    return CLIPVisionModelWithProjection.from_pretrained(get_pretrained_name(model))
+
+
 class PortedCLIPClassifier(nn.Module):
     DROPOUT_RATE = 0.5
     INNER_SIZE = 32
@@ -31,17 +92,30 @@ class PortedCLIPClassifier(nn.Module):
 
 
 class CLIPNSFWDetector(nn.Module):
+    """Only the vision tower of CLIP and its projection are loaded. The first time the detector is created, the
+    weights of CLIP and of the NSFW classifier are merged in a single checkpoint in `checkpoints_dir`, which is
+    loaded directly the following times."""
     INPUT_SIZE = 512
 
     def __init__(self, model: str = "b32", checkpoints_dir: str = "checkpoints"):
         super().__init__()
-        checkpoint_path = BASE_CHECKPOINT_PATH.format(checkpoints_dir=checkpoints_dir, model="torch.pth")
-        self.clip_embedder = CLIPModel.from_pretrained(f"openai/clip-vit-{PRETRAINED_URL_NAMES[model]}")
+        merged_checkpoint_path = Path(MERGED_CHECKPOINT_PATH.format(checkpoints_dir=checkpoints_dir, model=model))
         self.nsfw_model = PortedCLIPClassifier(self.INPUT_SIZE)
-        self.nsfw_model.load_state_dict(torch.load(checkpoint_path))
+        if merged_checkpoint_path.exists():
+            merged_checkpoint = torch.load(merged_checkpoint_path, map_location="cpu")
+            self.clip_embedder = CLIPVisionModelWithProjection(CLIPVisionConfig.from_dict(merged_checkpoint["config"]))
+            self.load_state_dict(merged_checkpoint["state_dict"])
+        else:
+            checkpoint_path = BASE_CHECKPOINT_PATH.format(checkpoints_dir=checkpoints_dir, model="torch.pth")
+            self.clip_embedder = _load_pretrained_vision_model(model)
+            self.nsfw_model.load_state_dict(torch.load(checkpoint_path, map_location="cpu"))
+            torch.save({
+                "config": self.clip_embedder.config.to_dict(),
+                "state_dict": self.state_dict()
+            }, merged_checkpoint_path)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:  # type: ignore
-        embeddings = self.clip_embedder.get_image_features(x)  # type: ignore
+        embeddings = self.clip_embedder(pixel_values=x).image_embeds
         normalized_embeddings = torch.nn.functional.normalize(embeddings, dim=1)
         y = self.nsfw_model(normalized_embeddings)
         return y
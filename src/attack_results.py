@@ -1,13 +1,65 @@
 import dataclasses
 import json
 from pathlib import Path
+from typing import Sequence
 
 import numpy as np
 
 from src.attacks.base import ExtraResultsDict, ExtraResultsDictContent
-from src.attacks.queries_counter import QueriesCounter
+from src.attacks.hsja import HSJAttackPhase
+from src.attacks.queries_counter import QueriesCounter, QueriesRun, TraceRecording
+from src.distance_arrays import (MAX_BAD_QUERIES_TRADEOFF_PLOT, MAX_UNSAFE_QUERIES, NpyRowsWriter,
+                                 complete_tradeoff_arrays, total_queries_at_bad_queries)
 from src.json_list import JSONList
 
+# Phases whose queries are not included in the curves of the distance after each query
+PHASES_EXCLUDED_FROM_CURVES = {HSJAttackPhase.gradient_estimation_search_start}
+
+CHANGE_POINTS_TRACES_FILENAME = "change_points_traces.json"
+
+
+def get_trace_curves(runs: Sequence[QueriesRun],
+                     change_points: Sequence[tuple[int, float]]) -> tuple[np.ndarray, np.ndarray]:
+    """Best distance after each bad query which is included in the curves, and the mask of the bad queries, of a
+    sample recorded as runs of queries and change points of the best distance."""
+    n_queries = np.array([run.n_queries for run in runs], dtype=np.int64)
+    unsafe_mask = np.repeat(np.array([not run.safe for run in runs], dtype=bool), n_queries)
+    included_mask = np.repeat(np.array([run.phase not in PHASES_EXCLUDED_FROM_CURVES for run in runs], dtype=bool),
+                              n_queries)
+    queries = np.flatnonzero(unsafe_mask & included_mask)
+    change_points_array = np.array(change_points, dtype=float).reshape(-1, 2)
+    change_point_idx = np.searchsorted(change_points_array[:, 0], queries, side="right") - 1
+    # The best distance is infinite until the first change point
+    best_distances = np.where(change_point_idx >= 0, change_points_array[change_point_idx.clip(0), 1], np.inf)
+    return best_distances, unsafe_mask
+
+
+class CurvesAggregator:
+    """Appends the curves of each sample to the arrays loaded by the plots, during the run: the best distance after each
+    bad query (`distances_array_unsafe_only.npy`) and the total number of queries at each bad query
+    (`tradeoff_array.npy`), in the same format as the ones that `plot_dist_vs_queries.py` makes from
+    `distances_traces.json`."""
+
+    def __init__(self, path: Path) -> None:
+        self._distances_writer = NpyRowsWriter(path / "distances_array_unsafe_only.npy", MAX_UNSAFE_QUERIES)
+        self._tradeoff_writer = NpyRowsWriter(path / "tradeoff_array.npy", MAX_BAD_QUERIES_TRADEOFF_PLOT, float)
+        self.n_samples = 0
+
+    def update(self, queries_counter: QueriesCounter) -> None:
+        best_distances, unsafe_mask = get_trace_curves(queries_counter.runs, queries_counter.change_points)
+        if len(best_distances):
+            self._distances_writer.append(best_distances)
+        for tradeoff_array in complete_tradeoff_arrays(
+                total_queries_at_bad_queries([unsafe_mask], MAX_BAD_QUERIES_TRADEOFF_PLOT)):
+            self._tradeoff_writer.append(tradeoff_array)
+        self._distances_writer.flush()
+        self._tradeoff_writer.flush()
+        self.n_samples += 1
+
+    def close(self) -> None:
+        self._distances_writer.close()
+        self._tradeoff_writer.close()
+
 
 @dataclasses.dataclass
 class AttackResults:
@@ -20,12 +72,17 @@ class AttackResults:
     failed_distances: list[float] = dataclasses.field(default_factory=list)
     failed_queries_counters: list[QueriesCounter] = dataclasses.field(default_factory=list)
     failed_extra_results: list[ExtraResultsDict] = dataclasses.field(default_factory=list)
+    curves_aggregator: CurvesAggregator | None = None
     _distances_traces_jsonlist: JSONList = dataclasses.field(init=False)
     _failed_distances_traces_jsonlist: JSONList = dataclasses.field(init=False)
+    _change_points_traces_jsonlist: JSONList = dataclasses.field(init=False)
+    _failed_change_points_traces_jsonlist: JSONList = dataclasses.field(init=False)
 
     def __post_init__(self):
         self._distances_traces_jsonlist = JSONList(self.path / "distances_traces.json")
         self._failed_distances_traces_jsonlist = JSONList(self.path / "failed_distances_traces.json")
+        self._change_points_traces_jsonlist = JSONList(self.path / CHANGE_POINTS_TRACES_FILENAME)
+        self._failed_change_points_traces_jsonlist = JSONList(self.path / f"failed_{CHANGE_POINTS_TRACES_FILENAME}")
 
     def update_with_success(self, distance: float, queries_counter: QueriesCounter,
                             extra_results: ExtraResultsDict) -> "AttackResults":
@@ -56,8 +113,8 @@ class AttackResults:
     def simulated_self(self) -> "AttackResults":
         if not self.has_simulated_counters:
             raise ValueError("No simulated counters to expand")
-        simulated_queries_counters = map(lambda c: c.expand_simulated_distances(), self.queries_counters)
-        simulated_failed_queries_counters = map(lambda c: c.expand_simulated_distances(), self.failed_queries_counters)
+        simulated_queries_counters = map(lambda c: c.simulated_counter(), self.queries_counters)
+        simulated_failed_queries_counters = map(lambda c: c.simulated_counter(), self.failed_queries_counters)
         return dataclasses.replace(self,
                                    queries_counters=list(simulated_queries_counters),
                                    failed_queries_counters=list(simulated_failed_queries_counters))
@@ -109,12 +166,21 @@ class AttackResults:
         np.save(self.path / "unsafe_queries.npy", np.array(self._get_overall_unsafe_queries()))
         np.save(self.path / "failed_distances.npy", np.array(self.failed_distances))
         np.save(self.path / "failed_queries.npy", np.array(self._get_overall_failed_queries()))
+        if self.curves_aggregator is not None:
+            for queries_counter in self.queries_counters[self.curves_aggregator.n_samples:]:
+                self.curves_aggregator.update(queries_counter)
         if self.queries_counters:
-            self._distances_traces_jsonlist.append(
-                list(map(lambda distance_info: distance_info.__dict__, self.queries_counters[-1].distances)))
+            queries_counter = self.queries_counters[-1]
+            if queries_counter.recording == TraceRecording.full:
+                self._distances_traces_jsonlist.append(queries_counter.to_trace())
+            else:
+                self._change_points_traces_jsonlist.append(queries_counter.to_trace())
         if self.failed_queries_counters:
-            self._failed_distances_traces_jsonlist.append(
-                list(map(lambda distance_info: distance_info.__dict__, self.failed_queries_counters[-1].distances)))
+            queries_counter = self.failed_queries_counters[-1]
+            if queries_counter.recording == TraceRecording.full:
+                self._failed_distances_traces_jsonlist.append(queries_counter.to_trace())
+            else:
+                self._failed_change_points_traces_jsonlist.append(queries_counter.to_trace())
         if verbose:
             print(f"Saved results to {self.path}")
 
@@ -1,9 +1,30 @@
-from .boundary_attack import BoundaryAttack
-from .hsja import HSJA
-from .opt import OPT
-from .queries_counter import QueriesCounter
-from .rays import RayS
-from .sign_opt import SignOPT
-from .geoda import GeoDA
-
-__all__ = ["BoundaryAttack", "RayS", "HSJA", "OPT", "SignOPT", "QueriesCounter", "GeoDA"]
\ No newline at end of file
+import importlib
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from .boundary_attack import BoundaryAttack
+    from .geoda import GeoDA
+    from .hsja import HSJA
+    from .opt import OPT
+    from .queries_counter import QueriesCounter
+    from .rays import RayS
+    from .sign_opt import SignOPT
+
+# The attacks are imported only when they are used, as some of them import heavy libraries
+_MODULES = {
+    "BoundaryAttack": ".boundary_attack",
+    "RayS": ".rays",
+    "HSJA": ".hsja",
+    "OPT": ".opt",
+    "SignOPT": ".sign_opt",
+    "QueriesCounter": ".queries_counter",
+    "GeoDA": ".geoda",
+}
+
+__all__ = ["BoundaryAttack", "RayS", "HSJA", "OPT", "SignOPT", "QueriesCounter", "GeoDA"]
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_MODULES[name], __name__), name)
@@ -1,11 +1,13 @@
 import abc
 from enum import Enum
-from typing import NamedTuple
+from typing import Hashable, NamedTuple
 
+import numpy as np
 import torch
-from foolbox.distances import LpDistance
 
-from src.attacks.queries_counter import AttackPhase, QueriesCounter
+from src.attacks.queries_counter import AttackPhase, QueriesCounter, TraceRecording
+from src.distances import LpDistance
+from src.image_utils import Codec, to_uint8
 from src.model_wrappers import ModelWrapper
 
 
@@ -14,9 +16,56 @@ class Bounds(NamedTuple):
     upper: float = 1.
 
 
+class SampleRNGs(NamedTuple):
+    torch_generator: torch.Generator
+    numpy_generator: np.random.Generator
+
+
+def make_sample_rngs(run_seed: int, sample_index: int, device: torch.device | str = "cpu") -> SampleRNGs:
+    """Random number generators used to attack a sample. They only depend on the seed of the run and on the index of
+    the sample, so that each sample gives the same results regardless of which other samples are attacked before it,
+    and in which process."""
+    torch_seed_sequence, numpy_seed_sequence = np.random.SeedSequence([run_seed, sample_index]).spawn(2)
+    torch_seed = int(torch_seed_sequence.generate_state(1, dtype=np.uint64)[0])
+    return SampleRNGs(torch.Generator(device=device).manual_seed(torch_seed),
+                      np.random.default_rng(numpy_seed_sequence))
+
+
 ExtraResultsDictContent = float | int | list[float] | list[int]
 ExtraResultsDict = dict[str, ExtraResultsDictContent]
 
+DEFAULT_INITIAL_BATCH_SIZE = 8
+
+
+class AdaptiveBatchSize:
+    """Sizes of the batches of the batched line searches. Only the queries up to the first unsafe one of each batch
+    are counted, so the rest of the batch is wasted compute. Hence, the first batch of a search is as large as the
+    number of queries the previous search with the same key needed to hit the boundary, and the following batches
+    grow geometrically as long as all their queries are safe, up to the maximum batch size of the search.
+
+    If disabled, all the batches have the maximum size. The queries which are counted are the same in both cases."""
+
+    def __init__(self, enabled: bool = True, growth_factor: int = 2,
+                 initial_batch_size: int = DEFAULT_INITIAL_BATCH_SIZE):
+        self.enabled = enabled
+        self.growth_factor = growth_factor
+        self.initial_batch_size = initial_batch_size
+        self._last_n_queries: dict[Hashable, int] = {}
+
+    def first(self, key: Hashable, max_batch_size: int) -> int:
+        if not self.enabled:
+            return max_batch_size
+        return max(min(self._last_n_queries.get(key, self.initial_batch_size), max_batch_size), 1)
+
+    def next(self, batch_size: int, max_batch_size: int) -> int:
+        if not self.enabled:
+            return max_batch_size
+        return min(batch_size * self.growth_factor, max_batch_size)
+
+    def update(self, key: Hashable, n_queries: int) -> None:
+        """Records the number of queries (up to and including the first unsafe one) made by a search."""
+        self._last_n_queries[key] = n_queries
+
 
 class BaseAttack(abc.ABC):
 
@@ -28,9 +77,26 @@ class BaseAttack(abc.ABC):
         self.distance = distance
         self.queries_limit = queries_limit
         self.unsafe_queries_limit = unsafe_queries_limit
+        # Applied to the queries of discrete attacks, the default (lossless) codec rounds them to uint8
+        self.codec = Codec()
+        # Whether the queries of discrete attacks are given to the model as uint8, which is dequantized by the model
+        self.uint8_queries = False
+        # Maximum number of bad queries of each eggs dropping search, and how much more a bad query costs than a good
+        # one
+        self.max_eggs = 2
+        self.bad_query_cost_ratio = 1.
+        self.line_search_batch_sizes = AdaptiveBatchSize()
+        self.trace_recording = TraceRecording.full
+        # Random number generators of the sample being attacked (see `make_sample_rngs`), the global ones are used if
+        # they are None
+        self.generator: torch.Generator | None = None
+        self.numpy_generator: np.random.Generator | None = None
+
+    def set_sample_rngs(self, rngs: SampleRNGs) -> None:
+        self.generator, self.numpy_generator = rngs
 
     def _make_queries_counter(self) -> QueriesCounter:
-        return QueriesCounter(self.queries_limit, self.unsafe_queries_limit)
+        return QueriesCounter(self.queries_limit, self.unsafe_queries_limit, self.trace_recording)
 
     def is_correct_boundary_side(self, model: ModelWrapper, x_adv: torch.Tensor, y: torch.Tensor,
                                  target: torch.Tensor | None, queries_counter: QueriesCounter,
@@ -40,10 +106,11 @@ class BaseAttack(abc.ABC):
             x_adv = x_adv.unsqueeze(0)
         if len(original_x.size()) != 4:
             original_x = original_x.unsqueeze(0)
+        query = to_uint8(x_adv) if self.discrete and self.uint8_queries else x_adv
         if target is not None:
-            success = model.predict_label(x_adv) == target
+            success = model.predict_label(query) == target
         else:
-            success = model.predict_label(x_adv) != y
+            success = model.predict_label(query) != y
         distance = self.distance(original_x, x_adv)
         return success, queries_counter.increase(attack_phase,
                                                  safe=success,
@@ -107,11 +174,8 @@ class BaseAttack(abc.ABC):
 
     def clamp_and_discretize(self, out: torch.Tensor) -> torch.Tensor:
         out = torch.clamp(out, self.bounds.lower, self.bounds.upper)
-        #if self.discrete:
-        #    assert torch.allclose(out, torch.round(out * 255) / 255)  # type: ignore
-        #    decoded_out = encode_decode(out)
-        #    assert torch.allclose(out, decoded_out, atol=1 / 256)
-        #    out = decoded_out
+        if self.discrete:
+            out = self.codec(out)
         return out
 
     @abc.abstractmethod
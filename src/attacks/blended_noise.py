@@ -6,11 +6,11 @@ from typing import Callable
 import eagerpy as ep
 import numpy as np
 import torch
-from foolbox.distances import LpDistance
 
 from src.attacks.base import Bounds, ExtraResultsDict, PerturbationAttack
 from src.attacks.queries_counter import AttackPhase, QueriesCounter
 from src.attacks.utils import atleast_kd
+from src.distances import LpDistance
 from src.model_wrappers import ModelWrapper
 
 
@@ -66,7 +66,7 @@ class LinearSearchBlendedUniformNoiseAttack(PerturbationAttack):
             # random noise inputs tend to be classified into the same class,
             # so we might need to make very many draws if the original class
             # is that one
-            random_ = ep.uniform(x_ep, x_ep.shape, min_, max_)
+            random_ = ep.astensor(torch.empty(x.shape, device=x.device).uniform_(min_, max_, generator=self.generator))
             success, queries_counter = is_adversarial(random_, queries_counter)
             is_adv_ = atleast_kd(ep.astensor(success), x_ep.ndim)
 
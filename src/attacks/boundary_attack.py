@@ -5,12 +5,12 @@ from typing import Callable
 import eagerpy as ep
 import numpy as np
 import torch
-from foolbox.distances import LpDistance, l2
 
 from src.attacks.base import Bounds, ExtraResultsDict, PerturbationAttack
 from src.attacks.blended_noise import LinearSearchBlendedUniformNoiseAttack
 from src.attacks.queries_counter import AttackPhase, QueriesCounter
 from src.attacks.utils import atleast_kd, flatten
+from src.distances import LpDistance, l2
 from src.model_wrappers import ModelWrapper
 
 
@@ -65,6 +65,7 @@ class BoundaryAttack(PerturbationAttack):
                                                             None,
                                                             BoundaryAttackPhase.initialization,
                                                             steps=50)
+        init_attack.generator = self.generator
         best_advs_torch, queries_counter, _, _, _ = init_attack(model, x, label)
         best_advs = ep.astensor(best_advs_torch)
         is_adv_torch, queries_counter = is_adversarial(best_advs, queries_counter, BoundaryAttackPhase.initialization)
@@ -112,6 +113,7 @@ class BoundaryAttack(PerturbationAttack):
                 source_norms,
                 spherical_steps,
                 source_steps,
+                self.generator,
             )
 
             is_adv_torch, queries_counter = is_adversarial(candidates, queries_counter,
@@ -221,6 +223,7 @@ def draw_proposals(
     source_norms: ep.Tensor,
     spherical_steps: ep.Tensor,
     source_steps: ep.Tensor,
+    generator: torch.Generator | None = None,
 ) -> tuple[ep.Tensor, ep.Tensor]:
     # remember the actual shape
     shape = originals.shape
@@ -240,7 +243,8 @@ def draw_proposals(
     assert source_steps.shape == (n_samples, )
 
     # draw from an iid Gaussian (we can share this across the whole batch)
-    eta = ep.normal(perturbed, (dim, 1))
+    eta = ep.astensor(
+        torch.randn((dim, 1), generator=generator, dtype=perturbed.raw.dtype, device=perturbed.raw.device))
 
     # make orthogonal (source_directions are normalized)
     eta = eta.T - ep.matmul(source_directions, eta) * source_directions
@@ -3,12 +3,13 @@ import itertools
 import math
 
 import torch
-from foolbox.distances import LpDistance, l2, linf
 
 from src.attacks.base import Bounds, ExtraResultsDict, PerturbationAttack, SearchMode
 from src.attacks.opt import normalize
 from src.attacks.queries_counter import AttackPhase, QueriesCounter
-from src.attacks.utils import opt_binary_search, opt_line_search
+from src.attacks.utils import (eggs_dropping_line_search, nth_root, opt_binary_search, opt_eggs_dropping_search,
+                              opt_line_search)
+from src.distances import LpDistance, l2, linf
 from src.model_wrappers import ModelWrapper
 from src.utils import compute_distance
 
@@ -73,6 +74,8 @@ class HSJA(PerturbationAttack):
         self.max_opt_search_steps = max_opt_search_steps
         self.search = search
         self.n_searches = n_searches
+        if self.n_searches < 1:
+            raise ValueError("At least 1 search must be done in HSJA.")
         self.bias_coef = bias_coef
         self.lower_bad_query_bound = lower_bad_query_bound
         self.upper_bad_query_bound = upper_bad_query_bound
@@ -295,9 +298,10 @@ class HSJA(PerturbationAttack):
         # Generate random vectors.
         noise_shape = [num_evals] + list(params['shape'])
         if params['distance'] == l2:
-            rv = torch.randn(*noise_shape, device=sample.device)
+            rv = torch.randn(*noise_shape, generator=self.generator, device=sample.device)
         elif params['distance'] == linf:
-            rv = torch.empty(*noise_shape, device=sample.device).uniform_(-1, 1)  # type: ignore
+            rv = torch.empty(*noise_shape, device=sample.device).uniform_(-1, 1,
+                                                                          generator=self.generator)  # type: ignore
         else:
             raise ValueError(f'Unknown constraint {params["constraint"]}.')
 
@@ -358,7 +362,7 @@ class HSJA(PerturbationAttack):
         opt_queries = 10
         num_evals = max(num_evals // sign_opt_queries, 1) * opt_queries
 
-        u = torch.randn((num_evals, ) + x.shape, device=x.device, dtype=x.dtype)
+        u = torch.randn((num_evals, ) + x.shape, generator=self.generator, device=x.device, dtype=x.dtype)
         u, _ = normalize(u, batch=True)
         new_thetas = theta + delta * u
         new_thetas, _ = normalize(new_thetas, batch=True)
@@ -375,6 +379,11 @@ class HSJA(PerturbationAttack):
                                                              params['target_label'], new_thetas[j], queries_counter,
                                                              initial_lbd.item(), HSJAttackPhase.gradient_estimation,
                                                              params['theta'])
+            elif self.search == SearchMode.eggs_dropping:
+                g1, queries_counter = self.opt_eggs_dropping_search(model, x, params['original_label'],
+                                                                    params['target_label'], new_thetas[j],
+                                                                    queries_counter, initial_lbd.item(),
+                                                                    HSJAttackPhase.gradient_estimation)
             else:
                 g1, queries_counter = self.opt_line_search(model, x, params['original_label'],
                                                            params['target_label'], new_thetas[j], queries_counter,
@@ -408,7 +417,7 @@ class HSJA(PerturbationAttack):
         x = x.unsqueeze(0)
         delta /= initial_lbd
 
-        u = torch.randn((num_evals, ) + theta.shape, dtype=theta.dtype, device=x.device)
+        u = torch.randn((num_evals, ) + theta.shape, generator=self.generator, dtype=theta.dtype, device=x.device)
         u, _ = normalize(u, batch=True)
 
         sign_v = torch.ones((num_evals, 1, 1, 1), device=x.device)
@@ -464,6 +473,16 @@ class HSJA(PerturbationAttack):
                                                     self.GRAD_EST_SEARCH_LOWER_BOUND, self.GRAD_EST_SEARCH_UPPER_BOUND)
         return distance, queries_counter
 
+    def opt_eggs_dropping_search(self, model: ModelWrapper, x: torch.Tensor, y: torch.Tensor,
+                                 target: torch.Tensor | None, theta: torch.Tensor, queries_counter: QueriesCounter,
+                                 initial_lbd: float, phase: HSJAttackPhase) -> tuple[float, QueriesCounter]:
+        distance, queries_counter = opt_eggs_dropping_search(self, model, x, y, target, theta, queries_counter,
+                                                             initial_lbd, phase, HSJAttackPhase.direction_probing,
+                                                             None, self.max_opt_search_steps,
+                                                             self.GRAD_EST_SEARCH_LOWER_BOUND,
+                                                             self.GRAD_EST_SEARCH_UPPER_BOUND)
+        return distance, queries_counter
+
     def binary_search_batch(
             self,
             original_image: torch.Tensor,
@@ -546,53 +565,61 @@ class HSJA(PerturbationAttack):
             dists = torch.ones_like(dists_post_update)
             step_size = params['theta'] / 2
 
-        if self.n_searches == 2:
-            search_max_steps = math.ceil(math.sqrt(dists_post_update / step_size))
-            first_search_step_size = (dists_post_update / math.sqrt(dists_post_update / step_size)).cpu().item()
+        if self.search == SearchMode.eggs_dropping:
+            final_distance, search_queries_counter = self._eggs_dropping_search_body(
+                model, original_image, params['original_label'], params['target_label'], perturbed_images, params,
+                queries_counter, dists[0], phase, step_size.item(), math.ceil((dists_post_update / step_size).item()))
         else:
-            search_max_steps = math.ceil((dists_post_update / step_size).item())
-            first_search_step_size = step_size.item()
+            if self.n_searches == 1:
+                search_max_steps = math.ceil((dists_post_update / step_size).item())
+                first_search_step_size = step_size.item()
+            else:
+                # With n searches, each search does (up to) the n-th root of the steps of a single search, and each
+                # search refines the step size of the previous one by that factor
+                steps_root = nth_root((dists_post_update / step_size).item(), self.n_searches)
+                search_max_steps = math.ceil(steps_root)
+                first_search_step_size = (dists_post_update / steps_root).cpu().item()
 
-        search_batch_size = min(search_max_steps, self.grad_batch_size)
+            search_batch_size = min(search_max_steps, self.grad_batch_size)
 
-        first_search_distance, first_search_queries_counter = self._batched_line_search_body(
-            model,
-            original_image,
-            params['original_label'],
-            params['target_label'],
-            perturbed_images,
-            params,
-            queries_counter,
-            dists[0],
-            phase,
-            first_search_step_size,
-            search_batch_size,
-            # Here we count each query of the first search as equivalent to search_max_steps queries of when we do 1
-            equivalent_simulated_queries=1 if self.n_searches == 1 else search_max_steps,
-            # But we don't count the queries from the last batch as they will be counted in the second search
-            count_last_batch_for_sim=self.n_searches == 1)
-
-        if self.n_searches == 2:
-            second_search_step_size = step_size.item()
-            final_distance, second_search_queries_counter = self._batched_line_search_body(
+            final_distance, search_queries_counter = self._batched_line_search_body(
                 model,
                 original_image,
                 params['original_label'],
                 params['target_label'],
                 perturbed_images,
                 params,
-                first_search_queries_counter,
-                first_search_distance,
+                queries_counter,
+                dists[0],
                 phase,
-                second_search_step_size,
+                first_search_step_size,
                 search_batch_size,
-                # Here each query has the same step size as if we were doing one search only
-                equivalent_simulated_queries=1,
-                # And we count the queries from the last batch as they are not counted in the first search
-                count_last_batch_for_sim=True)
-        else:
-            second_search_queries_counter = first_search_queries_counter
-            final_distance = first_search_distance
+                # Here we count each query of the first search as equivalent to the search_max_steps queries of each of
+                # the following searches
+                equivalent_simulated_queries=search_max_steps**(self.n_searches - 1),
+                # But we don't count the queries from the last batch as they will be counted in the next search
+                count_last_batch_for_sim=self.n_searches == 1)
+
+            for search_idx in range(1, self.n_searches):
+                # The last search has the step size of a single search
+                search_step_size = step_size.item() * steps_root**(self.n_searches - 1 - search_idx)
+                final_distance, search_queries_counter = self._batched_line_search_body(
+                    model,
+                    original_image,
+                    params['original_label'],
+                    params['target_label'],
+                    perturbed_images,
+                    params,
+                    search_queries_counter,
+                    final_distance,
+                    phase,
+                    search_step_size,
+                    search_batch_size,
+                    # Here each query is equivalent to the queries of the following searches, and each query of the last
+                    # search has the same step size as if we were doing one search only
+                    equivalent_simulated_queries=search_max_steps**(self.n_searches - 1 - search_idx),
+                    # And we count the queries from the last batch only in the last search
+                    count_last_batch_for_sim=search_idx == self.n_searches - 1)
 
         out_images = self.project(original_image, perturbed_images, final_distance.unsqueeze(0), params)
 
@@ -604,7 +631,23 @@ class HSJA(PerturbationAttack):
         dist = dists_post_update[idx].item()
         out_image = out_images[idx]
 
-        return out_image, dist, second_search_queries_counter
+        return out_image, dist, search_queries_counter
+
+    def _eggs_dropping_search_body(self, model: ModelWrapper, x: torch.Tensor, y: torch.Tensor,
+                                   target: torch.Tensor | None, perturbed_images: torch.Tensor, params,
+                                   queries_counter: QueriesCounter, initial_distance: torch.Tensor,
+                                   phase: HSJAttackPhase, step_size: float,
+                                   n_steps: int) -> tuple[torch.Tensor, QueriesCounter]:
+
+        def is_safe(distance: float, q_counter: QueriesCounter) -> tuple[bool, QueriesCounter]:
+            image = self.project(x, perturbed_images, torch.tensor([distance], device=x.device), params)
+            success, q_counter = self.decision_function(model, image, params, q_counter, phase, x)
+            return bool(success.all().item()), q_counter
+
+        distance, queries_counter, _ = eggs_dropping_line_search(is_safe, queries_counter, initial_distance.item(),
+                                                                 step_size, n_steps - 1, self.max_eggs,
+                                                                 self.bad_query_cost_ratio)
+        return torch.tensor(distance, device=initial_distance.device), queries_counter
 
     def _batched_line_search_body(self,
                                   model: ModelWrapper,
@@ -625,15 +668,20 @@ class HSJA(PerturbationAttack):
         distances_inner_shape = tuple([1] * (len(x.shape) - 1))
         previous_last_distance = torch.tensor([initial_distance], device=initial_distance.device)
         distances = torch.tensor([initial_distance], device=initial_distance.device)
+        # The equivalent simulated queries identify the search
+        batch_sizes_key = (phase, equivalent_simulated_queries)
+        # The first batch starts from 1, so, as before, it has one query less than the following ones
+        current_batch_size = self.line_search_batch_sizes.first(batch_sizes_key, batch_size - 1)
+        end = 1
 
         while success.all():
             # Update the last distance (in case the whole next batch is unsafe) and the index
             previous_last_distance = distances[-1]
-            # Get steps bounds based on the batch index
-            start = batch_idx * batch_size
-            if batch_idx == 0:
-                start = 1
-            end = (batch_idx + 1) * batch_size
+            # Get steps bounds based on the previous batch
+            if batch_idx > 0:
+                current_batch_size = self.line_search_batch_sizes.next(current_batch_size, batch_size)
+            start = end
+            end = start + current_batch_size
             # Compute the steps to take
             steps_sizes = torch.arange(start, end, device=x.device) * step_size
             # Subtract the steps from the original distance
@@ -648,6 +696,7 @@ class HSJA(PerturbationAttack):
 
         # We get the index of the first unsafe query
         unsafe_query_idx = torch.argmin(success.to(torch.int))
+        self.line_search_batch_sizes.update(batch_sizes_key, start - 1 + int(unsafe_query_idx.item()) + 1)
         if unsafe_query_idx == 0:
             # If no query was safe in the latest batch, then we return the last lbd from the previous batch
             distance = previous_last_distance
@@ -679,7 +728,8 @@ class HSJA(PerturbationAttack):
             while True:
                 random_noise = torch.empty(*params['shape'],
                                            device=sample.device).uniform_(params['clip_min'],
-                                                                          params['clip_max'])  # type: ignore
+                                                                          params['clip_max'],
+                                                                          generator=self.generator)  # type: ignore
                 success_array, queries_counter = self.decision_function(model, random_noise[None], params,
                                                                         queries_counter, HSJAttackPhase.initialization,
                                                                         sample)
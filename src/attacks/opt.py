@@ -2,11 +2,11 @@ import itertools
 from typing import Callable
 
 import torch
-from foolbox.distances import LpDistance
 
 from src.attacks.base import Bounds, DirectionAttack, ExtraResultsDict, SearchMode
 from src.attacks.queries_counter import AttackPhase, QueriesCounter
-from src.attacks.utils import opt_line_search, opt_binary_search
+from src.attacks.utils import opt_binary_search, opt_eggs_dropping_search, opt_line_search
+from src.distances import LpDistance
 from src.model_wrappers import ModelWrapper
 
 
@@ -68,10 +68,8 @@ class OPT(DirectionAttack):
         self.batch_size = batch_size if batch_size is not None else MAX_BATCH_SIZE
         self.num_grad_queries = num_grad_queries
 
-        if SearchMode.eggs_dropping in {search, grad_estimation_search, step_size_search}:
-            raise ValueError("eggs dropping search not available for OPT and SignOPT")
-        if self.n_searches not in {1, 2}:
-            raise ValueError("Only 1 or 2 searches can be done in OPT.")
+        if self.n_searches < 1:
+            raise ValueError("At least 1 search must be done in OPT.")
 
         self.fine_grained_search: FineGrainedSearchFn
         self.grad_estimation_search_fn: GradientEstimationSearchFn
@@ -82,6 +80,10 @@ class OPT(DirectionAttack):
             self.fine_grained_search = (
                 lambda model, x, y, target, theta, queries_counter, initial_lbd, current_best: self.line_search(
                     model, x, y, target, theta, queries_counter, initial_lbd, OPTAttackPhase.search, current_best))
+        elif search == SearchMode.eggs_dropping:
+            self.fine_grained_search = (lambda model, x, y, target, theta, queries_counter, initial_lbd, current_best:
+                                        self.eggs_dropping_search(model, x, y, target, theta, queries_counter,
+                                                                  initial_lbd, OPTAttackPhase.search, current_best))
 
         if grad_estimation_search == SearchMode.binary:
             self.grad_estimation_search_fn = (
@@ -93,6 +95,11 @@ class OPT(DirectionAttack):
                 lambda model, x, y, target, theta, queries_counter, initial_lbd, tol, lower_b, upper_b: self.
                 line_search(model, x, y, target, theta, queries_counter, initial_lbd, OPTAttackPhase.
                             gradient_estimation, None, lower_b, upper_b, tol))
+        elif grad_estimation_search == SearchMode.eggs_dropping:
+            self.grad_estimation_search_fn = (
+                lambda model, x, y, target, theta, queries_counter, initial_lbd, tol, lower_b, upper_b: self.
+                eggs_dropping_search(model, x, y, target, theta, queries_counter, initial_lbd, OPTAttackPhase.
+                                     gradient_estimation, None, lower_b, upper_b, tol))
 
         if step_size_search == SearchMode.binary:
             self.step_size_search_search_fn = (
@@ -100,6 +107,11 @@ class OPT(DirectionAttack):
                 queries_counter, initial_lbd, tol, _lower_b: self.fine_grained_binary_search_local(
                     model, x, y, target, theta, queries_counter, initial_lbd, OPTAttackPhase.step_size_search,
                     OPTAttackPhase.step_size_search_start, tol))
+        elif step_size_search == SearchMode.eggs_dropping:
+            self.step_size_search_search_fn = (
+                lambda model, x, y, target, theta, queries_counter, initial_lbd, tol, lower_b: self.
+                eggs_dropping_search(model, x, y, target, theta, queries_counter, initial_lbd, OPTAttackPhase.
+                                     step_size_search, None, lower_b, None, tol))
         else:
             self.step_size_search_search_fn = (
                 lambda model, x, y, target, theta, queries_counter, initial_lbd, tol, lower_b: self.line_search(
@@ -124,7 +136,7 @@ class OPT(DirectionAttack):
         print(f"Searching for the initial direction on {self.num_directions} random directions")
 
         for i in range(self.num_directions):
-            theta = torch.randn_like(x)
+            theta = torch.randn(x.shape, generator=self.generator, dtype=x.dtype, device=x.device)
             success, queries_counter = self.is_correct_boundary_side(model, x + theta, y, None, queries_counter,
                                                                      OPTAttackPhase.direction_search, x)
             if success.item():
@@ -143,7 +155,7 @@ class OPT(DirectionAttack):
             self.log(f"Searching for the initial direction on {self.num_directions} random directions")
 
             for i in range(self.num_directions):
-                theta = torch.randn_like(x)
+                theta = torch.randn(x.shape, generator=self.generator, dtype=x.dtype, device=x.device)
                 success, queries_counter = self.is_correct_boundary_side(model, x + theta, y, None, queries_counter,
                                                                          OPTAttackPhase.direction_search, x)
                 if success.item():
@@ -175,7 +187,7 @@ class OPT(DirectionAttack):
             q = self.num_grad_queries
             min_g1 = float("inf")
             gradient = torch.zeros_like(theta)
-            u = torch.randn((q, ) + theta.shape, device=theta.device)
+            u = torch.randn((q, ) + theta.shape, generator=self.generator, device=theta.device)
             u, _ = normalize(u, batch=True)
             ttt = theta.unsqueeze(0) + beta * u
             ttt, _ = normalize(ttt, batch=True)
@@ -332,6 +344,24 @@ class OPT(DirectionAttack):
                                                     upper_b)
         return distance, queries_counter, None
 
+    def eggs_dropping_search(self,
+                             model: ModelWrapper,
+                             x: torch.Tensor,
+                             y: torch.Tensor,
+                             target: torch.Tensor | None,
+                             theta: torch.Tensor,
+                             queries_counter: QueriesCounter,
+                             initial_lbd: float,
+                             phase: OPTAttackPhase,
+                             current_best: float | None,
+                             lower_b: float | None = None,
+                             upper_b: float | None = None,
+                             tol: float = DEFAULT_LINE_SEARCH_TOL) -> tuple[float, QueriesCounter, None]:
+        distance, queries_counter = opt_eggs_dropping_search(self, model, x, y, target, theta, queries_counter,
+                                                             initial_lbd, phase, OPTAttackPhase.direction_probing,
+                                                             current_best, self.max_search_steps, lower_b, upper_b)
+        return distance, queries_counter, None
+
 
 def normalize(x: torch.Tensor, batch: bool = False) -> tuple[torch.Tensor, torch.Tensor]:
     """Normalize x in-place
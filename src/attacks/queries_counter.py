@@ -1,7 +1,8 @@
 import dataclasses
-from collections import Counter, defaultdict
+import itertools
+from collections import defaultdict
 from enum import Enum
-from typing import Callable, Generic, Iterable, TypeVar
+from typing import Any, Callable, Generic, Iterable, TypeVar
 
 import numpy as np
 import torch
@@ -19,6 +20,14 @@ class QueryType(str, Enum):
     unsafe = "unsafe"
 
 
+class TraceRecording(str, Enum):
+    """How the queries are recorded: `full` keeps a `CurrentDistanceInfo` for each query, while `change_points` keeps
+    them only for the current phase, and only the runs of queries with the same phase and outcome, and the queries
+    which improve the best distance, for the previous phases."""
+    full = "full"
+    change_points = "change_points"
+
+
 def increase_dict(d: dict[K, int], k: K, n: int) -> dict[K, int]:
     return update_dict(d, k, d[k] + n)
 
@@ -47,6 +56,122 @@ class CurrentDistanceInfo:
                 and self.equivalent_simulated_queries == __o.equivalent_simulated_queries)
 
 
+@dataclasses.dataclass
+class RunLengthDistances:
+    """Simulated view of a list of `CurrentDistanceInfo`s, where each of them stands for as many queries as its
+    `equivalent_simulated_queries` (the length of its run). The records are stored as columns, and the queries are
+    looked up with binary searches over the cumulative run lengths, so the runs never need to be expanded."""
+    phases: list[AttackPhase]
+    safe: np.ndarray
+    distances: np.ndarray
+    best_distances: np.ndarray
+    run_lengths: np.ndarray
+
+    @classmethod
+    def from_distance_infos(cls, distance_infos: Iterable[CurrentDistanceInfo]) -> "RunLengthDistances":
+        distance_infos = list(distance_infos)
+        return cls([info.phase for info in distance_infos],
+                   np.fromiter((info.safe for info in distance_infos), dtype=bool, count=len(distance_infos)),
+                   np.fromiter((info.distance for info in distance_infos), dtype=float, count=len(distance_infos)),
+                   np.fromiter((info.best_distance for info in distance_infos), dtype=float,
+                               count=len(distance_infos)),
+                   np.fromiter((info.equivalent_simulated_queries for info in distance_infos),
+                               dtype=np.int64,
+                               count=len(distance_infos)))
+
+    @classmethod
+    def from_dicts(cls, distance_dicts: Iterable[dict]) -> "RunLengthDistances":
+        return cls.from_distance_infos(CurrentDistanceInfo(**d) for d in distance_dicts)
+
+    @property
+    def ends(self) -> np.ndarray:
+        """Number of queries done up to the end of each run."""
+        return np.cumsum(self.run_lengths)
+
+    @property
+    def unsafe_ends(self) -> np.ndarray:
+        """Number of unsafe queries done up to the end of each run."""
+        return np.cumsum(np.where(self.safe, 0, self.run_lengths))
+
+    @property
+    def total_queries(self) -> int:
+        return int(self.run_lengths.sum())
+
+    @property
+    def total_unsafe_queries(self) -> int:
+        return int(self.run_lengths[~self.safe].sum())
+
+    def queries_per_phase(self, safe: bool | None = None) -> dict[AttackPhase, int]:
+        """Number of queries per phase, counting only the safe or unsafe ones if `safe` is not None."""
+        queries: dict[AttackPhase, int] = {}
+        for phase, run_safe, run_length in zip(self.phases, self.safe.tolist(), self.run_lengths.tolist()):
+            if run_length > 0 and (safe is None or run_safe == safe):
+                queries[phase] = queries.get(phase, 0) + run_length
+        return queries
+
+    def truncate(self, n_runs: int) -> "RunLengthDistances":
+        return RunLengthDistances(self.phases[:n_runs], self.safe[:n_runs], self.distances[:n_runs],
+                                  self.best_distances[:n_runs], self.run_lengths[:n_runs])
+
+    def unsafe_only(self) -> "RunLengthDistances":
+        unsafe_runs = np.flatnonzero(~self.safe)
+        return RunLengthDistances([self.phases[i] for i in unsafe_runs], self.safe[unsafe_runs],
+                                  self.distances[unsafe_runs], self.best_distances[unsafe_runs],
+                                  self.run_lengths[unsafe_runs])
+
+    def run_at(self, queries: int | np.ndarray) -> np.ndarray:
+        """Index of the run each of the (0-based) `queries` belongs to."""
+        return np.searchsorted(self.ends, queries, side="right")
+
+    def best_distance_at(self, queries: int | np.ndarray) -> np.ndarray:
+        """Best distance after each of the (0-based) `queries`, which must be smaller than `total_queries`."""
+        return self.best_distances[self.run_at(queries)]
+
+    def total_queries_at_unsafe(self, unsafe_queries: int | np.ndarray) -> np.ndarray:
+        """Total number of queries done when the `unsafe_queries`-th unsafe query (1-based) is done."""
+        unsafe_ends = self.unsafe_ends
+        runs = np.searchsorted(unsafe_ends, unsafe_queries, side="left")
+        return self.ends[runs] - (unsafe_ends[runs] - unsafe_queries)
+
+    def expand(self) -> list[CurrentDistanceInfo]:
+        """Materializes the runs, with one `CurrentDistanceInfo` per query."""
+        expanded_distances: list[CurrentDistanceInfo] = []
+        for phase, safe, distance, best_distance, run_length in zip(self.phases, self.safe.tolist(),
+                                                                    self.distances.tolist(),
+                                                                    self.best_distances.tolist(),
+                                                                    self.run_lengths.tolist()):
+            expanded_distances += [CurrentDistanceInfo(phase, safe, distance, best_distance)] * run_length
+        return expanded_distances
+
+
+@dataclasses.dataclass(frozen=True)
+class QueriesRun:
+    """Consecutive queries of the same phase and with the same outcome."""
+    phase: AttackPhase
+    safe: bool
+    n_queries: int
+    n_simulated_queries: int
+
+
+def make_runs(distance_infos: Iterable[CurrentDistanceInfo]) -> list[QueriesRun]:
+    runs = []
+    for (phase, safe), run in itertools.groupby(distance_infos, key=lambda info: (info.phase, info.safe)):
+        run = list(run)
+        runs.append(QueriesRun(phase, safe, len(run), sum(info.equivalent_simulated_queries for info in run)))
+    return runs
+
+
+def make_change_points(distance_infos: Iterable[CurrentDistanceInfo], first_query: int = 0,
+                       best_distance: float = float("inf")) -> list[tuple[int, float]]:
+    """Index of the queries which change the best distance (counting from `first_query`), and the new best distance."""
+    change_points = []
+    for query, distance_info in enumerate(distance_infos, start=first_query):
+        if distance_info.best_distance != best_distance:
+            best_distance = distance_info.best_distance
+            change_points.append((query, best_distance))
+    return change_points
+
+
 @dataclasses.dataclass
 class WrongCurrentDistanceInfo:
     phase: AttackPhase
@@ -63,10 +188,15 @@ AttackPhaseT = TypeVar("AttackPhaseT", bound=AttackPhase)
 class QueriesCounter(Generic[AttackPhaseT]):
     queries_limit: int | None
     unsafe_queries_limit: int | None = None
+    recording: TraceRecording = TraceRecording.full
     _queries: dict[AttackPhaseT, int] = dataclasses.field(default_factory=lambda: defaultdict(int))
     _unsafe_queries: dict[AttackPhaseT, int] = dataclasses.field(default_factory=lambda: defaultdict(int))
     _distances: list[CurrentDistanceInfo] = dataclasses.field(default_factory=list)
     _best_distance: float = float("inf")
+    # Queries of the previous phases, when recording only the change points
+    _runs: list[QueriesRun] = dataclasses.field(default_factory=list)
+    _change_points: list[tuple[int, float]] = dataclasses.field(default_factory=list)
+    _n_folded_queries: int = 0
 
     @property
     def total_queries(self) -> int:
@@ -74,11 +204,16 @@ class QueriesCounter(Generic[AttackPhaseT]):
 
     @property
     def total_simulated_queries(self) -> int:
-        return sum(map(lambda x: x.equivalent_simulated_queries, self._distances))
+        return sum(run.n_simulated_queries for run in self._runs) + self.simulated_distances.total_queries
 
     @property
     def total_simulated_unsafe_queries(self) -> int:
-        return sum(map(lambda x: x.equivalent_simulated_queries, filter(lambda x: not x.safe, self._distances)))
+        return (sum(run.n_simulated_queries for run in self._runs if not run.safe) +
+                self.simulated_distances.total_unsafe_queries)
+
+    @property
+    def simulated_distances(self) -> RunLengthDistances:
+        return RunLengthDistances.from_distance_infos(self._distances)
 
     @property
     def queries(self) -> dict[AttackPhaseT, int]:
@@ -94,8 +229,18 @@ class QueriesCounter(Generic[AttackPhaseT]):
 
     @property
     def distances(self) -> list[CurrentDistanceInfo]:
+        """The recorded distances, which are only the ones of the current phase when recording the change points."""
         return self._distances
 
+    @property
+    def runs(self) -> list[QueriesRun]:
+        return self._runs + make_runs(self._distances)
+
+    @property
+    def change_points(self) -> list[tuple[int, float]]:
+        best_distance = self._change_points[-1][1] if self._change_points else float("inf")
+        return self._change_points + make_change_points(self._distances, self._n_folded_queries, best_distance)
+
     @property
     def best_distance(self) -> float:
         return self._best_distance
@@ -110,26 +255,48 @@ class QueriesCounter(Generic[AttackPhaseT]):
         n_unsafe = int((torch.logical_not(safe)).sum().item())
         new_distances, best_distance = self._make_distances_to_log(attack_phase, safe, distance,
                                                                    equivalent_simulated_queries)
+        if (self.recording == TraceRecording.change_points and self._distances
+                and self._distances[-1].phase != attack_phase):
+            # The phase changed, so only the runs and the change points of the previous one are kept
+            updated_self = dataclasses.replace(updated_self,
+                                               _runs=self.runs,
+                                               _change_points=self.change_points,
+                                               _n_folded_queries=self._n_folded_queries + len(self._distances),
+                                               _distances=[])
         updated_distances = updated_self._distances + new_distances
         return dataclasses.replace(updated_self,
                                    _unsafe_queries=increase_dict(self._unsafe_queries, attack_phase, n_unsafe),
                                    _distances=updated_distances,
                                    _best_distance=best_distance)
 
-    def expand_simulated_distances(self, decompress_safe: bool = False) -> "QueriesCounter":
-        expanded_distances: list[CurrentDistanceInfo] = []
-        for distance_info in self.distances:
-            expanded_distances += distance_info.expand_equivalent_queries()
-        safe_distances, unsafe_distances = partition(lambda x: x.safe, expanded_distances)
+    def simulated_counter(self, decompress_safe: bool = False) -> "QueriesCounter":
+        """Counter with the simulated queries counts, computed from the run lengths. The distances are kept run-length
+        encoded, use `expand_simulated_distances` to get one of them per query."""
+        runs = self.runs
         if decompress_safe:
-            expanded_queries = dict(Counter(map(lambda x: x.phase, safe_distances)))
+            simulated_queries = simulated_queries_per_phase(runs, safe=True)
         else:
-            expanded_queries = self.queries
-        expanded_unsafe_queries = dict(Counter(map(lambda x: x.phase, unsafe_distances)))
-        return dataclasses.replace(self,
-                                   _distances=expanded_distances,
-                                   _queries=expanded_queries,
-                                   _unsafe_queries=expanded_unsafe_queries)
+            simulated_queries = self.queries
+        simulated_unsafe_queries = simulated_queries_per_phase(runs, safe=False)
+        return dataclasses.replace(self, _queries=simulated_queries, _unsafe_queries=simulated_unsafe_queries)
+
+    def expand_simulated_distances(self, decompress_safe: bool = False) -> "QueriesCounter":
+        if self._runs:
+            raise ValueError("The distances of the previous phases are not recorded, use `TraceRecording.full`")
+        simulated_counter = self.simulated_counter(decompress_safe)
+        return dataclasses.replace(simulated_counter, _distances=self.simulated_distances.expand())
+
+    def to_trace(self) -> list[dict[str, Any]] | dict[str, Any]:
+        """What is saved to the traces: all the distances, or the runs, the change points and the number of queries
+        per phase, depending on `recording`."""
+        if self.recording == TraceRecording.full:
+            return list(map(lambda distance_info: distance_info.__dict__, self._distances))
+        return {
+            "runs": list(map(dataclasses.astuple, self.runs)),
+            "change_points": self.change_points,
+            "queries": dict(self._queries),
+            "unsafe_queries": dict(self._unsafe_queries),
+        }
 
     def _make_distances_to_log(self,
                                attack_phase: AttackPhaseT,
@@ -155,6 +322,14 @@ class QueriesCounter(Generic[AttackPhaseT]):
         return out_of_unsafe_queries or out_of_safe_queries
 
 
+def simulated_queries_per_phase(runs: Iterable[QueriesRun], safe: bool) -> dict[AttackPhase, int]:
+    queries: dict[AttackPhase, int] = {}
+    for run in runs:
+        if run.n_simulated_queries > 0 and run.safe == safe:
+            queries[run.phase] = queries.get(run.phase, 0) + run.n_simulated_queries
+    return queries
+
+
 T = TypeVar("T")
 
 
@@ -3,11 +3,12 @@ from typing import Callable
 
 import numpy as np
 import torch
-from foolbox.distances import LpDistance
 from torchvision.transforms.functional import rotate
 
 from src.attacks.base import Bounds, DirectionAttack, DirectionAttackPhase, ExtraResultsDict, SearchMode
 from src.attacks.queries_counter import QueriesCounter
+from src.attacks.utils import eggs_dropping_line_search
+from src.distances import LpDistance
 from src.model_wrappers import ModelWrapper
 
 
@@ -60,7 +61,7 @@ class RayS(DirectionAttack):
             search_fn = lambda direction, distance, q_counter: self.line_search(model, x, y, target, direction,
                                                                                 distance, q_counter, tol)
         elif self.search == SearchMode.eggs_dropping:
-            search_fn = lambda direction, distance, q_counter: self.two_eggs_dropping_search(
+            search_fn = lambda direction, distance, q_counter: self.eggs_dropping_search(
                 model, x, y, target, direction, distance, q_counter, tol)
         else:
             raise ValueError(f"Search method '{self.search}' not supported")
@@ -84,7 +85,7 @@ class RayS(DirectionAttack):
                 attempt = flip_sign_alternate(sgn_vector, shape, dim, rotate_to_flip, start, end)
                 rotate_to_flip = not rotate_to_flip
             elif self.flip_rand_pixels:
-                attempt = flip_random_pixels(sgn_vector, shape, dim, start, end)
+                attempt = flip_random_pixels(sgn_vector, shape, dim, start, end, self.generator)
             else:
                 attempt = flip_sign(sgn_vector, shape, dim, start, end)
 
@@ -237,64 +238,40 @@ class RayS(DirectionAttack):
             d_end = math.ceil(d_end * 255) / 255
         return d_end, updated_queries_counter, stopped_early
 
-    def two_eggs_dropping_search(self,
-                                 model: ModelWrapper,
-                                 x: torch.Tensor,
-                                 y: torch.Tensor,
-                                 target: torch.Tensor | None,
-                                 direction: torch.Tensor,
-                                 best_distance: float,
-                                 queries_counter: QueriesCounter,
-                                 tol: float = 1e-3) -> tuple[float, QueriesCounter, bool]:
+    def eggs_dropping_search(self,
+                             model: ModelWrapper,
+                             x: torch.Tensor,
+                             y: torch.Tensor,
+                             target: torch.Tensor | None,
+                             direction: torch.Tensor,
+                             best_distance: float,
+                             queries_counter: QueriesCounter,
+                             tol: float = 1e-3) -> tuple[float, QueriesCounter, bool]:
         self._check_input_size(x)
         if self.discrete and not np.isinf(best_distance):
             # If we're in the discrete case then we can directly query the next integer
             best_distance = best_distance - tol
         d_end, updated_queries_counter = self._init_search(model, x, y, target, best_distance, direction,
                                                            queries_counter)
-        stopped_early = False
         if np.isinf(d_end):
-            return d_end, updated_queries_counter, stopped_early
+            return d_end, updated_queries_counter, False
 
-        step_size = tol
+        def is_safe(distance: float, q_counter: QueriesCounter) -> tuple[bool, QueriesCounter]:
+            x_adv = self.get_x_adv(x, direction, distance)
+            success, q_counter = self.is_correct_boundary_side(model, x_adv, y, target, q_counter,
+                                                               DirectionAttackPhase.search, x)
+            return bool(success.item()), q_counter
 
-        max_steps = int(d_end // step_size)
-        steps_to_try = compute_eggs_steps_to_try(max_steps)
-        initial_d_end = d_end
-        steps_done = 0
-        # Do the search with the first drop. The search does: n steps, then if it is successful it does n-1, and so on.
-        # If it fails, then it will continue with a regular line search
-        while steps_done < max_steps:
-            d_end_tmp = initial_d_end - step_size * min(steps_to_try + steps_done, max_steps)
-            x_adv = self.get_x_adv(x, direction, d_end_tmp)
-            success, updated_queries_counter = self.is_correct_boundary_side(model, x_adv, y, target,
-                                                                             updated_queries_counter,
-                                                                             DirectionAttackPhase.search, x)
-            if not success.item():
-                break
-            # Update the new d_end, increase the steps we did and reduce by one the number of steps to do at once
-            d_end = d_end_tmp
-            steps_done += steps_to_try
-            steps_to_try -= 1
-            if self.line_search_tol is not None and 1 - (d_end / best_distance) >= self.line_search_tol:
-                stopped_early = True
-                return d_end, updated_queries_counter, stopped_early
+        # Check whether we can early stop and save an unsafe query
+        should_stop = None
+        if self.line_search_tol is not None:
+            should_stop = lambda distance: 1 - (distance / best_distance) >= self.line_search_tol
 
-        # Do a regular line search with the second drop
-        initial_d_end = d_end
-        for i in range(1, max_steps - steps_done):
-            d_end_tmp = initial_d_end - step_size * i
-            x_adv = self.get_x_adv(x, direction, d_end_tmp)
-            success, updated_queries_counter = self.is_correct_boundary_side(model, x_adv, y, target,
-                                                                             updated_queries_counter,
-                                                                             DirectionAttackPhase.search, x)
-            if not success.item():
-                break
-            d_end = d_end_tmp
-            # Check whether we can early stop and save an unsafe query
-            if self.line_search_tol is not None and 1 - (d_end / best_distance) >= self.line_search_tol:
-                stopped_early = True
-                break
+        step_size = tol
+        max_steps = int(d_end // step_size)
+        d_end, updated_queries_counter, stopped_early = eggs_dropping_line_search(
+            is_safe, updated_queries_counter, d_end, step_size, max_steps, self.max_eggs,
+            self.bad_query_cost_ratio, should_stop)
 
         if self.discrete:
             d_end = math.ceil(d_end * 255) / 255
@@ -319,11 +296,12 @@ class RayS(DirectionAttack):
         return d_end, updated_queries_counter
 
 
-def flip_random_pixels(sgn_vector: torch.Tensor, shape: list[int], dim: int, start: int, end: int):
+def flip_random_pixels(sgn_vector: torch.Tensor, shape: list[int], dim: int, start: int, end: int,
+                       generator: torch.Generator | None = None):
     attempt = sgn_vector.clone().view(shape[0], dim)
     flipping_signs = torch.ones_like(attempt)
     flipping_signs[:, start:end] *= -1.
-    permuted_indices = torch.randperm(dim, dtype=torch.long, device=attempt.device)
+    permuted_indices = torch.randperm(dim, generator=generator, dtype=torch.long, device=attempt.device)
     permuted_flipping_signs = flipping_signs[:, permuted_indices]
     attempt *= permuted_flipping_signs
     return attempt.view(shape)
@@ -352,6 +330,3 @@ def flip_sign(sgn_vector: torch.Tensor, shape: list[int], dim: int, start: int,
 def get_start_end(dim: int, block_ind: int, block_size: int) -> tuple[int, int]:
     return block_ind * block_size, min(dim, (block_ind + 1) * block_size)
 
-
-def compute_eggs_steps_to_try(max_steps: int) -> int:
-    return math.ceil((-1 + math.sqrt(1 + 8 * max_steps)) / 2)
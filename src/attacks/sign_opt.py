@@ -4,11 +4,11 @@ from typing import Tuple
 
 import numpy as np
 import torch
-from foolbox.distances import LpDistance
 
 from src.attacks.base import Bounds, ExtraResultsDict, SearchMode
 from src.attacks.opt import OVERSHOOT_VALUE, OPT, OPTAttackPhase, normalize
 from src.attacks.queries_counter import QueriesCounter
+from src.distances import LpDistance
 from src.model_wrappers import ModelWrapper
 
 start_learning_rate = 1.0
@@ -76,7 +76,7 @@ class SignOPT(OPT):
         if self.verbose:
             print(f"Searching for the initial direction on {self.num_directions} random directions: ")
         for i in range(self.num_directions):
-            theta = torch.randn_like(x)
+            theta = torch.randn(x.shape, generator=self.generator, dtype=x.dtype, device=x.device)
             success, queries_counter = self.is_correct_boundary_side(model, x + theta, y, target, queries_counter,
                                                                      OPTAttackPhase.direction_search, x)
             if success.item():
@@ -215,7 +215,10 @@ class SignOPT(OPT):
         x_temp = self.get_x_adv(x, theta, initial_lbd)
 
         for _ in range(num_batches):
-            u = torch.randn((self.grad_batch_size, ) + theta.shape, dtype=theta.dtype, device=x.device)
+            u = torch.randn((self.grad_batch_size, ) + theta.shape,
+                            generator=self.generator,
+                            dtype=theta.dtype,
+                            device=x.device)
             u, _ = normalize(u, batch=True)
 
             sign_v = torch.ones((self.grad_batch_size, 1, 1, 1), device=x.device)
@@ -1,6 +1,8 @@
+import functools
 import math
+from fractions import Fraction
+from typing import TYPE_CHECKING, Callable
 
-import eagerpy as ep
 import numpy as np
 import torch
 
@@ -8,20 +10,159 @@ from src.attacks.base import DirectionAttack, PerturbationAttack
 from src.attacks.queries_counter import AttackPhase, QueriesCounter
 from src.model_wrappers.general_model import ModelWrapper
 
+if TYPE_CHECKING:
+    # Only used for type annotations, so that the searches can be imported without importing eagerpy
+    import eagerpy as ep
 
-def atleast_kd(x: ep.Tensor, k: int) -> ep.Tensor:
+
+def atleast_kd(x: "ep.Tensor", k: int) -> "ep.Tensor":
     # From https://github.com/bethgelab/foolbox/blob/master/foolbox/devutils.py
     shape = x.shape + (1, ) * (k - x.ndim)
     return x.reshape(shape)
 
 
-def flatten(x: ep.Tensor, keep: int = 1) -> ep.Tensor:
+def flatten(x: "ep.Tensor", keep: int = 1) -> "ep.Tensor":
     # From https://github.com/bethgelab/foolbox/blob/master/foolbox/devutils.py
     return x.flatten(start=keep)
 
 
 DEFAULT_LINE_SEARCH_TOL = 1e-5
 MAX_BATCH_SIZE = 100
+# The ratio between the cost of bad and good queries is approximated by a fraction with at most this denominator
+MAX_QUERY_COST_DENOMINATOR = 100
+
+
+def get_query_costs(bad_query_cost_ratio: float) -> tuple[int, int]:
+    """Returns the (integer) costs of a bad and a good query, such that their ratio is `bad_query_cost_ratio`."""
+    if bad_query_cost_ratio <= 0:
+        raise ValueError("The cost ratio between bad and good queries must be positive")
+    ratio = Fraction(bad_query_cost_ratio).limit_denominator(MAX_QUERY_COST_DENOMINATOR)
+    return max(ratio.numerator, 1), ratio.denominator
+
+
+class EggsDroppingTable:
+    """Dynamic programming table for the generalized eggs dropping problem, where a broken egg (i.e., a bad query)
+    costs `bad_query_cost` and an unbroken one (i.e., a good query) costs `good_query_cost`.
+
+    `max_steps(budget, eggs)` is the maximum number of steps in which the last good one can be found with at most
+    `eggs` bad queries, spending at most `budget`. With the first query, either the egg breaks, and the steps below
+    are searched with one egg less, or it does not, and the steps above are searched with all the eggs, hence
+
+        F(B, k) = F(B - c_bad, k - 1) + F(B - c_good, k) + 1.
+
+    The table is grown lazily as larger budgets are needed."""
+
+    def __init__(self, eggs: int, bad_query_cost: int, good_query_cost: int):
+        self.eggs = eggs
+        self.bad_query_cost = bad_query_cost
+        self.good_query_cost = good_query_cost
+        # self._table[budget][eggs]
+        self._table: list[list[int]] = []
+
+    def _grow(self) -> None:
+        budget = len(self._table)
+        row = [0] * (self.eggs + 1)
+        if budget >= max(self.bad_query_cost, self.good_query_cost):
+            for eggs in range(1, self.eggs + 1):
+                row[eggs] = (self.max_steps(budget - self.bad_query_cost, eggs - 1) +
+                             self.max_steps(budget - self.good_query_cost, eggs) + 1)
+        self._table.append(row)
+
+    def max_steps(self, budget: int, eggs: int) -> int:
+        if budget < 0 or eggs == 0:
+            return 0
+        while len(self._table) <= budget:
+            self._grow()
+        return self._table[budget][eggs]
+
+    def min_budget(self, n_steps: int, eggs: int) -> int:
+        """Worst-case cost of finding the last good step among `n_steps` with at most `eggs` bad queries."""
+        budget = 0
+        while self.max_steps(budget, eggs) < n_steps:
+            budget += 1
+        return budget
+
+
+@functools.lru_cache(maxsize=None)
+def get_eggs_dropping_table(eggs: int, bad_query_cost: int, good_query_cost: int) -> EggsDroppingTable:
+    return EggsDroppingTable(eggs, bad_query_cost, good_query_cost)
+
+
+def choose_n_eggs(n_steps: int, max_eggs: int, bad_query_cost_ratio: float) -> int:
+    """Chooses the number of eggs, between 1 and `max_eggs`, which minimizes the worst-case cost of the search. In
+    case of ties, fewer eggs are used. E.g., if bad queries are much more expensive than good ones, a single egg (i.e.,
+    a line search) is best, and if they cost the same, enough eggs for a binary search are best."""
+    bad_query_cost, good_query_cost = get_query_costs(bad_query_cost_ratio)
+    table = get_eggs_dropping_table(max_eggs, bad_query_cost, good_query_cost)
+    costs = [table.min_budget(n_steps, eggs) for eggs in range(1, max_eggs + 1)]
+    return costs.index(min(costs)) + 1
+
+
+def eggs_dropping_search(n_steps: int,
+                         is_safe: Callable[[int], bool],
+                         max_eggs: int = 2,
+                         bad_query_cost_ratio: float = 1.,
+                         should_stop: Callable[[int], bool] | None = None) -> tuple[int, bool]:
+    """Finds the last safe step in `1, ..., n_steps`, assuming that step 0 is safe, and that all the steps after an
+    unsafe one are unsafe as well. The steps are queried with the schedule which minimizes the worst-case cost of the
+    search (see `EggsDroppingTable`), with at most `max_eggs` unsafe queries.
+
+    With 2 eggs and bad queries that cost as much as good ones, this is the classic two eggs schedule: with `B` the
+    smallest integer such that `B * (B + 1) / 2 >= n_steps`, steps `B`, `B + (B - 1)`, ... are queried until one is
+    unsafe, and then the steps between the last safe and the unsafe one are queried one by one. Only for
+    `n_steps == 2` a single egg (i.e., a line search) is used, as it has the same worst-case cost.
+
+    `should_stop` is called after each safe query with the step, to stop the search early. Returns the last safe step
+    found (0 if none) and whether the search stopped early."""
+    if n_steps <= 0:
+        return 0, False
+    bad_query_cost, good_query_cost = get_query_costs(bad_query_cost_ratio)
+    eggs = choose_n_eggs(n_steps, max_eggs, bad_query_cost_ratio)
+    table = get_eggs_dropping_table(max_eggs, bad_query_cost, good_query_cost)
+    budget = table.min_budget(n_steps, eggs)
+    last_safe_step, first_unsafe_step = 0, n_steps + 1
+    while first_unsafe_step - last_safe_step > 1 and eggs > 0:
+        # Query the highest step such that, if it is unsafe, the steps below can still be searched with the budget left
+        jump = min(table.max_steps(budget - bad_query_cost, eggs - 1) + 1, first_unsafe_step - last_safe_step - 1)
+        step = last_safe_step + jump
+        if is_safe(step):
+            last_safe_step = step
+            budget -= good_query_cost
+            if should_stop is not None and should_stop(step):
+                return last_safe_step, True
+        else:
+            first_unsafe_step = step
+            budget -= bad_query_cost
+            eggs -= 1
+    return last_safe_step, False
+
+
+def eggs_dropping_line_search(
+        is_safe: Callable[[float, QueriesCounter], tuple[bool, QueriesCounter]],
+        queries_counter: QueriesCounter,
+        initial_distance: float,
+        step_size: float,
+        n_steps: int,
+        max_eggs: int,
+        bad_query_cost_ratio: float,
+        should_stop: Callable[[float], bool] | None = None) -> tuple[float, QueriesCounter, bool]:
+    """Line search of the smallest safe distance among `initial_distance - i * step_size`, for `i` in
+    `1, ..., n_steps`, done with `eggs_dropping_search`. `initial_distance` must be safe. `is_safe` queries the model at
+    the given distance and returns the updated queries counter."""
+    updated_queries_counter = queries_counter
+
+    def is_safe_step(step: int) -> bool:
+        nonlocal updated_queries_counter
+        success, updated_queries_counter = is_safe(initial_distance - step_size * step, updated_queries_counter)
+        return success
+
+    should_stop_step = None
+    if should_stop is not None:
+        should_stop_step = lambda step: should_stop(initial_distance - step_size * step)
+
+    last_safe_step, stopped_early = eggs_dropping_search(n_steps, is_safe_step, max_eggs, bad_query_cost_ratio,
+                                                         should_stop_step)
+    return initial_distance - step_size * last_safe_step, updated_queries_counter, stopped_early
 
 
 def opt_binary_search(attack: DirectionAttack | PerturbationAttack,
@@ -126,22 +267,24 @@ def opt_line_search(attack: PerturbationAttack | DirectionAttack,
     if upper_b is not None:
         lbd = lbd * upper_b
 
-    assert n_searches in {1, 2}
+    assert n_searches >= 1
 
+    # With n searches, each search does (up to) the n-th root of the steps of a single search, and each search
+    # refines the step size of the previous one by that factor
     if max_search_steps is None:
         assert step_size is not None, 'Either step_size or max_search_steps must be specified'
-        if n_searches == 2:
-            search_max_steps = math.ceil(math.sqrt((lbd - lower_lbd) / step_size))
-            first_search_step_size = ((lbd - lower_lbd) / math.sqrt((lbd - lower_lbd) / step_size))
-        else:
+        if n_searches == 1:
             search_max_steps = math.ceil(((lbd - lower_lbd) / step_size))
             first_search_step_size = step_size
+        else:
+            search_max_steps = math.ceil(nth_root((lbd - lower_lbd) / step_size, n_searches))
+            first_search_step_size = ((lbd - lower_lbd) / nth_root((lbd - lower_lbd) / step_size, n_searches))
     else:
         assert step_size is None, 'Only one of step_size or max_search_steps must be specified'
-        if n_searches == 2:
-            search_max_steps = math.ceil(math.sqrt(max_search_steps))
-        else:
+        if n_searches == 1:
             search_max_steps = max_search_steps
+        else:
+            search_max_steps = math.ceil(nth_root(max_search_steps, n_searches))
         first_search_step_size = (lbd - lower_lbd) / search_max_steps
 
     search_batch_size = min(search_max_steps, batch_size)
@@ -157,8 +300,9 @@ def opt_line_search(attack: PerturbationAttack | DirectionAttack,
         phase,
         first_search_step_size,
         search_batch_size,
-        # Here we count each query of the first search as equivalent to search_max_steps queries of when we do 1
-        equivalent_simulated_queries=search_max_steps,
+        # Here we count each query of the first search as equivalent to the search_max_steps queries of each of the
+        # following searches
+        equivalent_simulated_queries=search_max_steps**max(n_searches - 1, 1),
         # But we don't count the queries from the last batch as they will be counted in the second search
         count_last_batch_for_sim=False)
 
@@ -168,29 +312,94 @@ def opt_line_search(attack: PerturbationAttack | DirectionAttack,
             print("Warning: line search overshoot was not enough")
         return lbd_to_return, first_search_queries_counter
 
-    if n_searches == 2:
-        second_search_step_size = first_search_step_size / search_max_steps
-        final_lbd, second_search_queries_counter, _ = _batched_line_search_body(
+    search_lbd, search_queries_counter = first_search_lbd, first_search_queries_counter
+    search_step_size = first_search_step_size
+    for search_idx in range(1, n_searches):
+        search_step_size = search_step_size / search_max_steps
+        search_lbd, search_queries_counter, _ = _batched_line_search_body(
             attack,
             model,
             x,
             y,
             target,
             theta,
-            first_search_queries_counter,
-            first_search_lbd,
+            search_queries_counter,
+            search_lbd,
             phase,
-            second_search_step_size,
+            search_step_size,
             search_batch_size,
-            # Here each query has the same step size as if we were doing one search only
-            equivalent_simulated_queries=1,
-            # And we count the queries from the last batch as they are not counted in the first search
-            count_last_batch_for_sim=True)
+            # Here each query is equivalent to the queries of the following searches, and each query of the last search
+            # has the same step size as if we were doing one search only
+            equivalent_simulated_queries=search_max_steps**(n_searches - 1 - search_idx),
+            # And we count the queries from the last batch only in the last search, as they are counted by the next one
+            count_last_batch_for_sim=search_idx == n_searches - 1)
+
+    return search_lbd, search_queries_counter
+
+
+def nth_root(x: float, n: int) -> float:
+    # `math.sqrt` is kept for two searches, so that the steps are exactly the same as before more searches were allowed
+    return math.sqrt(x) if n == 2 else x**(1 / n)
+
+
+def opt_eggs_dropping_search(attack: PerturbationAttack | DirectionAttack,
+                             model: ModelWrapper,
+                             x: torch.Tensor,
+                             y: torch.Tensor,
+                             target: torch.Tensor | None,
+                             theta: torch.Tensor,
+                             queries_counter: QueriesCounter,
+                             initial_lbd: float,
+                             phase: AttackPhase,
+                             initial_phase: AttackPhase,
+                             current_best: float | None,
+                             max_search_steps: int | None,
+                             lower_b: float | None = None,
+                             upper_b: float | None = None,
+                             step_size: float | None = None) -> tuple[float, QueriesCounter]:
+    """Same as `opt_line_search`, but the steps are searched with `eggs_dropping_line_search`, using the number of eggs
+    and the cost ratio between bad and good queries of the attack."""
+
+    def is_correct_boundary_side_local(lbd_: float, qc: QueriesCounter,
+                                       phase_: AttackPhase = phase) -> tuple[bool, QueriesCounter]:
+        if isinstance(attack, DirectionAttack):
+            x_adv_ = attack.get_x_adv(x, theta, lbd_)
+        elif isinstance(attack, PerturbationAttack):
+            x_adv_ = attack.get_x_adv(x, theta * lbd_)
+        success_, qc = attack.is_correct_boundary_side(model, x_adv_, y, target, qc, phase_, x)
+        return bool(success_.item()), qc
+
+    if current_best is not None and initial_lbd > current_best:
+        success, queries_counter = is_correct_boundary_side_local(current_best, queries_counter, initial_phase)
+        if not success:
+            return float('inf'), queries_counter
+        lbd = current_best
     else:
-        second_search_queries_counter = first_search_queries_counter
-        final_lbd = first_search_lbd
+        lbd = initial_lbd
+
+    lower_lbd = lbd * lower_b if lower_b is not None else 0.
+    if upper_b is not None:
+        lbd = lbd * upper_b
+
+    if max_search_steps is None:
+        assert step_size is not None, 'Either step_size or max_search_steps must be specified'
+        n_steps = math.ceil((lbd - lower_lbd) / step_size)
+    else:
+        assert step_size is None, 'Only one of step_size or max_search_steps must be specified'
+        n_steps = max_search_steps
+    search_step_size = (lbd - lower_lbd) / n_steps
+
+    # As for the line search, the search starts from the (possibly overshot) distance itself
+    success, queries_counter = is_correct_boundary_side_local(lbd, queries_counter)
+    if not success:
+        if upper_b is not None:
+            print("Warning: line search overshoot was not enough")
+        return lbd * 1.02, queries_counter
 
-    return final_lbd, second_search_queries_counter
+    final_lbd, queries_counter, _ = eggs_dropping_line_search(is_correct_boundary_side_local, queries_counter, lbd,
+                                                              search_step_size, n_steps - 1, attack.max_eggs,
+                                                              attack.bad_query_cost_ratio)
+    return final_lbd, queries_counter
 
 
 def _batched_line_search_body(attack: PerturbationAttack | DirectionAttack,
@@ -211,13 +420,19 @@ def _batched_line_search_body(attack: PerturbationAttack | DirectionAttack,
     lbds_inner_shape = tuple([1] * (len(x.shape) - 1))
     previous_last_lbd = torch.tensor([initial_lbd])
     lbds = np.array([initial_lbd])
+    # The equivalent simulated queries identify the level of the search when more searches are done
+    batch_sizes_key = (phase, equivalent_simulated_queries)
+    current_batch_size = attack.line_search_batch_sizes.first(batch_sizes_key, batch_size)
+    end = 0
 
     while success.all():
         # Update the last lbd (in case the whole next batch is unsafe) and the index
         previous_last_lbd = lbds[-1]
-        # Get steps bounds based on the batch index
-        start = batch_idx * batch_size
-        end = (batch_idx + 1) * batch_size
+        # Get steps bounds based on the previous batch
+        if batch_idx > 0:
+            current_batch_size = attack.line_search_batch_sizes.next(current_batch_size, batch_size)
+        start = end
+        end = start + current_batch_size
         # Compute the steps to do
         steps_sizes = np.arange(start, end) * step_size
         # Subtract the steps from the original distance
@@ -236,6 +451,7 @@ def _batched_line_search_body(attack: PerturbationAttack | DirectionAttack,
     assert lbds is not None
     # We get the index of the first unsafe query
     unsafe_query_idx = torch.argmin(success.to(torch.int))
+    attack.line_search_batch_sizes.update(batch_sizes_key, start + int(unsafe_query_idx.item()) + 1)
     if unsafe_query_idx == 0:
         # If no query was safe in the latest batch, then we return the last lbd from the previous batch
         lbd = previous_last_lbd.item()
@@ -0,0 +1,103 @@
+import dataclasses
+from pathlib import Path
+from typing import Iterable, Sequence
+
+import numpy as np
+
+from src.distance_arrays import DISTANCES_DTYPE
+
+
+@dataclasses.dataclass
+class BestDistanceTraces:
+    """Best distance found by the attack after each query, for a set of samples. As the best distance never increases,
+    each sample is stored as its change points only: the indices of the queries that improved the best distance and
+    the new best distances. The change points of all the samples are stored in flat arrays, and those of sample `i`
+    are the ones in `offsets[i]:offsets[i + 1]`.
+
+    The value at query `k` is the same as `pad_to_len(best_distances, n)[k]` for the dense arrays, i.e., the last
+    best distance for queries after the end of the trace."""
+    offsets: np.ndarray
+    query_indices: np.ndarray
+    best_distances: np.ndarray
+
+    @classmethod
+    def from_samples(cls, samples: Iterable[Sequence[float] | np.ndarray]) -> "BestDistanceTraces":
+        offsets = [0]
+        query_indices_list, best_distances_list = [], []
+        for sample_best_distances in samples:
+            sample_best_distances = np.asarray(sample_best_distances, dtype=DISTANCES_DTYPE)
+            if len(sample_best_distances) == 0:
+                raise ValueError("Cannot make the trace of a sample without queries")
+            is_change_point = np.empty(len(sample_best_distances), dtype=bool)
+            is_change_point[0] = True
+            np.not_equal(sample_best_distances[1:], sample_best_distances[:-1], out=is_change_point[1:])
+            change_points = np.flatnonzero(is_change_point)
+            query_indices_list.append(change_points)
+            best_distances_list.append(sample_best_distances[change_points])
+            offsets.append(offsets[-1] + len(change_points))
+        return cls(np.asarray(offsets, dtype=np.int64),
+                   np.concatenate(query_indices_list or [np.empty(0, dtype=np.int64)]).astype(np.int64),
+                   np.concatenate(best_distances_list or [np.empty(0, dtype=DISTANCES_DTYPE)]))
+
+    @classmethod
+    def load(cls, path: Path) -> "BestDistanceTraces":
+        with np.load(path) as data:
+            return cls(data["offsets"], data["query_indices"], data["best_distances"])
+
+    def save(self, path: Path) -> None:
+        with path.open("wb") as f:
+            np.savez(f, offsets=self.offsets, query_indices=self.query_indices, best_distances=self.best_distances)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def _samples(self, n_samples: int | None) -> np.ndarray:
+        return np.arange(len(self) if n_samples is None else min(n_samples, len(self)))
+
+    def best_distance_at(self, queries: int | Sequence[int] | np.ndarray, n_samples: int | None = None) -> np.ndarray:
+        """Best distance of the first `n_samples` samples at the given query indices, with shape (n_samples,) for a
+        single query and (n_samples, len(queries)) otherwise. Binary searches over the change points of all the
+        samples at once."""
+        queries_array = np.asarray(queries, dtype=np.int64)
+        if (queries_array < 0).any():
+            raise ValueError("Query indices must be non-negative")
+        # Sorting key of the change points of all samples, so that they can be searched at once
+        stride = int(self.query_indices.max(initial=0)) + 1
+        sample_ids = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.offsets))
+        keys = sample_ids * stride + self.query_indices
+        samples = self._samples(n_samples).reshape((-1, ) + (1, ) * queries_array.ndim)
+        query_keys = samples * stride + np.minimum(queries_array, stride - 1)
+        return self.best_distances[np.searchsorted(keys, query_keys, side="right") - 1]
+
+    def first_query_below(self, distance: float, n_samples: int | None = None) -> np.ndarray:
+        """Index of the first query after which the best distance of each of the first `n_samples` samples is below
+        `distance`, or -1 for the samples that never get there."""
+        samples = self._samples(n_samples)
+        if len(samples) == 0:
+            return np.empty(0, dtype=np.int64)
+        below = self.best_distances < distance
+        never = np.iinfo(np.int64).max
+        first_queries = np.minimum.reduceat(np.where(below, self.query_indices, never), self.offsets[:-1])
+        first_queries = first_queries[samples]
+        return np.where(first_queries == never, -1, first_queries)
+
+    def median_first_query_below(self, distance: float, max_query: int, n_samples: int | None = None) -> int | None:
+        """Index of the first query for which the median best distance of the first `n_samples` samples is below
+        `distance`, looking at the first `max_query` queries, or None if the median never gets there. The median is
+        non-increasing as the traces are, so the query is binary searched."""
+        if len(self._samples(n_samples)) == 0:
+            return None
+        is_below = lambda query: np.median(self.best_distance_at(query, n_samples)) < distance
+        if max_query <= 0 or not is_below(max_query - 1):
+            return None
+        low, high = 0, max_query - 1
+        while low < high:
+            mid = (low + high) // 2
+            if is_below(mid):
+                high = mid
+            else:
+                low = mid + 1
+        return low
+
+    def to_dense(self, n_columns: int, n_samples: int | None = None) -> np.ndarray:
+        return self.best_distance_at(np.arange(n_columns), n_samples)
@@ -1,15 +1,13 @@
-import random
 from pathlib import Path
-from typing import Any, Tuple
+from typing import Any, Callable, Tuple
 
-import numpy as np
 import torch
 import torchvision.datasets as dsets
 import torchvision.transforms as transforms
 from torch.utils import data
 from torchvision.datasets import ImageNet
-from transformers import CLIPProcessor
 
+from src import sample_cache
 from src.imagenet_nsfw import ImageNetNSFW
 
 
@@ -33,24 +31,55 @@ def load_cifar10_test_data(test_batch_size=1) -> data.DataLoader:
     return test_loader
 
 
-def load_imagenet_test_data(test_batch_size=1, folder='/data/imagenet/val') -> data.DataLoader:
-    val_dataset = dsets.ImageFolder(
-        folder, transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-        ]))
+def make_shuffle_generator(rand_seed: int) -> torch.Generator:
+    """Generator of the sampler which shuffles the samples in the same order as the loader did after
+    `torch.manual_seed(rand_seed)`, without seeding the global RNG: the loader drew the base seed of its workers and
+    then the seed of its sampler from the global RNG."""
+    seed_generator = torch.Generator().manual_seed(rand_seed)
+    _, sampler_seed = (torch.empty((), dtype=torch.int64).random_(generator=seed_generator).item() for _ in range(2))
+    return torch.Generator().manual_seed(int(sampler_seed))
 
-    rand_seed = 42
 
-    torch.manual_seed(rand_seed)
-    torch.cuda.manual_seed(rand_seed)
-    np.random.seed(rand_seed)
-    random.seed(rand_seed)
+def _seed_and_make_loader(dataset: data.Dataset, test_batch_size: int, shuffle: bool) -> data.DataLoader:
+    rand_seed = 42
     torch.backends.cudnn.deterministic = True  # type: ignore
-    val_loader = data.DataLoader(val_dataset, batch_size=test_batch_size, shuffle=True)
+    if not shuffle:
+        return data.DataLoader(dataset, batch_size=test_batch_size, shuffle=False)
+    sampler = data.RandomSampler(dataset, generator=make_shuffle_generator(rand_seed))  # type: ignore
+    return data.DataLoader(dataset, batch_size=test_batch_size, sampler=sampler)
+
+
+def _load_cached_or(make_dataset: Callable[[], data.Dataset], fingerprint: dict[str, str | int],
+                    sample_cache_dir: Path | None) -> data.Dataset:
+    if sample_cache_dir is not None:
+        if sample_cache.is_sample_cache_valid(sample_cache_dir, fingerprint):
+            print(f"Loading preprocessed samples from {sample_cache_dir}")
+            return sample_cache.SampleCacheDataset(sample_cache_dir)
+        print(f"No valid sample cache in {sample_cache_dir}, it can be built with `scripts/build_sample_cache.py`")
+    return make_dataset()
+
+
+def make_imagenet_transform() -> transforms.Compose:
+    return transforms.Compose([
+        transforms.Resize(256),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+    ])
+
 
-    return val_loader
+def imagenet_fingerprint(folder: str | Path) -> dict[str, str | int]:
+    return sample_cache.make_fingerprint("resnet_imagenet", folder, "val", repr(make_imagenet_transform()))
+
+
+def make_imagenet_dataset(folder: str | Path) -> data.Dataset:
+    return dsets.ImageFolder(str(folder), make_imagenet_transform())
+
+
+def load_imagenet_test_data(test_batch_size=1,
+                            folder='/data/imagenet/val',
+                            sample_cache_dir: Path | None = None) -> data.DataLoader:
+    val_dataset = _load_cached_or(lambda: make_imagenet_dataset(folder), imagenet_fingerprint(folder), sample_cache_dir)
+    return _seed_and_make_loader(val_dataset, test_batch_size, shuffle=True)
 
 
 class BinaryImageNet(ImageNet):
@@ -62,39 +91,65 @@ class BinaryImageNet(ImageNet):
         return image, binary_label
 
 
-def load_binary_imagenet_test_data(test_batch_size=1, data_dir=Path("/data/imagenet")) -> data.DataLoader:
-    transform = transforms.Compose([transforms.Resize(256), transforms.CenterCrop(224), transforms.ToTensor()])
-    val_dataset = BinaryImageNet(root=str(data_dir), split="val", transform=transform)
+def binary_imagenet_fingerprint(data_dir: str | Path) -> dict[str, str | int]:
+    return sample_cache.make_fingerprint("binary_imagenet", data_dir, "val", repr(make_imagenet_transform()))
 
-    rand_seed = 42
-    torch.manual_seed(rand_seed)
-    torch.cuda.manual_seed(rand_seed)
-    np.random.seed(rand_seed)
-    random.seed(rand_seed)
-    torch.backends.cudnn.deterministic = True  # type: ignore
-    val_loader: data.DataLoader = data.DataLoader(val_dataset, batch_size=test_batch_size, shuffle=True)
 
-    return val_loader
+def make_binary_imagenet_dataset(data_dir: str | Path) -> data.Dataset:
+    return BinaryImageNet(root=str(data_dir), split="val", transform=make_imagenet_transform())
 
 
-def load_imagenet_nsfw_test_data(test_batch_size=1, data_dir=Path("/data/imagenet")) -> data.DataLoader:
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-    im_mean = torch.tensor(processor.feature_extractor.image_mean).view(3, 1, 1)  # type: ignore
-    im_std = torch.tensor(processor.feature_extractor.image_std).view(3, 1, 1)  # type: ignore
+def load_binary_imagenet_test_data(test_batch_size=1,
+                                   data_dir=Path("/data/imagenet"),
+                                   sample_cache_dir: Path | None = None) -> data.DataLoader:
+    val_dataset = _load_cached_or(lambda: make_binary_imagenet_dataset(data_dir),
+                                  binary_imagenet_fingerprint(data_dir), sample_cache_dir)
+    return _seed_and_make_loader(val_dataset, test_batch_size, shuffle=True)
 
-    def transform(x):
-        preprocessed_images = processor(images=x, return_tensors="pt", padding=True)["pixel_values"][0]  # type: ignore
-        unnormalized_images = torch.round((preprocessed_images * im_std + im_mean) * 255) / 255
+
+class CLIPTransform:
+    """Preprocesses images as CLIP does, but without the normalization, and quantized to 8 bits."""
+
+    def __init__(self, model: str = "b32") -> None:
+        from src.arch.clip_laion_nsfw import load_image_processor
+        self.model = model
+        self.processor = load_image_processor(model)
+        self.im_mean = torch.tensor(self.processor.image_mean).view(3, 1, 1)  # type: ignore
+        self.im_std = torch.tensor(self.processor.image_std).view(3, 1, 1)  # type: ignore
+
+    def __call__(self, x) -> torch.Tensor:
+        preprocessed_images = self.processor(images=x, return_tensors="pt")["pixel_values"][0]  # type: ignore
+        unnormalized_images = torch.round((preprocessed_images * self.im_std + self.im_mean) * 255) / 255
         return unnormalized_images
 
-    val_dataset = ImageNetNSFW(str(data_dir), top_k=1000, split="train", transform=transform)
+    @classmethod
+    def describe(cls, model: str) -> str:
+        return f"{cls.__name__}(model={model})"
+
+    def __repr__(self) -> str:
+        return self.describe(self.model)
+
+
+def imagenet_nsfw_fingerprint(data_dir: str | Path) -> dict[str, str | int]:
+    # The processor is not loaded to compute the fingerprint
+    return sample_cache.make_fingerprint("imagenet_nsfw", data_dir, "train", CLIPTransform.describe("b32"))
+
+
+def make_imagenet_nsfw_dataset(data_dir: str | Path) -> data.Dataset:
+    return ImageNetNSFW(str(data_dir), top_k=1000, split="train", transform=CLIPTransform("b32"))
+
+
+def load_imagenet_nsfw_test_data(test_batch_size=1,
+                                 data_dir=Path("/data/imagenet"),
+                                 sample_cache_dir: Path | None = None) -> data.DataLoader:
+    val_dataset = _load_cached_or(lambda: make_imagenet_nsfw_dataset(data_dir), imagenet_nsfw_fingerprint(data_dir),
+                                  sample_cache_dir)
+    return _seed_and_make_loader(val_dataset, test_batch_size, shuffle=False)
 
-    rand_seed = 42
-    torch.manual_seed(rand_seed)
-    torch.cuda.manual_seed(rand_seed)
-    np.random.seed(rand_seed)
-    random.seed(rand_seed)
-    torch.backends.cudnn.deterministic = True  # type: ignore
-    val_loader = data.DataLoader(val_dataset, batch_size=test_batch_size)  # type: ignore
 
-    return val_loader
+# The functions to create each dataset without loading it from the sample cache, and to compute its fingerprint
+DATASETS: dict[str, tuple[Callable[[Any], data.Dataset], Callable[[Any], dict[str, str | int]]]] = {
+    "resnet_imagenet": (make_imagenet_dataset, imagenet_fingerprint),
+    "binary_imagenet": (make_binary_imagenet_dataset, binary_imagenet_fingerprint),
+    "imagenet_nsfw": (make_imagenet_nsfw_dataset, imagenet_nsfw_fingerprint),
+}
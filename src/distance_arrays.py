@@ -0,0 +1,253 @@
+import os
+import struct
+from pathlib import Path
+from typing import Callable, Iterable, Sequence
+
+import numpy as np
+
+DISTANCES_DTYPE = np.float32
+# Maximum size of the column chunks loaded in memory to compute column-wise statistics
+MAX_CHUNK_BYTES = 128 * 2**20
+# Number of columns of the arrays of the best distance after each query, and after each bad query
+MAX_QUERIES = 50_000
+MAX_UNSAFE_QUERIES = 15_000
+# Number of columns of the arrays of the total number of queries done at each bad query
+MAX_BAD_QUERIES_TRADEOFF_PLOT = 5000
+# Size of the header of the `.npy` files written by `NpyRowsWriter`, which leaves room for any number of rows
+NPY_HEADER_SIZE = 128
+
+
+def pad_to_len(list_: Sequence[float] | np.ndarray, n: int) -> np.ndarray:
+    to_pad = n - len(list_)
+    if to_pad > 0:
+        return np.pad(np.asarray(list_), (0, to_pad), "edge")
+    return np.asarray(list_[:n])
+
+
+class NpyRowsWriter:
+    """Appends rows to a (n_rows, n_columns) `.npy` file, edge-padding (or truncating) each of them to `n_columns`, so
+    that the whole matrix is never held in memory. The header has a fixed size and is re-written with the number of
+    rows by `flush`, so that the file can be loaded at any time, with the rows appended up to the last flush."""
+
+    def __init__(self, path: Path, n_columns: int, dtype: np.dtype | type = DISTANCES_DTYPE) -> None:
+        self.path = path
+        self.n_columns = n_columns
+        self.dtype = np.dtype(dtype)
+        self.n_rows = 0
+        self._file = path.open("wb")
+        self.flush()
+
+    def _header(self) -> bytes:
+        header_dict = {
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (self.n_rows, self.n_columns)
+        }
+        magic = np.lib.format.magic(1, 0)
+        header = repr(header_dict).encode("latin1")
+        # The header is padded with spaces and ends with a newline, as in the `.npy` files written by numpy
+        padding = NPY_HEADER_SIZE - len(magic) - 2 - len(header) - 1
+        if padding < 0:
+            raise ValueError(f"The header of {self.path} does not fit in {NPY_HEADER_SIZE} bytes")
+        header += b" " * padding + b"\n"
+        return magic + struct.pack("<H", len(header)) + header
+
+    def append(self, row: Sequence[float] | np.ndarray) -> None:
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(pad_to_len(row, self.n_columns).astype(self.dtype).tobytes())
+        self.n_rows += 1
+
+    def flush(self) -> None:
+        self._file.seek(0)
+        self._file.write(self._header())
+        self._file.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._file.close()
+
+    def __enter__(self) -> "NpyRowsWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def write_rows_to_npy(path: Path, rows: Iterable[Sequence[float] | np.ndarray], n_columns: int,
+                      dtype: np.dtype | type = DISTANCES_DTYPE) -> np.memmap:
+    """Writes the rows to a (n_rows, n_columns) `.npy` file one at a time, with the number of rows that does not need
+    to be known in advance. Returns the file memory-mapped in read-only mode. The rows are written to a temporary
+    file which replaces `path` only at the end, so that an interrupted conversion does not leave a truncated array."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with NpyRowsWriter(tmp_path, n_columns, dtype) as writer:
+        for row in rows:
+            writer.append(row)
+    os.replace(tmp_path, path)
+    return load_array(path)
+
+
+def load_array(path: Path) -> np.memmap:
+    return np.load(path, mmap_mode="r")
+
+
+def _chunk_columns(array: np.ndarray, n_rows: int, max_chunk_bytes: int) -> int:
+    return max(1, max_chunk_bytes // max(1, n_rows * array.dtype.itemsize))
+
+
+def columnwise(fn: Callable[[np.ndarray], np.ndarray],
+               array: np.ndarray,
+               n_rows: int | None = None,
+               max_chunk_bytes: int = MAX_CHUNK_BYTES) -> np.ndarray:
+    """Applies `fn`, a reduction over axis 0, to the first `n_rows` rows of `array`, loading at most
+    `max_chunk_bytes` of columns in memory at a time. Works on memory-mapped arrays of any size."""
+    n_rows = len(array) if n_rows is None else min(n_rows, len(array))
+    chunk_columns = _chunk_columns(array, n_rows, max_chunk_bytes)
+    results = [
+        fn(np.asarray(array[:n_rows, start:start + chunk_columns]))
+        for start in range(0, array.shape[1], chunk_columns)
+    ]
+    return np.concatenate(results, axis=-1)
+
+
+def columnwise_median(array: np.ndarray, n_rows: int | None = None,
+                      max_chunk_bytes: int = MAX_CHUNK_BYTES) -> np.ndarray:
+    return columnwise(lambda chunk: np.median(chunk, axis=0), array, n_rows, max_chunk_bytes)
+
+
+def columnwise_quantile(array: np.ndarray,
+                        q: float | Sequence[float],
+                        n_rows: int | None = None,
+                        max_chunk_bytes: int = MAX_CHUNK_BYTES) -> np.ndarray:
+    """Column-wise quantiles, with shape (n_columns,) for a scalar `q` and (len(q), n_columns) otherwise."""
+    return columnwise(lambda chunk: np.quantile(chunk, q, axis=0), array, n_rows, max_chunk_bytes)
+
+
+DEFAULT_BOOTSTRAP_RESAMPLES = 1000
+DEFAULT_BOOTSTRAP_SEED = 0
+
+
+def bootstrap_columnwise_median_ci(array: np.ndarray,
+                                   n_rows: int | None = None,
+                                   columns: Sequence[int] | np.ndarray | None = None,
+                                   n_resamples: int = DEFAULT_BOOTSTRAP_RESAMPLES,
+                                   confidence_level: float = 0.95,
+                                   seed: int = DEFAULT_BOOTSTRAP_SEED,
+                                   max_chunk_bytes: int = MAX_CHUNK_BYTES) -> tuple[np.ndarray, np.ndarray]:
+    """Percentile bootstrap confidence interval of the column-wise median of the first `n_rows` rows of `array`, for
+    the given `columns` (all of them by default). Returns the lower and upper bounds of the interval for each column.
+
+    The resamples are drawn at once from `seed` and are the same for all the columns, so the result does not depend on
+    the chunking. Each resample is represented by how many times it contains each row: the median of a resample is
+    then found by accumulating these counts over the rows sorted by value, which is done for all the resamples and a
+    chunk of columns at once, without gathering the resampled values."""
+    n_rows = len(array) if n_rows is None else min(n_rows, len(array))
+    columns = np.arange(array.shape[1]) if columns is None else np.asarray(columns)
+    resampled_rows = np.random.default_rng(seed).integers(0, n_rows, (n_resamples, n_rows))
+    counts_dtype = np.int16 if n_rows < 2**15 else np.int32
+    resampled_counts = np.stack([np.bincount(rows, minlength=n_rows) for rows in resampled_rows]).astype(counts_dtype)
+    # Ranks of the two middle values, which are the same for odd numbers of rows
+    lower_middle, upper_middle = (n_rows + 1) // 2, n_rows // 2 + 1
+    alpha = (1 - confidence_level) / 2
+    chunk_columns = max(1, max_chunk_bytes // max(1, 2 * resampled_counts.nbytes))
+    lower_bounds, upper_bounds = [], []
+    for start in range(0, len(columns), chunk_columns):
+        chunk_columns_indices = columns[start:start + chunk_columns]
+        chunk = np.asarray(array[:n_rows][:, chunk_columns_indices])
+        order = np.argsort(chunk, axis=0, kind="stable")
+        sorted_chunk = np.take_along_axis(chunk, order, axis=0)
+        # (n_resamples, n_columns, n_rows) counts of the resampled rows, sorted by value for each column
+        cumulative_counts = np.cumsum(resampled_counts[:, order.T], axis=-1, dtype=counts_dtype)
+        lower_ranks = (cumulative_counts < lower_middle).sum(axis=-1)
+        upper_ranks = (cumulative_counts < upper_middle).sum(axis=-1)
+        chunk_columns_range = np.arange(len(chunk_columns_indices))
+        resampled_medians = (sorted_chunk[lower_ranks, chunk_columns_range] +
+                             sorted_chunk[upper_ranks, chunk_columns_range]) / 2
+        lower_bound, upper_bound = np.quantile(resampled_medians, [alpha, 1 - alpha], axis=0)
+        lower_bounds.append(lower_bound)
+        upper_bounds.append(upper_bound)
+    return np.concatenate(lower_bounds), np.concatenate(upper_bounds)
+
+
+def batched_interp(x: np.ndarray, xp: np.ndarray, fp: np.ndarray) -> np.ndarray:
+    """Like `np.interp(x, xp[i], fp[i], left=np.nan, right=np.nan)` for each row `i` of `xp` and `fp`, with shape
+    (n_rows, len(x)), but with a single binary search over all the rows. The rows of `xp` must be non-decreasing."""
+    x, xp, fp = np.asarray(x, dtype=float), np.asarray(xp, dtype=float), np.asarray(fp, dtype=float)
+    n_rows, n_points = xp.shape
+    # Shift each row (and the points looked up in it) to a disjoint range, so that all the rows are sorted together
+    low = min(xp.min(), x.min())
+    width = max(xp.max(), x.max()) - low + 1
+    row_offsets = np.arange(n_rows)[:, None] * width
+    positions = np.searchsorted((xp - low + row_offsets).ravel(), x[None, :] - low + row_offsets, side="right")
+    upper = np.clip(positions - np.arange(n_rows)[:, None] * n_points, 1, n_points - 1)
+    lower = upper - 1
+    x0, x1 = np.take_along_axis(xp, lower, 1), np.take_along_axis(xp, upper, 1)
+    y0, y1 = np.take_along_axis(fp, lower, 1), np.take_along_axis(fp, upper, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        interpolated = np.where(x1 > x0, y0 + (x[None, :] - x0) / (x1 - x0) * (y1 - y0), y1)
+    out_of_range = (x[None, :] < xp[:, :1]) | (x[None, :] > xp[:, -1:])
+    return np.where(out_of_range, np.nan, interpolated)
+
+
+def median_distance_per_cost(median_total_queries: np.ndarray, median_distances: np.ndarray,
+                             bad_query_cost_ratios: Sequence[float], costs: Sequence[float]) -> np.ndarray:
+    """Median distance reached at each of the `costs` by each experiment, for each ratio between the cost of a bad
+    query and the one of any query. `median_total_queries` and `median_distances` are the (n_experiments, n_bad_queries)
+    median total number of queries and median best distance after each bad query. The cost of the k-th bad query is
+    the total number of queries plus k times the ratio, and the median cost is computed for all the experiments and
+    ratios at once. Returns an array with shape (n_experiments, n_ratios, n_costs), with nan for the costs that are not
+    covered by the experiment."""
+    n_experiments, n_bad_queries = median_total_queries.shape
+    ratios = np.asarray(bad_query_cost_ratios, dtype=float)
+    bad_queries = np.arange(1, n_bad_queries + 1)
+    median_costs = median_total_queries[:, None, :] + ratios[None, :, None] * bad_queries
+    distances = np.broadcast_to(median_distances[:, None, :], median_costs.shape)
+    per_cost = batched_interp(np.asarray(costs), median_costs.reshape(-1, n_bad_queries),
+                              distances.reshape(-1, n_bad_queries))
+    return per_cost.reshape(n_experiments, len(ratios), len(costs))
+
+
+def total_queries_at_bad_queries(unsafe_masks: Sequence[np.ndarray], n_bad_queries: int) -> np.ndarray:
+    """Total number of queries done when each of the first `n_bad_queries` bad queries is done, for a batch of samples
+    given as the masks of their unsafe queries. Returns an (n_samples, n_bad_queries) array, with nan after the last
+    bad query of each sample. The bad queries of all the samples are found at once on the concatenated masks."""
+    lengths = np.fromiter(map(len, unsafe_masks), dtype=np.int64, count=len(unsafe_masks))
+    starts = np.cumsum(lengths) - lengths
+    unsafe_positions = np.flatnonzero(np.concatenate(list(unsafe_masks) or [np.empty(0, dtype=bool)]))
+    sample_ids = np.searchsorted(starts, unsafe_positions, side="right") - 1
+    # Index of each bad query among the ones of its sample
+    first_bad_query_of_sample = np.searchsorted(sample_ids, np.arange(len(unsafe_masks)), side="left")
+    bad_query_indices = np.arange(len(unsafe_positions)) - first_bad_query_of_sample[sample_ids]
+    to_keep = bad_query_indices < n_bad_queries
+    total_queries = np.full((len(unsafe_masks), n_bad_queries), np.nan)
+    total_queries[sample_ids[to_keep], bad_query_indices[to_keep]] = (unsafe_positions[to_keep] + 1 -
+                                                                      starts[sample_ids[to_keep]])
+    return total_queries
+
+
+def extrapolate_rows(array: np.ndarray, last_k: int = 100) -> np.ndarray:
+    """Fills the nan tail of each row of `array` by extrapolating the linear regression of the last `last_k` values
+    before it, for all the rows at once. The rows with less than two values are left as they are."""
+    n_values = (~np.isnan(array)).sum(axis=1)
+    to_extrapolate = (n_values < array.shape[1]) & (n_values >= 2)
+    if not to_extrapolate.any():
+        return array
+    rows, n_values = array[to_extrapolate], n_values[to_extrapolate]
+    columns = np.arange(array.shape[1])
+    in_regression = (columns >= (n_values - last_k)[:, None]) & (columns < n_values[:, None])
+    n_points = in_regression.sum(axis=1)
+    x_mean = np.where(in_regression, columns, 0).sum(axis=1) / n_points
+    y_mean = np.where(in_regression, rows, 0).sum(axis=1) / n_points
+    x_centered = np.where(in_regression, columns - x_mean[:, None], 0)
+    slopes = (x_centered * np.where(in_regression, rows - y_mean[:, None], 0)).sum(axis=1) / (x_centered**2).sum(axis=1)
+    intercepts = y_mean - slopes * x_mean
+    extrapolated = columns * slopes[:, None] + intercepts[:, None]
+    array = array.copy()
+    array[to_extrapolate] = np.where(columns < n_values[:, None], rows, extrapolated)
+    return array
+
+
+def complete_tradeoff_arrays(total_queries: np.ndarray) -> np.ndarray:
+    """Extrapolates the output of `total_queries_at_bad_queries` to all the bad queries, and discards the samples with
+    too few bad queries for it."""
+    total_queries = extrapolate_rows(total_queries)
+    return total_queries[~np.isnan(total_queries).any(axis=1)]
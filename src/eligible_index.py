@@ -0,0 +1,96 @@
+import json
+from argparse import Namespace
+from pathlib import Path
+from typing import Iterator
+
+import torch
+import tqdm
+from torch.utils import data
+
+from src.model_wrappers import ModelWrapper
+
+ELIGIBLE_INDEX_VERSION = 2
+
+
+def get_eligible_index_path(eligible_index_dir: Path, args: Namespace) -> Path:
+    return eligible_index_dir / f"{args.dataset}_{args.model_backend}.json"
+
+
+def make_fingerprint(args: Namespace, data_fingerprint: dict[str, str | int]) -> dict:
+    """Describes the model and the data which determine which samples are eligible. The order in which the samples
+    are attacked is not part of it, as it is given by the data loader."""
+    model_fingerprint: dict[str, str | int | None] = {"model_backend": args.model_backend}
+    if args.model_backend == "quantized":
+        model_fingerprint["quantization_calibration_size"] = args.quantization_calibration_size
+    elif args.model_backend == "onnx":
+        model_fingerprint["onnx_model_path"] = args.onnx_model_path
+    # The strong preprocessing changes the labels predicted by the model
+    model_fingerprint["strong_preprocessing"] = args.strong_preprocessing
+    if args.strong_preprocessing == '1':
+        model_fingerprint["strong_preprocessing_jpeg_quality"] = args.strong_preprocessing_jpeg_quality
+        model_fingerprint["strong_preprocessing_resize"] = args.strong_preprocessing_resize
+    return {"version": ELIGIBLE_INDEX_VERSION, "data": data_fingerprint, "model": model_fingerprint}
+
+
+@torch.no_grad()
+def compute_eligible_indices(model: ModelWrapper,
+                             dataset: data.Dataset,
+                             device: torch.device,
+                             batch_size: int = 256,
+                             num_workers: int = 8) -> list[int]:
+    """Returns the indices of the samples of `dataset` which are correctly classified by `model` and, for binary
+    models, are positives, i.e., the samples that would be attacked."""
+    loader = data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    eligible_indices = []
+    start = 0
+    for batch in tqdm.tqdm(loader):
+        if isinstance(batch, dict):
+            x, y = batch["image"], batch["label"]
+        else:
+            x, y = batch
+        x, y = x.to(device), y.to(device)
+        eligible = model.predict_label(x) == y
+        if model.n_class == 2:
+            eligible = torch.logical_and(eligible, y != 0)
+        eligible_indices += (torch.nonzero(eligible).flatten().cpu() + start).tolist()
+        start += len(x)
+    model.num_queries = 0
+    return eligible_indices
+
+
+def save_eligible_index(path: Path, eligible_indices: list[int], fingerprint: dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w") as f:
+        json.dump({"fingerprint": fingerprint, "eligible_indices": eligible_indices}, f)
+
+
+def load_eligible_index(path: Path, fingerprint: dict) -> list[int] | None:
+    if not path.exists():
+        return None
+    with path.open("r") as f:
+        eligible_index = json.load(f)
+    if eligible_index["fingerprint"] != fingerprint:
+        return None
+    return eligible_index["eligible_indices"]
+
+
+class EligibleSampler(data.Sampler[int]):
+    """Yields only the eligible indices, in the same order as `base_sampler` yields them. Since `base_sampler` is
+    iterated as usual, it draws from the global RNG exactly as it would without filtering, and the samples are
+    attacked in the same order and with the same randomness.
+
+    `current_position` is the position of the last yielded index in the order of `base_sampler`."""
+
+    def __init__(self, base_sampler: data.Sampler[int], eligible_indices: list[int]) -> None:
+        self.base_sampler = base_sampler
+        self.eligible_indices = set(eligible_indices)
+        self.current_position = -1
+
+    def __iter__(self) -> Iterator[int]:
+        for position, index in enumerate(self.base_sampler):
+            if index in self.eligible_indices:
+                self.current_position = position
+                yield index
+
+    def __len__(self) -> int:
+        return len(self.eligible_indices)
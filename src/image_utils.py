@@ -1,11 +1,85 @@
 import io
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 import numpy as np
 import torch
 from PIL import Image
-from torchvision.transforms.functional import pil_to_tensor
 
 UPLOAD_FORMAT = 'png'
+# Formats for which an encode-decode round trip gives back exactly the uint8 image, so it can be skipped
+LOSSLESS_FORMATS = {'png', 'bmp', 'tiff'}
+
+
+def to_uint8(images: torch.Tensor) -> torch.Tensor:
+    """Rounds images in [0, 1] to the closest uint8 value, for a whole batch at once. uint8 images are returned as
+    they are."""
+    if images.dtype == torch.uint8:
+        return images
+    return torch.round(images * 255).clamp(0, 255).to(torch.uint8)
+
+
+def from_uint8(images: torch.Tensor) -> torch.Tensor:
+    return images.to(torch.float32) / 255
+
+
+def discretize(images: torch.Tensor) -> torch.Tensor:
+    """Rounds images to the closest point of the 1/255 grid, i.e., to what is left of them after saving them as
+    uint8, without leaving the device."""
+    if images.dtype == torch.uint8:
+        return images
+    return from_uint8(to_uint8(images)).to(images.dtype)
+
+
+def _encode_decode_array(array: np.ndarray, format: str, quality: int | None) -> np.ndarray:
+    with io.BytesIO() as buf:
+        array_to_buffer(array, buf, format, quality)
+        image = Image.open(buf, formats=[format])
+        image.load()
+        return np.asarray(image.convert('RGB'))
+
+
+def encode_decode_batch(images: torch.Tensor,
+                        format: str = UPLOAD_FORMAT,
+                        quality: int | None = None,
+                        executor: Executor | None = None) -> torch.Tensor:
+    """Simulates saving and loading a batch of images (N, C, H, W) in the given format. Lossless formats are
+    equivalent to rounding to uint8, so only lossy formats go through the codec, one image per `executor` task (PIL
+    releases the GIL while encoding and decoding). uint8 images are decoded to float32 ones."""
+    if len(images.size()) == 3:
+        return encode_decode_batch(images.unsqueeze(0), format, quality, executor).squeeze(0)
+    images_uint8 = to_uint8(images)
+    dtype = torch.float32 if images.dtype == torch.uint8 else images.dtype
+    if format in LOSSLESS_FORMATS:
+        return from_uint8(images_uint8).to(dtype)
+    arrays = images_uint8.permute(0, 2, 3, 1).cpu().numpy()
+    if executor is not None:
+        decoded_arrays = list(executor.map(lambda array: _encode_decode_array(array, format, quality), arrays))
+    else:
+        decoded_arrays = [_encode_decode_array(array, format, quality) for array in arrays]
+    decoded_images = torch.from_numpy(np.stack(decoded_arrays)).permute(0, 3, 1, 2).to(images.device)
+    return from_uint8(decoded_images).to(dtype)
+
+
+@dataclass
+class Codec:
+    """Encode-decode round trip applied to the batches of discrete attacks, e.g., to simulate the compression of an
+    API which re-encodes the uploaded images."""
+    format: str = UPLOAD_FORMAT
+    quality: int | None = None
+    max_workers: int | None = None
+    _executor: ThreadPoolExecutor | None = field(default=None, init=False, repr=False)
+
+    @property
+    def is_lossless(self) -> bool:
+        return self.format in LOSSLESS_FORMATS
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        if self.is_lossless:
+            return discretize(images)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return encode_decode_batch(images, self.format, self.quality, self._executor)
 
 
 def encode_decode(image: torch.Tensor, format=UPLOAD_FORMAT) -> torch.Tensor:
@@ -17,10 +91,7 @@ def encode_decode(image: torch.Tensor, format=UPLOAD_FORMAT) -> torch.Tensor:
 
 
 def to_from_pil(image):
-    pil_image = Image.fromarray(np.uint8(torch.round(image[0] * 255).cpu().numpy().transpose(1, 2, 0)))
-    np_image = (np.asarray(pil_image).astype(np.float32)).transpose(2, 0, 1)
-    converted_image = torch.from_numpy(np_image).to(image.device) / 255
-    return converted_image.unsqueeze(0)
+    return discretize(image[0]).unsqueeze(0)
 
 
 def buffer_to_torch(buf: io.BytesIO, device: torch.device, format=UPLOAD_FORMAT) -> torch.Tensor:
@@ -28,15 +99,19 @@ def buffer_to_torch(buf: io.BytesIO, device: torch.device, format=UPLOAD_FORMAT)
     image.load()
     np_image = (np.asarray(image).astype(np.float32)).transpose(2, 0, 1)
     torch_image = torch.from_numpy(np_image).to(device) / 255
-    assert torch.allclose(torch_image * 255, pil_to_tensor(image).to(device).to(torch.float), atol=1 / 256)
     return torch_image
 
 
-def torch_to_buffer(image: torch.Tensor, buf: io.BytesIO, format=UPLOAD_FORMAT) -> None:
-    pil_image = Image.fromarray(np.uint8(torch.round(image * 255).cpu().numpy().transpose(1, 2, 0)))
+def array_to_buffer(array: np.ndarray, buf: io.BytesIO, format=UPLOAD_FORMAT, quality: int | None = None) -> None:
+    pil_image = Image.fromarray(array)
     if format == 'png':
         pil_image.save(buf, format=format, compress_level=0, optimize=False)
+    elif quality is not None:
+        pil_image.save(buf, format=format, quality=quality)
     else:
         pil_image.save(buf, format=format)
-    # pil_image.save("test.png")
     buf.seek(0)
+
+
+def torch_to_buffer(image: torch.Tensor, buf: io.BytesIO, format=UPLOAD_FORMAT) -> None:
+    array_to_buffer(to_uint8(image).cpu().numpy().transpose(1, 2, 0), buf, format)
@@ -1,17 +1,25 @@
+import json
+import os
 from pathlib import Path
 from typing import Any
 
 import numpy as np
 import requests
 import tqdm
-from torchvision.datasets import ImageNet
+from torchvision.datasets import ImageNet, VisionDataset
+from torchvision.datasets.folder import default_loader
 
-from src.utils import sha256sum
+from src.utils import cached_sha256sum
 
 
 class ImageNetNSFW(ImageNet):
+    """ImageNet images with their NSFW label. If only the `top_k` NSFW images are needed, the ImageNet directory is
+    not scanned, as all the needed information is in the outputs file.
+
+    The outputs file is verified only when it changes, and unpacked to `.npy` files which are memory-mapped."""
 
     _BASE_FILENAME = "nsfw_imagenet_{split}_outputs.npz"
+    _UNPACKED_DIRNAME = "nsfw_imagenet_{split}_outputs"
     _ROOT_FILENAME = "nsfw_imagenet"
     _BASE_URL = "https://github.com/ethz-privsec/realistic-adv-examples/releases/download/{version}/{filename}"
     _VERSION = "v0.1"
@@ -29,7 +37,11 @@ class ImageNetNSFW(ImageNet):
                  split: str = "train",
                  only_positives: bool = True,
                  **kwargs: Any) -> None:
-        super().__init__(root, split, **kwargs)
+        scan_imagenet = top_k is None or not only_positives
+        if scan_imagenet:
+            super().__init__(root, split, **kwargs)
+        else:
+            self._init_without_scanning(root, split, **kwargs)
         self.nsfw_outputs_path = Path(root).parent / self._ROOT_FILENAME / self._BASE_FILENAME.format(split=split)
         if not self.nsfw_outputs_path.parent.exists():
             self.nsfw_outputs_path.parent.mkdir(parents=True)
@@ -37,33 +49,61 @@ class ImageNetNSFW(ImageNet):
         if not self.nsfw_outputs_path.exists():
             self._download_outputs()
 
-        if sha256sum(self.nsfw_outputs_path) != self._SHA256_HASHES[split]:
+        if cached_sha256sum(self.nsfw_outputs_path) != self._SHA256_HASHES[split]:
             raise ValueError("The SHA256 hash of downloaded file does not match expected hash.")
 
-        with np.load(self.nsfw_outputs_path, allow_pickle=False) as f:
-            nsfw_outputs = f["outputs"]
-            imgs = f["imgs"]
+        nsfw_outputs, imgs = self._load_unpacked_outputs()
         assert len(nsfw_outputs) == len(imgs)
-        assert len(nsfw_outputs) == len(self.samples)
+        if scan_imagenet:
+            assert len(nsfw_outputs) == len(self.samples)
         if top_k is not None:
             assert threshold is None, "Cannot specify both top_k and threshold"
-            imgs_to_keep = imgs[:top_k]
+            is_positive = np.arange(len(imgs)) < top_k
         else:
             assert threshold is not None, "Must specify either top_k or threshold"
-            imgs_to_keep = np.array(imgs)[nsfw_outputs >= threshold].tolist()
-        imgs_to_keep = list(map(lambda x: (x[0], 1), imgs_to_keep))
+            is_positive = nsfw_outputs >= threshold
 
-        if not only_positives:
-            if top_k is not None:
-                positives = imgs[top_k:]
-            else:
-                positives = np.array(imgs)[nsfw_outputs < threshold].tolist()
-            imgs_to_keep += list(map(lambda x: (x[0], 0), positives))
-
-        full_path_imgs_to_keep = list(map(lambda x: (str(Path(self.root) / split / x[0]), x[1]), imgs_to_keep))
+        if only_positives:
+            samples = self._make_samples(imgs, np.flatnonzero(is_positive), split, 1)
+        else:
+            samples = (self._make_samples(imgs, np.flatnonzero(is_positive), split, 1) +
+                       self._make_samples(imgs, np.flatnonzero(~is_positive), split, 0))
 
-        self.samples = full_path_imgs_to_keep
+        self.samples = samples
         self.imgs = self.samples
+        self.targets = [label for _, label in samples]
+
+    def _init_without_scanning(self, root: str, split: str, **kwargs: Any) -> None:
+        VisionDataset.__init__(self,
+                               os.path.expanduser(root),
+                               transform=kwargs.get("transform"),
+                               target_transform=kwargs.get("target_transform"))
+        self.split = split
+        self.loader = kwargs.get("loader", default_loader)
+
+    def _make_samples(self, imgs: np.ndarray, indices: np.ndarray, split: str, label: int) -> list[tuple[str, int]]:
+        # Equivalent to `str(Path(self.root) / split / filename)`, without creating a `Path` for each image
+        base_path = str(Path(self.root) / split)
+        return [(f"{base_path}/{filename}", label) for filename in imgs[indices, 0].tolist()]
+
+    def _load_unpacked_outputs(self) -> tuple[np.ndarray, np.ndarray]:
+        unpacked_dir = self.nsfw_outputs_path.parent / self._UNPACKED_DIRNAME.format(split=self.split)
+        source_path = unpacked_dir / "source.json"
+        source = {"sha256": self._SHA256_HASHES[self.split]}
+        is_unpacked = False
+        if source_path.exists():
+            with source_path.open("r") as f:
+                is_unpacked = json.load(f) == source
+        if not is_unpacked:
+            unpacked_dir.mkdir(exist_ok=True)
+            with np.load(self.nsfw_outputs_path, allow_pickle=False) as f:
+                np.save(unpacked_dir / "outputs.npy", f["outputs"])
+                np.save(unpacked_dir / "imgs.npy", f["imgs"])
+            with source_path.open("w") as f:
+                json.dump(source, f)
+        nsfw_outputs = np.load(unpacked_dir / "outputs.npy", mmap_mode="r")
+        imgs = np.load(unpacked_dir / "imgs.npy", mmap_mode="r")
+        return nsfw_outputs, imgs
 
     def _download_outputs(self) -> None:
         download_url = self._DOWNLOAD_URL.format(split=self.split)
@@ -1,10 +1,40 @@
 import abc
+import threading
 
 import torch
 from torch import nn
 
+from src.model_wrappers.strong_preprocessing import StrongPreprocessing
+
 MeanStdType = tuple[float, float, float] | None
 
+OUT_OF_MEMORY_MESSAGES = ("out of memory", "can't allocate memory", "failed to allocate memory")
+
+
+def is_out_of_memory_error(e: Exception) -> bool:
+    if isinstance(e, (torch.cuda.OutOfMemoryError, MemoryError)):
+        return True
+    message = str(e).lower()
+    return any(oom_message in message for oom_message in OUT_OF_MEMORY_MESSAGES)
+
+
+class QueriesInterrupted(Exception):
+    """Raised when the model is queried after its `interrupt` event is set."""
+
+
+def dequantize_and_normalize(image: torch.Tensor,
+                             im_mean: torch.Tensor | None,
+                             im_std: torch.Tensor | None,
+                             out: torch.Tensor | None = None) -> torch.Tensor:
+    """Computes `(image / 255 - im_mean) / im_std` for uint8 images with a single multiply-add, so that the
+    intermediate float images in [0, 1] are never materialized."""
+    image = image.to(torch.float32)
+    if im_mean is None or im_std is None:
+        return torch.mul(image, 1 / 255, out=out)  # type: ignore
+    scale = 1 / (255 * im_std)
+    bias = -im_mean / im_std
+    return torch.addcmul(bias, image, scale, out=out)  # type: ignore
+
 
 class ModelWrapper(nn.Module, metaclass=abc.ABCMeta):
 
@@ -15,10 +45,20 @@ class ModelWrapper(nn.Module, metaclass=abc.ABCMeta):
                  take_sigmoid: bool = True):
         super().__init__()
         self.num_queries = 0
-        self.im_mean = torch.Tensor(im_mean).view(1, 3, 1, 1).cuda() if im_mean is not None else None
-        self.im_std = torch.Tensor(im_std).view(1, 3, 1, 1).cuda() if im_std is not None else None
+        self.im_mean: torch.Tensor | None
+        self.im_std: torch.Tensor | None
+        self.register_buffer("im_mean", torch.Tensor(im_mean).view(1, 3, 1, 1) if im_mean is not None else None)
+        self.register_buffer("im_std", torch.Tensor(im_std).view(1, 3, 1, 1) if im_std is not None else None)
         self.n_class = n_class
         self.take_sigmoid = take_sigmoid
+        # Maximum number of images given to the model at once. If `None`, batches are given as they are, and it is
+        # set automatically if the model runs out of memory
+        self.micro_batch_size: int | None = None
+        # Applied to the queries before they are given to the model, to simulate the preprocessing of realistic APIs
+        self.strong_preprocessing: StrongPreprocessing | None = None
+        # If set, the following queries raise `QueriesInterrupted`, e.g., to stop an attack whose result is not needed
+        # anymore
+        self.interrupt: threading.Event | None = None
         if self.n_class == 2:
             print("Using binary predict label function")
             self.predict_label = self.predict_label_binary
@@ -30,19 +70,56 @@ class ModelWrapper(nn.Module, metaclass=abc.ABCMeta):
 
     @abc.abstractmethod
     def preprocess(self, image: torch.Tensor) -> torch.Tensor:
+        """Normalizes the images. Images can also be given as uint8 (e.g., by discrete attacks), in which case they
+        are dequantized in the same step."""
         ...
 
     @abc.abstractmethod
     def _predict_prob(self, image: torch.Tensor, verbose: bool = False) -> torch.Tensor:
         ...
 
+    def _predict_prob_with_strong_preprocessing(self, image: torch.Tensor) -> torch.Tensor:
+        if self.strong_preprocessing is not None:
+            image = self.strong_preprocessing(image)
+        return self._predict_prob(image)
+
+    def _predict_prob_in_micro_batches(self, image: torch.Tensor) -> torch.Tensor:
+        """Splits `image` in micro-batches of at most `micro_batch_size` images. If the model runs out of memory,
+        the micro-batch size is halved and the failed micro-batch is retried. The images are still queried in order,
+        and only the successful queries are counted. The strong preprocessing is applied to each micro-batch, so that
+        it is also retried if it runs out of memory."""
+        if self.interrupt is not None and self.interrupt.is_set():
+            raise QueriesInterrupted("The queries to the model were interrupted")
+        if len(image.size()) != 4:
+            return self._predict_prob_with_strong_preprocessing(image)
+        micro_batch_size = self.micro_batch_size or len(image)
+        outputs = []
+        start = 0
+        while start < len(image):
+            micro_batch = image[start:start + micro_batch_size]
+            try:
+                outputs.append(self._predict_prob_with_strong_preprocessing(micro_batch))
+            except Exception as e:
+                if not is_out_of_memory_error(e) or micro_batch_size == 1:
+                    raise
+                micro_batch_size = max(len(micro_batch) // 2, 1)
+                self.micro_batch_size = micro_batch_size
+                print(f"Model ran out of memory, reducing the micro-batch size to {micro_batch_size}")
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                continue
+            start += len(micro_batch)
+        if len(outputs) == 1:
+            return outputs[0]
+        return torch.cat(outputs)
+
     def predict_label_multiclass(self, image: torch.Tensor, verbose: bool = False) -> torch.Tensor:
-        logits = self._predict_prob(image)
+        logits = self._predict_prob_in_micro_batches(image)
         _, predict = torch.max(logits, 1)
         return predict
 
     def predict_label_binary(self, image: torch.Tensor, verbose: bool = False) -> torch.Tensor:
-        logits = self._predict_prob(image)
+        logits = self._predict_prob_in_micro_batches(image)
         if self.take_sigmoid:
             probs = torch.sigmoid(logits)
         else:
@@ -0,0 +1,127 @@
+from pathlib import Path
+
+import numpy as np
+import onnxruntime as ort
+import torch
+import torch.nn as nn
+
+from src.model_wrappers.general_model import MeanStdType, ModelWrapper, dequantize_and_normalize
+
+ONNX_INPUT_NAME = "image"
+ONNX_OUTPUT_NAME = "logits"
+ONNX_OPSET_VERSION = 17
+
+
+def export_onnx_model(model: nn.Module, path: Path, input_size: int = 224) -> None:
+    """Exports `model` (which takes normalized images as input) to ONNX, with a dynamic batch dimension."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    model = model.cpu().eval()
+    dummy_input = torch.zeros(1, 3, input_size, input_size)
+    with torch.no_grad():
+        torch.onnx.export(model,
+                          (dummy_input, ),
+                          str(path),
+                          input_names=[ONNX_INPUT_NAME],
+                          output_names=[ONNX_OUTPUT_NAME],
+                          dynamic_axes={
+                              ONNX_INPUT_NAME: {
+                                  0: "batch"
+                              },
+                              ONNX_OUTPUT_NAME: {
+                                  0: "batch"
+                              }
+                          },
+                          opset_version=ONNX_OPSET_VERSION)
+
+
+def make_session_options(intra_op_num_threads: int = 0, inter_op_num_threads: int = 0) -> ort.SessionOptions:
+    """0 threads means that ONNX Runtime picks the number of threads by itself."""
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    # The model is a single chain of big ops, so parallelism within ops is what matters
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = intra_op_num_threads
+    options.inter_op_num_threads = inter_op_num_threads
+    return options
+
+
+class OnnxModelWrapper(ModelWrapper):
+    """Runs an exported model with ONNX Runtime.
+
+    Inputs are normalized directly into a pre-allocated buffer which is bound to the session (together with the
+    output buffer) via I/O binding, so that no copies are made between torch and ONNX Runtime. The buffers are
+    re-allocated only when a larger batch than any previous one is queried."""
+
+    def __init__(self,
+                 model_path: Path,
+                 n_class: int = 10,
+                 im_mean: MeanStdType = None,
+                 im_std: MeanStdType = None,
+                 take_sigmoid: bool = True,
+                 intra_op_num_threads: int = 0,
+                 inter_op_num_threads: int = 0,
+                 device: torch.device = torch.device("cpu")):
+        super().__init__(n_class, im_mean, im_std, take_sigmoid)
+        if not model_path.exists():
+            raise FileNotFoundError(f"ONNX model not found in {model_path}, export it with `scripts/export_onnx.py`")
+        self.device = device
+        if device.type == "cuda":
+            providers = [("CUDAExecutionProvider", {"device_id": device.index or 0})]
+        else:
+            providers = ["CPUExecutionProvider"]
+        self._session = ort.InferenceSession(str(model_path),
+                                             make_session_options(intra_op_num_threads, inter_op_num_threads),
+                                             providers=providers)
+        self._io_binding = self._session.io_binding()
+        self._n_outputs = self._session.get_outputs()[0].shape[1]
+        self._input_buffer = torch.empty(0, device=device)
+        self._output_buffer = torch.empty(0, device=device)
+
+    def preprocess(self, image: torch.Tensor) -> torch.Tensor:
+        if image.dtype == torch.uint8:
+            return dequantize_and_normalize(image, self.im_mean, self.im_std)
+        processed = image
+        if self.im_mean is not None and self.im_std is not None:
+            processed = (image - self.im_mean) / self.im_std
+        return processed
+
+    def _get_buffers(self, image: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        batch_size = image.size(0)
+        if self._input_buffer.size(0) < batch_size or self._input_buffer.shape[1:] != image.shape[1:]:
+            self._input_buffer = torch.empty(image.shape, dtype=torch.float32, device=self.device)
+            self._output_buffer = torch.empty((batch_size, self._n_outputs), dtype=torch.float32, device=self.device)
+        return self._input_buffer[:batch_size], self._output_buffer[:batch_size]
+
+    def _preprocess_into(self, image: torch.Tensor, out: torch.Tensor) -> None:
+        if image.dtype == torch.uint8:
+            # The uint8 images are copied to the device before being converted, which moves 4x less data
+            dequantize_and_normalize(image.to(self.device), self.im_mean, self.im_std, out=out)
+            return
+        image = image.to(self.device, torch.float32)
+        if self.im_mean is not None and self.im_std is not None:
+            torch.sub(image, self.im_mean, out=out).div_(self.im_std)
+        else:
+            out.copy_(image)
+
+    def _run(self, image: torch.Tensor) -> torch.Tensor:
+        if len(image.size()) != 4:
+            image = image.unsqueeze(0)
+        input_buffer, output_buffer = self._get_buffers(image)
+        self._preprocess_into(image, input_buffer)
+        device_type = "cuda" if self.device.type == "cuda" else "cpu"
+        device_id = self.device.index or 0
+        self._io_binding.bind_input(ONNX_INPUT_NAME, device_type, device_id, np.float32, tuple(input_buffer.shape),
+                                    input_buffer.data_ptr())
+        self._io_binding.bind_output(ONNX_OUTPUT_NAME, device_type, device_id, np.float32,
+                                     tuple(output_buffer.shape), output_buffer.data_ptr())
+        self._session.run_with_iobinding(self._io_binding)
+        # The output buffer is re-used by the next query, so it must be copied
+        return output_buffer.clone().to(image.device)
+
+    def forward(self, image: torch.Tensor) -> torch.Tensor:  # type: ignore
+        return self._run(image)
+
+    def _predict_prob(self, image: torch.Tensor, verbose: bool = False) -> torch.Tensor:
+        logits = self._run(image)
+        self.num_queries += logits.size(0)
+        return logits
@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import torch
+import torch.nn.functional as F
+
+from src.image_utils import encode_decode_batch, from_uint8
+
+# Ratio between the crop and the resize size used by default, as in the standard ImageNet preprocessing (224 / 256)
+DEFAULT_CROP_RATIO = 0.875
+
+
+def resize(images: torch.Tensor, size: int) -> torch.Tensor:
+    """Resizes a batch of images (N, C, H, W) so that their smaller side is `size`, keeping the aspect ratio."""
+    height, width = images.shape[-2:]
+    if min(height, width) == size:
+        return images
+    if height <= width:
+        new_size = (size, int(size * width / height))
+    else:
+        new_size = (int(size * height / width), size)
+    resized = F.interpolate(images, size=new_size, mode="bilinear", align_corners=False, antialias=True)
+    return resized.clamp(0, 1)
+
+
+def center_crop(images: torch.Tensor, size: int) -> torch.Tensor:
+    height, width = images.shape[-2:]
+    if size > min(height, width):
+        raise ValueError(f"Cannot crop images of size {height}x{width} to {size}x{size}")
+    top = int(round((height - size) / 2.))
+    left = int(round((width - size) / 2.))
+    return images[..., top:top + size, left:left + size]
+
+
+@dataclass
+class StrongPreprocessing:
+    """Preprocessing applied by realistic APIs to the uploaded images before classifying them: JPEG compression,
+    resizing to `resize_size` and center-cropping to `crop_size`. By default, images are cropped back to the size of
+    the input, after resizing them to that size / `DEFAULT_CROP_RATIO`.
+
+    Batches are processed at once: JPEG compression runs one image per thread (libjpeg releases the GIL), and resizing
+    and cropping are tensor operations, so that the result is the same as processing each image on its own."""
+    jpeg_quality: int | None = 75
+    resize_size: int | None = None
+    crop_size: int | None = None
+    max_workers: int | None = None
+    _executor: ThreadPoolExecutor | None = field(default=None, init=False, repr=False)
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        if len(images.size()) != 4:
+            return self(images.unsqueeze(0)).squeeze(0)
+        crop_size = self.crop_size or images.size(-1)
+        if self.jpeg_quality is not None:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            images = encode_decode_batch(images, "jpeg", self.jpeg_quality, self._executor)
+        elif images.dtype == torch.uint8:
+            images = from_uint8(images)
+        images = resize(images, self.resize_size or int(crop_size / DEFAULT_CROP_RATIO))
+        return center_crop(images, crop_size)
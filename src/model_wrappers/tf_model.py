@@ -1,10 +1,24 @@
 import tensorflow as tf
 import torch
+from torch.utils import dlpack as torch_dlpack
 
+from src.image_utils import from_uint8
 from src.model_wrappers.general_model import MeanStdType, ModelWrapper
 
 
+def torch_to_tf(tensor: torch.Tensor) -> tf.Tensor:
+    """Shares the memory of `tensor` with the returned TF tensor, without copies or device transfers."""
+    return tf.experimental.dlpack.from_dlpack(torch_dlpack.to_dlpack(tensor.contiguous()))
+
+
+def tf_to_torch(tensor: tf.Tensor) -> torch.Tensor:
+    """Shares the memory of `tensor` with the returned torch tensor, without copies or device transfers."""
+    return torch_dlpack.from_dlpack(tf.experimental.dlpack.to_dlpack(tensor))
+
+
 class TFModelWrapper(ModelWrapper):
+    """Wraps a Keras model. Images are exchanged with TF via DLPack in both directions, and the preprocessing
+    (i.e., the permutation to channels last and the normalization) is done in the same TF graph as the model."""
 
     def __init__(self,
                  model: tf.keras.Model,
@@ -13,31 +27,45 @@ class TFModelWrapper(ModelWrapper):
                  im_std: MeanStdType = None,
                  take_sigmoid: bool = True,
                  channels_last: bool = False):
-        self._model = model
         super().__init__(n_class, im_mean, im_std, take_sigmoid)
+        self._model = model
         self.channels_last = channels_last
+        stats_shape = (1, 1, 1, 3) if channels_last else (1, 3, 1, 1)
+        self._tf_mean = tf.reshape(tf.constant(im_mean, tf.float32), stats_shape) if im_mean is not None else None
+        self._tf_std = tf.reshape(tf.constant(im_std, tf.float32), stats_shape) if im_std is not None else None
+        self._tf_predict = tf.function(self._tf_preprocess_and_predict,
+                                       input_signature=[tf.TensorSpec([None, 3, None, None], tf.float32)])
+
+    def _tf_preprocess_and_predict(self, image: tf.Tensor) -> tf.Tensor:
+        if self.channels_last:
+            image = tf.transpose(image, (0, 2, 3, 1))
+        if self._tf_mean is not None and self._tf_std is not None:
+            image = (image - self._tf_mean) / self._tf_std
+        return self._model(image, training=False)
 
     def preprocess(self, image: torch.Tensor) -> torch.Tensor:
+        processed = from_uint8(image) if image.dtype == torch.uint8 else image
+        im_mean, im_std = self.im_mean, self.im_std
         if self.channels_last:
-            processed = image.permute(0, 2, 3, 1)
-        else:
-            processed = image
-        if self.im_mean is not None and self.im_std is not None:
-            processed = (image - self.im_mean) / self.im_std
+            processed = processed.permute(0, 2, 3, 1)
+            if im_mean is not None and im_std is not None:
+                im_mean, im_std = im_mean.permute(0, 2, 3, 1), im_std.permute(0, 2, 3, 1)
+        if im_mean is not None and im_std is not None:
+            processed = (processed - im_mean) / im_std
         return processed
 
-    def forward(self, image: torch.Tensor) -> torch.Tensor:  # type: ignore
+    def _run(self, image: torch.Tensor) -> torch.Tensor:
         if len(image.size()) != 4:
             image = image.unsqueeze(0)
-        image_tf = tf.constant(image.cpu())
-        logits = self._model(image_tf).numpy()
-        return torch.from_numpy(logits).cuda()
+        if image.dtype == torch.uint8:
+            image = from_uint8(image)
+        logits = tf_to_torch(self._tf_predict(torch_to_tf(image.to(torch.float32))))
+        return logits.to(image.device)
+
+    def forward(self, image: torch.Tensor) -> torch.Tensor:  # type: ignore
+        return self._run(image)
 
     def _predict_prob(self, image: torch.Tensor, verbose=False) -> torch.Tensor:
-        if len(image.size()) != 4:
-            image = image.unsqueeze(0)
-        image = self.preprocess(image)
-        image_tf = tf.constant(image.cpu())
-        logits = self._model(image_tf).numpy()
-        self.num_queries += image.size(0)
-        return torch.from_numpy(logits).cuda()
+        logits = self._run(image)
+        self.num_queries += logits.size(0)
+        return logits
@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 
-from src.model_wrappers.general_model import MeanStdType, ModelWrapper
+from src.model_wrappers.general_model import MeanStdType, ModelWrapper, dequantize_and_normalize
 
 
 class TorchModelWrapper(ModelWrapper):
@@ -15,6 +15,10 @@ class TorchModelWrapper(ModelWrapper):
         super().__init__(n_class, im_mean, im_std, take_sigmoid)
         self._model = model
 
+    @property
+    def inner_model(self) -> nn.Module:
+        return self._model
+
     def make_model_eval(self):
         self._model.eval()
 
@@ -26,6 +30,8 @@ class TorchModelWrapper(ModelWrapper):
         return logits
 
     def preprocess(self, image: torch.Tensor) -> torch.Tensor:
+        if image.dtype == torch.uint8:
+            return dequantize_and_normalize(image, self.im_mean, self.im_std)
         processed = image
         if self.im_mean is not None and self.im_std is not None:
             processed = (image - self.im_mean) / self.im_std
@@ -0,0 +1,157 @@
+import copy
+import json
+from enum import Enum
+from pathlib import Path
+
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.utils import data
+
+from src.model_wrappers import TorchModelWrapper
+
+DEFAULT_QUANTIZED_CHECKPOINTS_DIR = Path("checkpoints/quantized")
+CALIBRATION_SEED = 0
+CALIBRATION_BATCH_SIZE = 32
+
+
+class QuantizationMode(str, Enum):
+    # Static int8 quantization of weights and activations, calibrated on the dataset (CNNs)
+    static = "static"
+    # Dynamic int8 quantization of the linear layers only (transformers, which cannot be FX-traced)
+    dynamic = "dynamic"
+
+
+def _mean_std_to_tuple(t: torch.Tensor | None) -> tuple[float, float, float] | None:
+    if t is None:
+        return None
+    mean_or_std = t.flatten().tolist()
+    return mean_or_std[0], mean_or_std[1], mean_or_std[2]
+
+
+def get_calibration_images(dataset: data.Dataset,
+                           n_images: int,
+                           offset: int = 0,
+                           seed: int = CALIBRATION_SEED) -> torch.Tensor:
+    """Loads `n_images` images from `dataset`, in a random order which is fixed by `seed`.
+
+    A local generator is used (also by the data loader, which otherwise draws its base seed from the global RNG)
+    so that the global RNG state, and hence the order in which samples are attacked, is not affected."""
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randperm(len(dataset), generator=generator)[offset:offset + n_images]  # type: ignore
+    loader = data.DataLoader(data.Subset(dataset, indices.tolist()),
+                             batch_size=CALIBRATION_BATCH_SIZE,
+                             generator=generator)
+    images = []
+    for batch in loader:
+        images.append(batch["image"] if isinstance(batch, dict) else batch[0])
+    return torch.cat(images)
+
+
+def quantize_module(model: nn.Module, calibration_inputs: torch.Tensor, mode: QuantizationMode) -> nn.Module:
+    """Returns an int8 version of `model`, which only runs on CPU. `calibration_inputs` must already be
+    preprocessed (i.e., normalized) as the inputs that will be given to the model."""
+    model = copy.deepcopy(model).cpu().eval()
+    if mode == QuantizationMode.dynamic:
+        return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    prepared_model = prepare_fx(model, qconfig_mapping, (calibration_inputs[:1], ))
+    with torch.no_grad():
+        for batch in calibration_inputs.split(CALIBRATION_BATCH_SIZE):
+            prepared_model(batch)
+    return convert_fx(prepared_model)
+
+
+def compute_label_agreement(float_model: TorchModelWrapper, quantized_model: TorchModelWrapper,
+                            images: torch.Tensor) -> dict[str, float | int]:
+    float_labels = torch.cat([float_model.predict_label(batch) for batch in images.split(CALIBRATION_BATCH_SIZE)])
+    quantized_labels = torch.cat(
+        [quantized_model.predict_label(batch) for batch in images.split(CALIBRATION_BATCH_SIZE)])
+    agreements = (float_labels.cpu() == quantized_labels.cpu())
+    return {
+        "n_images": len(images),
+        "agreement": agreements.to(torch.float).mean().item(),
+        "n_disagreements": int(torch.logical_not(agreements).sum().item()),
+    }
+
+
+def _make_fingerprint(name: str, mode: QuantizationMode, n_calibration_images: int) -> dict[str, str | int]:
+    return {
+        "name": name,
+        "mode": mode.value,
+        "n_calibration_images": n_calibration_images,
+        "calibration_seed": CALIBRATION_SEED,
+        "engine": torch.backends.quantized.engine,
+        "torch_version": torch.__version__,
+    }
+
+
+def _save_quantized_module(module: nn.Module, path: Path, mode: QuantizationMode, example_input: torch.Tensor):
+    if mode == QuantizationMode.dynamic:
+        torch.save(module.state_dict(), path)
+    else:
+        with torch.no_grad():
+            torch.jit.save(torch.jit.trace(module, example_input), str(path))
+
+
+def _load_quantized_module(float_module: nn.Module, path: Path, mode: QuantizationMode) -> nn.Module:
+    if mode == QuantizationMode.dynamic:
+        module = quantize_dynamic(copy.deepcopy(float_module).cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+        module.load_state_dict(torch.load(path))
+        return module
+    return torch.jit.load(str(path))
+
+
+def quantize_model_wrapper(model: TorchModelWrapper,
+                           dataset: data.Dataset,
+                           name: str,
+                           mode: QuantizationMode,
+                           n_calibration_images: int,
+                           cache_dir: Path = DEFAULT_QUANTIZED_CHECKPOINTS_DIR) -> TorchModelWrapper:
+    """Returns a CPU int8 version of `model`, together with (and printing) a report of the agreement of its
+    predicted labels with the ones of the float model on `n_calibration_images` held-out images.
+
+    The quantized model and the report are cached in `cache_dir`, and re-used as long as the
+    quantization settings do not change."""
+    float_module = model.inner_model
+    if isinstance(float_module, nn.DataParallel):
+        float_module = float_module.module
+    module_path = cache_dir / f"{name}_int8_{mode.value}.pt"
+    report_path = cache_dir / f"{name}_int8_{mode.value}.json"
+    fingerprint = _make_fingerprint(name, mode, n_calibration_images)
+
+    report = None
+    if module_path.exists() and report_path.exists():
+        with report_path.open("r") as f:
+            report = json.load(f)
+        if report["fingerprint"] != fingerprint:
+            print(f"Quantized model in {module_path} is outdated, re-quantizing it")
+            report = None
+
+    if report is None:
+        print(f"Quantizing model with {mode.value} quantization, calibrating on {n_calibration_images} images")
+        calibration_images = get_calibration_images(dataset, n_calibration_images)
+        quantized_module = quantize_module(float_module, model.preprocess(calibration_images), mode)
+        quantized_model = TorchModelWrapper(quantized_module, model.n_class, _mean_std_to_tuple(model.im_mean),
+                                            _mean_std_to_tuple(model.im_std), model.take_sigmoid)
+        held_out_images = get_calibration_images(dataset, n_calibration_images, offset=n_calibration_images)
+        agreement = compute_label_agreement(model, quantized_model, held_out_images)
+        report = {"fingerprint": fingerprint, "label_agreement": agreement}
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        _save_quantized_module(quantized_module, module_path, mode, model.preprocess(calibration_images[:1]))
+        with report_path.open("w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Saved quantized model to {module_path}")
+    else:
+        print(f"Loading quantized model from {module_path}")
+        quantized_module = _load_quantized_module(float_module, module_path, mode)
+        quantized_model = TorchModelWrapper(quantized_module, model.n_class, _mean_std_to_tuple(model.im_mean),
+                                            _mean_std_to_tuple(model.im_std), model.take_sigmoid)
+
+    agreement = report["label_agreement"]
+    print(f"Quantized model agrees with the float model on {agreement['agreement'] * 100:.2f}% of "
+          f"{agreement['n_images']} held-out images ({agreement['n_disagreements']} disagreements)")
+    quantized_model.make_model_eval()
+    quantized_model.num_queries = 0
+    return quantized_model
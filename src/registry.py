@@ -0,0 +1,450 @@
+"""Registry of the attacks and of the models that can be run with `main.py`.
+
+Each attack declares its command line arguments and a factory which creates it from the parsed arguments, and each
+model declares how to wrap it and a factory for the model and for the test data. The factories import the attacks,
+the models and their dependencies only when they are called, so that only what is needed for a run is imported."""
+import dataclasses
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable
+
+from src.attacks.base import SearchMode
+
+if TYPE_CHECKING:
+    from torch import nn
+    from torch.utils import data
+
+    from src.attacks.base import BaseAttack
+
+
+@dataclasses.dataclass(frozen=True)
+class Argument:
+    flag: str
+    kwargs: dict[str, Any]
+
+    def add_to(self, parser: ArgumentParser) -> None:
+        parser.add_argument(self.flag, **self.kwargs)
+
+
+AttackFactory = Callable[[Namespace, dict[str, Any]], "BaseAttack"]
+
+
+@dataclasses.dataclass(frozen=True)
+class AttackSpec:
+    # Creates the attack from the parsed arguments and from the arguments which are common to all attacks
+    factory: AttackFactory
+    arguments: tuple[Argument, ...] = ()
+
+
+@dataclasses.dataclass(frozen=True)
+class ModelSpec:
+    wrapper_kwargs: dict[str, Any]
+    # Returns the (unwrapped) model
+    load_inner_model: Callable[[], "nn.Module"]
+    # Takes the batch size, the data directory and the sample cache directory
+    load_test_data: Callable[[int, str, Path | None], "data.DataLoader"]
+    quantization_mode: str = "static"
+    data_parallel: bool = True
+
+
+ATTACKS: dict[str, AttackSpec] = {}
+MODELS: dict[str, ModelSpec] = {}
+
+
+def register_attack(name: str, arguments: tuple[Argument, ...] = ()) -> Callable[[AttackFactory], AttackFactory]:
+
+    def decorator(factory: AttackFactory) -> AttackFactory:
+        ATTACKS[name] = AttackSpec(factory, arguments)
+        return factory
+
+    return decorator
+
+
+def add_attack_arguments(parser: ArgumentParser) -> None:
+    """Adds the arguments of all the attacks to `parser`. Arguments shared by several attacks are added once."""
+    added_flags = set()
+    for spec in ATTACKS.values():
+        for argument in spec.arguments:
+            if argument.flag not in added_flags:
+                argument.add_to(parser)
+                added_flags.add(argument.flag)
+
+
+def get_attack_spec(name: str) -> AttackSpec:
+    if name not in ATTACKS:
+        raise ValueError(f"Invalid attack: `{name}`")
+    return ATTACKS[name]
+
+
+def get_model_spec(name: str) -> ModelSpec:
+    if name not in MODELS:
+        raise ValueError("Invalid model")
+    return MODELS[name]
+
+
+RAYS_ARGUMENTS = (
+    Argument('--rays-flip-squares', {
+        'default': '0',
+        'type': str,
+        'help': 'Whether the attack should flip squares and not chunks of a 1-d vector'
+    }),
+    Argument('--rays-flip-rand-pixels', {
+        'default': '0',
+        'type': str,
+        'help': 'Whether the attack should flip random pixels not chunks of a 1-d vector'
+    }),
+)
+
+
+@register_attack("rays", RAYS_ARGUMENTS)
+def make_rays(args: Namespace, base_attack_kwargs: dict[str, Any]) -> "BaseAttack":
+    from src.attacks.rays import RayS
+    if args.rays_flip_squares == '1' and args.rays_flip_rand_pixels == '1':
+        raise ValueError("`--flip-squares` cannot be `1` if also `--flip-rand-pixels` is `1`")
+    attack_kwargs = {
+        "early_stopping": args.early == '1',
+        "search": SearchMode(args.search),
+        "line_search_tol": args.line_search_tol,
+        "flip_squares": args.rays_flip_squares == '1',
+        "flip_rand_pixels": args.rays_flip_rand_pixels == '1'
+    }
+    return RayS(**base_attack_kwargs, **attack_kwargs)
+
+
+HSJA_ARGUMENTS = (
+    Argument('--hsja-stepsize-search', {
+        'default': 'geometric_progression',
+        'type': str,
+        'help': 'Stepsize search for HSJA'
+    }),
+    Argument('--hsja-max-num-evals', {
+        'default': 1e4,
+        'type': int,
+        'help': 'Max number of evaluations for HSJA'
+    }),
+    Argument('--hsja-init-num-evals', {
+        'default': 100,
+        'type': int,
+        'help': 'Max number of evaluations for HSJA'
+    }),
+    Argument('--hsja-gamma', {
+        'default': 10_000,
+        'type': float,
+        'help': 'gamma parameter for HSJA (used for the binary search threshold)'
+    }),
+    Argument(
+        '--hsja-delta', {
+            'default': None,
+            'type': float,
+            'help': 'Whether to use a fixed delta for gradient estimation in HSJA, '
+                    'an adaptive delta is used if this is None'
+        }),
+    Argument('--hsja-grad-est-mode', {
+        'default': 'hsja',
+        'type': str,
+        'help': 'Gradient estimation mode for HSJA, one of `hsja`, `opt` or `sign_opt`'
+    }),
+    Argument('--hsja-n-searches', {
+        'default': 2,
+        'type': int,
+        'help': 'Number of searches of the HSJA line searches. Each search refines the step size of the previous one'
+    }),
+    Argument(
+        '--hsja-bias-coef', {
+            'default': 0.0,
+            'type': float,
+            'help': 'bias coefficient for HSJA (used to move boundary point farther before gradient estimation.)'
+        }),
+    Argument('--hsja-lower-bad-query-bound', {
+        'default': 10,
+        'type': int,
+        'help': 'desired lower bound on the number of bad queries in the gradient esitmation phase.'
+    }),
+    Argument('--hsja-upper-bad-query-bound', {
+        'default': 20,
+        'type': int,
+        'help': 'desired upper bound on the number of bad queries in the gradient esitmation phase.'
+    }),
+    Argument('--hsja-bias-coef-change-rate', {
+        'default': 0.1,
+        'type': float,
+        'help': 'used to change the bias coefficient adaptively.'
+    }),
+)
+
+
+@register_attack("hsja", HSJA_ARGUMENTS)
+def make_hsja(args: Namespace, base_attack_kwargs: dict[str, Any]) -> "BaseAttack":
+    from src.attacks.hsja import HSJA, GradientEstimationMode
+    attack_kwargs = {
+        "num_iterations": args.max_iter,
+        "stepsize_search": args.hsja_stepsize_search,
+        "max_num_evals": args.hsja_max_num_evals,
+        "init_num_evals": args.hsja_init_num_evals,
+        "gamma": args.hsja_gamma,
+        "fixed_delta": args.hsja_delta,
+        "gradient_estimation_mode": GradientEstimationMode(args.hsja_grad_est_mode),
+        "search": SearchMode(args.search),
+        "n_searches": args.hsja_n_searches,
+        "bias_coef": args.hsja_bias_coef,
+        'lower_bad_query_bound': args.hsja_lower_bad_query_bound,
+        'upper_bad_query_bound': args.hsja_upper_bad_query_bound,
+        'bias_coef_change_rate': args.hsja_bias_coef_change_rate
+    }
+    return HSJA(**base_attack_kwargs, **attack_kwargs)
+
+
+GEODA_ARGUMENTS = (
+    Argument('--geoda-n-searches', {
+        'default': 2,
+        'type': int,
+        'help': 'Number of searches of the GeoDA line searches. Each search refines the step size of the previous one'
+    }),
+    Argument('--geoda-theta', {
+        'default': 1e-4,
+        'type': float,
+        'help': 'Theta parameter for GeoDA'
+    }),
+    Argument('--geoda-delta', {
+        'default': 2e-4,
+        'type': float,
+        'help': 'Delta parameter for GeoDA'
+    }),
+    Argument('--geoda-max-num-evals', {
+        'default': 1e4,
+        'type': int,
+        'help': 'Max number of evaluations for GeoDA'
+    }),
+    Argument('--geoda-init-num-evals', {
+        'default': 100,
+        'type': int,
+        'help': 'GeoDA init num evals'
+    }),
+    Argument(
+        '--geoda-bias-coef', {
+            'default': 0.0,
+            'type': float,
+            'help': 'bias coefficient for GeoDA (used to move boundary point further before gradient estimation.)'
+        }),
+    Argument('--geoda-lower-bad-query-bound', {
+        'default': 10,
+        'type': int,
+        'help': 'desired lower bound on the number of bad queries in the gradient esitmation phase.'
+    }),
+    Argument('--geoda-upper-bad-query-bound', {
+        'default': 20,
+        'type': int,
+        'help': 'desired upper bound on the number of bad queries in the gradient esitmation phase.'
+    }),
+    Argument('--geoda-bias-coef-change-rate', {
+        'default': 0.1,
+        'type': float,
+        'help': 'used to change the bias coefficient adaptively.'
+    }),
+    Argument('--geoda-dim-reduc-factor', {
+        'default': 1e0,
+        'type': float,
+        'help': 'Dimension reduciton factor for creating subspace in GeoDA'
+    }),
+    Argument('--geoda-search-radius-increase', {
+        'default': 1.1,
+        'type': float,
+        'help': 'Multiplier used to increase search radius'
+    }),
+)
+
+
+@register_attack("geoda", GEODA_ARGUMENTS)
+def make_geoda(args: Namespace, base_attack_kwargs: dict[str, Any]) -> "BaseAttack":
+    from src.attacks.geoda import GeoDA
+    attack_kwargs = {
+        "num_iterations": args.max_iter,
+        "max_num_evals": args.geoda_max_num_evals,
+        "init_num_evals": args.geoda_init_num_evals,
+        "theta": args.geoda_theta,
+        "delta": args.geoda_delta,
+        "search": SearchMode(args.search),
+        "n_searches": args.geoda_n_searches,
+        "bias_coef": args.geoda_bias_coef,
+        'lower_bad_query_bound': args.geoda_lower_bad_query_bound,
+        'upper_bad_query_bound': args.geoda_upper_bad_query_bound,
+        'bias_coef_change_rate': args.geoda_bias_coef_change_rate,
+        "dim_reduc_factor": args.geoda_dim_reduc_factor,
+        "search_radius_increase": args.geoda_search_radius_increase
+    }
+    return GeoDA(**base_attack_kwargs, **attack_kwargs)
+
+
+OPT_ARGUMENTS = (
+    Argument('--opt-alpha', {
+        'default': 0.2,
+        'type': float,
+        'help': 'alpha parameter for OPT and Sign OPT'
+    }),
+    Argument('--opt-beta', {
+        'default': 0.01,
+        'type': float,
+        'help': 'beta parameter for OPT and Sign OPT'
+    }),
+    Argument(
+        '--opt-grad-est-search', {
+            'default': None,
+            'type': str,
+            'help': 'What search should be used for gradient estimation in OPT. Default is what it specified with '
+                    '--search'
+        }),
+    Argument(
+        '--opt-step-size-search', {
+            'default': None,
+            'type': str,
+            'help': 'What search should be used for step size search in OPT. Default is what it specified with '
+                    '--search'
+        }),
+    Argument('--opt-line-search-overshoot', {
+        'default': 2.5,
+        'type': float,
+        'help': 'Line search overshoot for OPT and Sign OPT'
+    }),
+    Argument('--opt-n-searches', {
+        'default': 2,
+        'type': int,
+        'help': 'Number of searches for OPT and Sign OPT. Each search refines the step size of the previous one'
+    }),
+    Argument('--opt-max-search-steps', {
+        'default': 10_000,
+        'type': int,
+        'help': 'Max number of line search steps for OPT and Sign OPT'
+    }),
+    Argument('--opt-bs', {
+        'default': 100,
+        'type': int,
+        'help': 'Batch size for for OPT and Sign OPT'
+    }),
+    Argument('--opt-num-grad-queries', {
+        'default': 10,
+        'type': int,
+        'help': 'Number of gradient queries for OPT'
+    }),
+    Argument('--opt-num-init-directions', {
+        'default': 100,
+        'type': int,
+        'help': 'Number of init directions OPT'
+    }),
+    Argument('--opt-get-one-init-direction', {
+        'default': '0',
+        'type': str,
+        'help': 'Whether OPT should stop when it finds one good initial direction'
+    }),
+)
+
+
+def _make_opt_kwargs(args: Namespace) -> dict[str, Any]:
+    search = SearchMode(args.search)
+    opt_grad_estimation_search = (SearchMode(args.opt_grad_est_search)
+                                  if args.opt_grad_est_search is not None else search)
+    opt_step_size_search = SearchMode(args.opt_step_size_search) if args.opt_step_size_search is not None else search
+    return {
+        "max_iter": args.max_iter,
+        "alpha": args.opt_alpha,
+        "beta": args.opt_beta,
+        "search": search,
+        "grad_estimation_search": opt_grad_estimation_search,
+        "step_size_search": opt_step_size_search,
+        "n_searches": args.opt_n_searches,
+        "max_search_steps": args.opt_max_search_steps,
+        "batch_size": args.opt_bs,
+        "num_grad_queries": args.opt_num_grad_queries,
+        "num_init_directions": args.opt_num_init_directions,
+        "get_one_init_direction": args.opt_get_one_init_direction == '1',
+    }
+
+
+@register_attack("opt", OPT_ARGUMENTS)
+def make_opt(args: Namespace, base_attack_kwargs: dict[str, Any]) -> "BaseAttack":
+    from src.attacks.opt import OPT
+    return OPT(**base_attack_kwargs, **_make_opt_kwargs(args))
+
+
+SIGN_OPT_ARGUMENTS = OPT_ARGUMENTS + (
+    Argument('--sign-opt-num-grad-queries', {
+        'default': 200,
+        'type': int,
+        'help': 'Number of gradient queries for Sign OPT'
+    }),
+    Argument('--sign-opt-momentum', {
+        'default': 0.,
+        'type': float,
+        'help': 'Momentum for Sign OPT'
+    }),
+)
+
+
+@register_attack("sign_opt", SIGN_OPT_ARGUMENTS)
+def make_sign_opt(args: Namespace, base_attack_kwargs: dict[str, Any]) -> "BaseAttack":
+    from src.attacks.sign_opt import SignOPT
+    attack_kwargs = _make_opt_kwargs(args) | {
+        "num_grad_queries": args.sign_opt_num_grad_queries,
+        "momentum": args.sign_opt_momentum
+    }
+    return SignOPT(**base_attack_kwargs, **attack_kwargs)
+
+
+@register_attack("boundary")
+def make_boundary(args: Namespace, base_attack_kwargs: dict[str, Any]) -> "BaseAttack":
+    from src.attacks.boundary_attack import BoundaryAttack
+    return BoundaryAttack(**base_attack_kwargs)
+
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def load_resnet50() -> "nn.Module":
+    from torchvision import models
+    return models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1)
+
+
+def load_binary_resnet50() -> "nn.Module":
+    from src.arch.binary_resnet50 import BinaryResNet50
+    return BinaryResNet50.load_from_checkpoint("checkpoints/binary_imagenet.ckpt").model
+
+
+def load_clip_nsfw_detector() -> "nn.Module":
+    from src.arch.clip_laion_nsfw import CLIPNSFWDetector
+    return CLIPNSFWDetector("b32", "checkpoints")
+
+
+def load_imagenet_test_data(batch_size: int, data_dir: str, sample_cache_dir: Path | None) -> "data.DataLoader":
+    from src import dataset
+    return dataset.load_imagenet_test_data(batch_size, data_dir, sample_cache_dir)
+
+
+def load_binary_imagenet_test_data(batch_size: int, data_dir: str,
+                                   sample_cache_dir: Path | None) -> "data.DataLoader":
+    from src import dataset
+    return dataset.load_binary_imagenet_test_data(batch_size, data_dir, sample_cache_dir)
+
+
+def load_imagenet_nsfw_test_data(batch_size: int, data_dir: str, sample_cache_dir: Path | None) -> "data.DataLoader":
+    from src import dataset
+    return dataset.load_imagenet_nsfw_test_data(batch_size, data_dir, sample_cache_dir)
+
+
+MODELS.update({
+    "resnet_imagenet":
+    ModelSpec(wrapper_kwargs={"n_class": 1000, "im_mean": IMAGENET_MEAN, "im_std": IMAGENET_STD},
+              load_inner_model=load_resnet50,
+              load_test_data=load_imagenet_test_data),
+    "binary_imagenet":
+    ModelSpec(wrapper_kwargs={"n_class": 2, "im_mean": IMAGENET_MEAN, "im_std": IMAGENET_STD},
+              load_inner_model=load_binary_resnet50,
+              load_test_data=load_binary_imagenet_test_data),
+    "imagenet_nsfw":
+    ModelSpec(wrapper_kwargs={"n_class": 2, "im_mean": CLIP_MEAN, "im_std": CLIP_STD, "take_sigmoid": False},
+              load_inner_model=load_clip_nsfw_detector,
+              load_test_data=load_imagenet_nsfw_test_data,
+              quantization_mode="dynamic",
+              data_parallel=False),
+})
@@ -0,0 +1,85 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+import tqdm
+from torch.utils import data
+
+SAMPLE_CACHE_VERSION = 1
+_IMAGES_FILENAME = "images.npy"
+_LABELS_FILENAME = "labels.npy"
+_FILES_FILENAME = "files.json"
+_FINGERPRINT_FILENAME = "fingerprint.json"
+
+
+def make_fingerprint(dataset_name: str, data_dir: Path | str, split: str,
+                     transform_description: str) -> dict[str, str | int]:
+    """The fingerprint must be cheap to compute, so it describes how the samples are created rather than
+    depending on the samples themselves."""
+    return {
+        "version": SAMPLE_CACHE_VERSION,
+        "dataset": dataset_name,
+        "data_dir": str(data_dir),
+        "split": split,
+        "transform": transform_description,
+    }
+
+
+def is_sample_cache_valid(cache_dir: Path, fingerprint: dict[str, str | int]) -> bool:
+    fingerprint_path = cache_dir / _FINGERPRINT_FILENAME
+    if not fingerprint_path.exists():
+        return False
+    with fingerprint_path.open("r") as f:
+        return json.load(f) == fingerprint
+
+
+def build_sample_cache(dataset: data.Dataset,
+                       cache_dir: Path,
+                       fingerprint: dict[str, str | int],
+                       batch_size: int = 64,
+                       num_workers: int = 8) -> None:
+    """Writes the images of `dataset` (which must be in the [0, 1] range and have been quantized to 8 bits, as it
+    is the case for images loaded with `ToTensor`) as a uint8 memory-mapped array, together with their labels and
+    file paths. The fingerprint is written last, so that a partially built cache is never considered valid."""
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    (cache_dir / _FINGERPRINT_FILENAME).unlink(missing_ok=True)
+    n_samples = len(dataset)  # type: ignore
+    loader = data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    images: np.memmap | None = None
+    labels = np.empty(n_samples, dtype=np.int64)
+    start = 0
+    for x, y in tqdm.tqdm(loader):
+        if images is None:
+            images = np.lib.format.open_memmap(cache_dir / _IMAGES_FILENAME,
+                                               mode="w+",
+                                               dtype=np.uint8,
+                                               shape=(n_samples, *x.shape[1:]))
+        images[start:start + len(x)] = torch.round(x * 255).to(torch.uint8).numpy()
+        labels[start:start + len(x)] = y.numpy()
+        start += len(x)
+    assert images is not None and start == n_samples
+    images.flush()
+    np.save(cache_dir / _LABELS_FILENAME, labels)
+    samples = getattr(dataset, "samples", [])
+    with (cache_dir / _FILES_FILENAME).open("w") as f:
+        json.dump([path for path, _ in samples], f)
+    with (cache_dir / _FINGERPRINT_FILENAME).open("w") as f:
+        json.dump(fingerprint, f, indent=4)
+
+
+class SampleCacheDataset(data.Dataset):
+    """Reads the samples written by `build_sample_cache`. Images are memory-mapped, so only the samples which are
+    actually used are read from disk, and they are returned exactly as the original dataset returns them."""
+
+    def __init__(self, cache_dir: Path) -> None:
+        self.images = np.load(cache_dir / _IMAGES_FILENAME, mmap_mode="r")
+        self.labels = np.load(cache_dir / _LABELS_FILENAME)
+        assert len(self.images) == len(self.labels)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __getitem__(self, index: int) -> tuple[torch.Tensor, int]:
+        image = torch.from_numpy(np.array(self.images[index])).to(torch.float32).div(255)
+        return image, int(self.labels[index])
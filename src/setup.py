@@ -5,52 +5,106 @@ from argparse import Namespace
 from pathlib import Path
 
 import torch
-from foolbox.distances import l2, linf
 from torch.utils import data
-from torchvision import models as models
-from torchvision.models import ResNet50_Weights
-
-from src import dataset
-from src.arch import binary_resnet50, clip_laion_nsfw
-from src.attacks import HSJA, OPT, BoundaryAttack, RayS, SignOPT, GeoDA
-from src.attacks.base import BaseAttack, Bounds, SearchMode
-from src.attacks.hsja import GradientEstimationMode
+
+from src import dataset, eligible_index, registry
+from src.attacks.base import AdaptiveBatchSize, BaseAttack, Bounds
+from src.attacks.queries_counter import TraceRecording
+from src.distances import l2, linf
+from src.image_utils import Codec
 from src.model_wrappers import ModelWrapper, TorchModelWrapper
+from src.model_wrappers.strong_preprocessing import StrongPreprocessing
 
 DEFAULT_BOUNDS = Bounds(0, 1)
 
 DISTANCES = {"linf": linf, "l2": l2}
 
+DEFAULT_ONNX_CHECKPOINT_PATH = "checkpoints/onnx/{dataset}.onnx"
+
 
 def setup_model_and_data(args: Namespace, device: torch.device) -> tuple[ModelWrapper, data.DataLoader]:
-    if args.dataset == 'resnet_imagenet':
-        inner_model = models.__dict__["resnet50"](weights=ResNet50_Weights.IMAGENET1K_V1).to(device).eval()
-        inner_model = torch.nn.DataParallel(inner_model, device_ids=[0])
-        test_loader = dataset.load_imagenet_test_data(args.batch, args.data_dir)
-        model = TorchModelWrapper(inner_model,
-                                  n_class=1000,
-                                  im_mean=(0.485, 0.456, 0.406),
-                                  im_std=(0.229, 0.224, 0.225))
-    elif args.dataset == 'binary_imagenet':
-        inner_model = binary_resnet50.BinaryResNet50.load_from_checkpoint("checkpoints/binary_imagenet.ckpt").model.to(
-            device).eval()
-        inner_model = torch.nn.DataParallel(inner_model, device_ids=[0])
-        test_loader = dataset.load_binary_imagenet_test_data(args.batch, args.data_dir)
-        model = TorchModelWrapper(inner_model, n_class=2, im_mean=(0.485, 0.456, 0.406), im_std=(0.229, 0.224, 0.225))
-    elif args.dataset == 'imagenet_nsfw':
-        inner_model = clip_laion_nsfw.CLIPNSFWDetector("b32", "checkpoints").to(device).eval()
-        model = TorchModelWrapper(inner_model,
-                                  n_class=2,
-                                  im_mean=(0.48145466, 0.4578275, 0.40821073),
-                                  im_std=(0.26862954, 0.26130258, 0.27577711),
-                                  take_sigmoid=False)
-        test_loader = dataset.load_imagenet_nsfw_test_data(args.batch, args.data_dir)
+    model_spec = registry.get_model_spec(args.dataset)
+    model: ModelWrapper
+    if args.model_backend == "onnx":
+        from src.model_wrappers.onnx_model import OnnxModelWrapper
+        onnx_model_path = args.onnx_model_path or DEFAULT_ONNX_CHECKPOINT_PATH.format(dataset=args.dataset)
+        model = OnnxModelWrapper(Path(onnx_model_path),
+                                 **model_spec.wrapper_kwargs,
+                                 intra_op_num_threads=args.onnx_intra_op_threads,
+                                 inter_op_num_threads=args.onnx_inter_op_threads,
+                                 device=device)
+        model = model.to(device)
+        test_loader = setup_data(args)
+    elif args.model_backend in {"torch", "quantized"}:
+        torch_model = setup_torch_model(args.dataset, device)
+        test_loader = setup_data(args)
+        if args.model_backend == "quantized":
+            if device.type != "cpu":
+                raise ValueError("The quantized model backend only runs on CPU, use `--device cpu`")
+            from src import quantization
+            torch_model = quantization.quantize_model_wrapper(torch_model, test_loader.dataset, args.dataset,
+                                                              quantization.QuantizationMode(
+                                                                  model_spec.quantization_mode),
+                                                              args.quantization_calibration_size,
+                                                              Path(args.quantized_checkpoints_dir))
+        model = torch_model
     else:
-        raise ValueError("Invalid model")
+        raise ValueError(f"Invalid model backend: `{args.model_backend}`")
+    model.micro_batch_size = args.model_micro_batch_size
+    if args.strong_preprocessing == '1':
+        model.strong_preprocessing = StrongPreprocessing(args.strong_preprocessing_jpeg_quality,
+                                                         args.strong_preprocessing_resize,
+                                                         max_workers=args.strong_preprocessing_workers)
+    return model, test_loader
+
+
+def load_inner_model(dataset_name: str, device: torch.device) -> torch.nn.Module:
+    inner_model = registry.get_model_spec(dataset_name).load_inner_model()
+    return inner_model.to(device).eval()
+
+
+def _wrap_data_parallel(inner_model: torch.nn.Module, device: torch.device) -> torch.nn.Module:
+    if device.type != "cuda":
+        return inner_model
+    return torch.nn.DataParallel(inner_model, device_ids=[0])
+
 
+def setup_torch_model(dataset_name: str, device: torch.device) -> TorchModelWrapper:
+    model_spec = registry.get_model_spec(dataset_name)
+    inner_model = load_inner_model(dataset_name, device)
+    if model_spec.data_parallel:
+        inner_model = _wrap_data_parallel(inner_model, device)
+    model = TorchModelWrapper(inner_model, **model_spec.wrapper_kwargs)
+    model = model.to(device)
     model.make_model_eval()
+    return model
 
-    return model, test_loader
+
+def setup_data(args: Namespace) -> data.DataLoader:
+    sample_cache_dir = Path(args.sample_cache_dir) / args.dataset if args.sample_cache_dir is not None else None
+    test_loader = registry.get_model_spec(args.dataset).load_test_data(args.batch, args.data_dir, sample_cache_dir)
+    if args.eligible_index_dir is not None:
+        test_loader = _filter_eligible_samples(args, test_loader)
+    return test_loader
+
+
+def get_eligible_index_fingerprint(args: Namespace) -> dict:
+    _, make_data_fingerprint = dataset.DATASETS[args.dataset]
+    return eligible_index.make_fingerprint(args, make_data_fingerprint(args.data_dir))
+
+
+def _filter_eligible_samples(args: Namespace, test_loader: data.DataLoader) -> data.DataLoader:
+    if args.batch != 1:
+        raise ValueError("The eligible samples index can only be used with `--batch 1`")
+    index_path = eligible_index.get_eligible_index_path(Path(args.eligible_index_dir), args)
+    eligible_indices = eligible_index.load_eligible_index(index_path, get_eligible_index_fingerprint(args))
+    if eligible_indices is None:
+        print(f"No valid eligible samples index in {index_path}, it can be built with "
+              "`scripts/build_eligible_index.py`")
+        return test_loader
+    print(f"Attacking only the {len(eligible_indices)} eligible samples in {index_path}")
+    sampler = eligible_index.EligibleSampler(test_loader.sampler, eligible_indices)
+    return data.DataLoader(test_loader.dataset, batch_size=args.batch, sampler=sampler)
 
 
 def setup_attack(args: Namespace) -> BaseAttack:
@@ -61,6 +115,8 @@ def setup_attack(args: Namespace) -> BaseAttack:
     if args.attack == 'rays' and args.early == "0" and (args.max_queries is None or args.max_unsafe_queries is None):
         raise ValueError(
             "For RayS attack, either early stopping or queries_limit or unsafe_queries_limit must be specified")
+    if args.uint8_queries == '1' and args.discrete != '1':
+        raise ValueError("uint8 queries can only be used by discrete attacks, use `--discrete 1`")
     base_attack_kwargs = {
         "epsilon": args.epsilon,
         "distance": DISTANCES[args.norm],
@@ -69,81 +125,14 @@ def setup_attack(args: Namespace) -> BaseAttack:
         "queries_limit": args.max_queries,
         "unsafe_queries_limit": args.max_unsafe_queries
     }
-    search = SearchMode(args.search)
-    opt_grad_estimation_search = (SearchMode(args.opt_grad_est_search)
-                                  if args.opt_grad_est_search is not None else search)
-    opt_step_size_search = SearchMode(args.opt_step_size_search) if args.opt_step_size_search is not None else search
-    opt_kwargs = {
-        "max_iter": args.max_iter,
-        "alpha": args.opt_alpha,
-        "beta": args.opt_beta,
-        "search": search,
-        "grad_estimation_search": opt_grad_estimation_search,
-        "step_size_search": opt_step_size_search,
-        "n_searches": args.opt_n_searches,
-        "max_search_steps": args.opt_max_search_steps,
-        "batch_size": args.opt_bs,
-        "num_grad_queries": args.opt_num_grad_queries,
-        "num_init_directions": args.opt_num_init_directions,
-        "get_one_init_direction": args.opt_get_one_init_direction == '1',
-    }
-    if args.attack == "rays":
-        if args.rays_flip_squares == '1' and args.rays_flip_rand_pixels == '1':
-            raise ValueError("`--flip-squares` cannot be `1` if also `--flip-rand-pixels` is `1`")
-        attack_kwargs = {
-            "early_stopping": args.early == '1',
-            "search": search,
-            "line_search_tol": args.line_search_tol,
-            "flip_squares": args.rays_flip_squares == '1',
-            "flip_rand_pixels": args.rays_flip_rand_pixels == '1'
-        }
-        return RayS(**base_attack_kwargs, **attack_kwargs)
-    if args.attack == "hsja":
-        attack_kwargs = {
-            "num_iterations": args.max_iter,
-            "stepsize_search": args.hsja_stepsize_search,
-            "max_num_evals": args.hsja_max_num_evals,
-            "init_num_evals": args.hsja_init_num_evals,
-            "gamma": args.hsja_gamma,
-            "fixed_delta": args.hsja_delta,
-            "gradient_estimation_mode": GradientEstimationMode(args.hsja_grad_est_mode),
-            "search": search,
-            "n_searches": args.hsja_n_searches,
-            "bias_coef": args.hsja_bias_coef,
-            'lower_bad_query_bound': args.hsja_lower_bad_query_bound,
-            'upper_bad_query_bound': args.hsja_upper_bad_query_bound,
-            'bias_coef_change_rate': args.hsja_bias_coef_change_rate
-        }
-        return HSJA(**base_attack_kwargs, **attack_kwargs)
-    if args.attack == "geoda":
-        attack_kwargs = {
-            "num_iterations": args.max_iter,
-            "max_num_evals": args.geoda_max_num_evals,
-            "init_num_evals": args.geoda_init_num_evals,
-            "theta": args.geoda_theta,
-            "delta": args.geoda_delta,
-            "search": search,
-            "n_searches": args.geoda_n_searches,
-            "bias_coef": args.geoda_bias_coef,
-            'lower_bad_query_bound': args.geoda_lower_bad_query_bound,
-            'upper_bad_query_bound': args.geoda_upper_bad_query_bound,
-            'bias_coef_change_rate': args.geoda_bias_coef_change_rate,
-            "dim_reduc_factor": args.geoda_dim_reduc_factor,
-            "search_radius_increase": args.geoda_search_radius_increase
-        }
-        return GeoDA(**base_attack_kwargs, **attack_kwargs)
-    if args.attack == "opt":
-        return OPT(**base_attack_kwargs, **opt_kwargs)
-    if args.attack == "sign_opt":
-        attack_kwargs = opt_kwargs | {
-            "num_grad_queries": args.sign_opt_num_grad_queries,
-            "momentum": args.sign_opt_momentum
-        }
-        return SignOPT(**base_attack_kwargs, **attack_kwargs)
-    if args.attack == "boundary":
-        return BoundaryAttack(**base_attack_kwargs)
-    else:
-        raise ValueError(f"Invalid attack: `{args.attack}`")
+    attack = registry.get_attack_spec(args.attack).factory(args, base_attack_kwargs)
+    attack.codec = Codec(args.discrete_codec, args.discrete_codec_quality, args.discrete_codec_workers)
+    attack.uint8_queries = args.uint8_queries == '1'
+    attack.max_eggs = args.eggs_dropping_max_eggs
+    attack.bad_query_cost_ratio = args.bad_query_cost_ratio
+    attack.line_search_batch_sizes = AdaptiveBatchSize(args.adaptive_line_search_batch == '1')
+    attack.trace_recording = TraceRecording(args.trace_recording)
+    return attack
 
 
 def get_git_revision_hash() -> str:
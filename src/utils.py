@@ -1,8 +1,10 @@
 import hashlib
+import json
 from pathlib import Path
 
 import torch
-from foolbox.distances import LpDistance, l2
+
+from src.distances import LpDistance, l2
 
 
 def compute_distance(x_ori: torch.Tensor, x_pert: torch.Tensor, distance: LpDistance = l2) -> torch.Tensor:
@@ -28,3 +30,20 @@ def write_sha256sum(src: Path, dst: Path):
 def read_sha256sum(path: Path) -> str:
     with open(path, "r") as f:
         return f.read().strip()
+
+
+def cached_sha256sum(filename: Path) -> str:
+    """Like `sha256sum`, but the hash is stored next to the file and re-computed only if the size or the
+    modification time of the file change."""
+    cache_path = filename.with_name(filename.name + ".sha256.json")
+    stat = filename.stat()
+    file_info = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if cache_path.exists():
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+        if cached["file"] == file_info:
+            return cached["sha256"]
+    sha256 = sha256sum(filename)
+    with open(cache_path, "w") as f:
+        json.dump({"file": file_info, "sha256": sha256}, f)
+    return sha256
@@ -0,0 +1,188 @@
+import contextlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from enum import Enum
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+QUEUE_FILENAME = "queue.sqlite"
+SAMPLES_DIRNAME = "samples"
+DEFAULT_LEASE_SECONDS = 600.
+DEFAULT_MAX_ATTEMPTS = 3
+# The leases are timestamped with the clock of the worker which renews them, and expired with the clock of the worker
+# which claims a task, so a lease only expires after this margin, which must be larger than the skew of the clocks
+DEFAULT_MAX_CLOCK_SKEW_SECONDS = 60.
+
+
+class TaskStatus(str, Enum):
+    pending = "pending"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
+class WorkQueue:
+    """Queue of the samples of a run, stored in a SQLite database in a directory shared by the workers, so that no
+    other service is needed. Each task is the position of a sample in the order in which `main.py` attacks them.
+
+    A worker claims a task with a lease, which it renews with heartbeats while it runs it. The tasks whose lease
+    expires (e.g., because the worker died) and the failed ones are claimed again, until they have been attempted
+    `max_attempts` times. Each operation opens its own connection, so that the queue can be used from several threads
+    and processes.
+
+    SQLite has no clock of its own, so the clocks of the workers must be synchronized (e.g., with NTP) up to
+    `max_clock_skew_seconds`, otherwise healthy leases can be expired by workers whose clock is ahead."""
+
+    def __init__(self,
+                 path: Path,
+                 timeout: float = 60.,
+                 max_clock_skew_seconds: float = DEFAULT_MAX_CLOCK_SKEW_SECONDS) -> None:
+        self.path = path
+        self.timeout = timeout
+        self.max_clock_skew_seconds = max_clock_skew_seconds
+
+    @classmethod
+    def create(cls,
+               path: Path,
+               config: dict[str, Any],
+               task_ids: Iterable[int],
+               max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> "WorkQueue":
+        path.mkdir(parents=True, exist_ok=True)
+        if (path / QUEUE_FILENAME).exists():
+            raise FileExistsError(f"There is already a queue in {path}")
+        queue = cls(path)
+        with queue._transaction() as connection:
+            connection.execute("CREATE TABLE config (config TEXT NOT NULL, max_attempts INTEGER NOT NULL)")
+            connection.execute("CREATE TABLE tasks (id INTEGER PRIMARY KEY, status TEXT NOT NULL, worker TEXT, "
+                               "lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT)")
+            connection.execute("INSERT INTO config VALUES (?, ?)", (json.dumps(config), max_attempts))
+            connection.executemany("INSERT INTO tasks (id, status) VALUES (?, ?)",
+                                   ((task_id, TaskStatus.pending.value) for task_id in task_ids))
+        (path / SAMPLES_DIRNAME).mkdir(exist_ok=True)
+        return queue
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # The lock is taken when the transaction begins, so that two workers cannot claim the same task
+        connection = sqlite3.connect(self.path / QUEUE_FILENAME, timeout=self.timeout, isolation_level=None)
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    @property
+    def config(self) -> dict[str, Any]:
+        with self._transaction() as connection:
+            config, = connection.execute("SELECT config FROM config").fetchone()
+        return json.loads(config)
+
+    def claim(self, worker: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> int | None:
+        """Claims the first task which is pending, or which can be retried, and returns its id, or None if there is
+        none."""
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE tasks SET status = ?, error = ? WHERE status = ? AND lease_expires < ?",
+                (TaskStatus.failed.value, "lease expired", TaskStatus.running.value, now - self.max_clock_skew_seconds))
+            row = connection.execute(
+                "SELECT id FROM tasks WHERE status = ? "
+                "OR (status = ? AND attempts < (SELECT max_attempts FROM config)) ORDER BY id LIMIT 1",
+                (TaskStatus.pending.value, TaskStatus.failed.value)).fetchone()
+            if row is None:
+                return None
+            task_id, = row
+            connection.execute(
+                "UPDATE tasks SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                (TaskStatus.running.value, worker, now + lease_seconds, task_id))
+        return task_id
+
+    def _update_running_task(self, task_id: int, worker: str, query: str, parameters: tuple) -> bool:
+        """Updates the task only if it is still running on `worker`, i.e., it was not claimed again after its lease
+        expired."""
+        with self._transaction() as connection:
+            cursor = connection.execute(f"{query} WHERE id = ? AND worker = ? AND status = ?",
+                                        parameters + (task_id, worker, TaskStatus.running.value))
+            return cursor.rowcount == 1
+
+    def heartbeat(self, task_id: int, worker: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> bool:
+        return self._update_running_task(task_id, worker, "UPDATE tasks SET lease_expires = ?",
+                                         (time.time() + lease_seconds, ))
+
+    def complete(self, task_id: int, worker: str) -> bool:
+        return self._update_running_task(task_id, worker, "UPDATE tasks SET status = ?, error = NULL",
+                                         (TaskStatus.done.value, ))
+
+    def fail(self, task_id: int, worker: str, error: str) -> bool:
+        return self._update_running_task(task_id, worker, "UPDATE tasks SET status = ?, error = ?",
+                                         (TaskStatus.failed.value, error))
+
+    def counts(self) -> dict[TaskStatus, int]:
+        with self._transaction() as connection:
+            rows = connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+        return {TaskStatus(status): count for status, count in rows}
+
+    def failed_tasks(self) -> dict[int, str]:
+        """Errors of the tasks which failed and cannot be retried anymore."""
+        with self._transaction() as connection:
+            rows = connection.execute(
+                "SELECT id, error FROM tasks WHERE status = ? AND attempts >= (SELECT max_attempts FROM config) "
+                "ORDER BY id", (TaskStatus.failed.value, )).fetchall()
+        return dict(rows)
+
+    def is_finished(self) -> bool:
+        """Whether all the tasks are done, or failed too many times to be retried."""
+        counts = self.counts()
+        return (counts.get(TaskStatus.pending, 0) == 0 and counts.get(TaskStatus.running, 0) == 0
+                and counts.get(TaskStatus.failed, 0) == len(self.failed_tasks()))
+
+    def done_tasks(self) -> list[int]:
+        with self._transaction() as connection:
+            rows = connection.execute("SELECT id FROM tasks WHERE status = ? ORDER BY id",
+                                      (TaskStatus.done.value, )).fetchall()
+        return [task_id for task_id, in rows]
+
+    def result_path(self, task_id: int) -> Path:
+        return self.path / SAMPLES_DIRNAME / f"{task_id}.pkl"
+
+    def save_result(self, task_id: int, result: dict[str, Any]) -> None:
+        # Written to a temporary file first, so that a result is never read while it is partially written
+        tmp_path = self.result_path(task_id).with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with tmp_path.open("wb") as f:
+            pickle.dump(result, f)
+        os.replace(tmp_path, self.result_path(task_id))
+
+    def load_result(self, task_id: int) -> dict[str, Any]:
+        with self.result_path(task_id).open("rb") as f:
+            return pickle.load(f)
+
+
+@contextlib.contextmanager
+def keep_lease(queue: WorkQueue, task_id: int, worker: str,
+               lease_seconds: float = DEFAULT_LEASE_SECONDS) -> Iterator[threading.Event]:
+    """Sends heartbeats for the task every third of the lease while the context is active. The event which is
+    yielded is set if the lease is lost."""
+    stop, lost = threading.Event(), threading.Event()
+
+    def send_heartbeats() -> None:
+        while not stop.wait(lease_seconds / 3):
+            if not queue.heartbeat(task_id, worker, lease_seconds):
+                lost.set()
+                return
+
+    thread = threading.Thread(target=send_heartbeats, daemon=True)
+    thread.start()
+    try:
+        yield lost
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,55 @@
+from pathlib import Path
+
+import pytest
+import torch
+from transformers import CLIPVisionConfig
+
+from src.arch import clip_laion_nsfw
+from src.arch.clip_laion_nsfw import (CLIPNSFWDetector, CLIPVisionModelWithProjection, PortedCLIPClassifier,
+                                      _CLIPVisionModelWithProjection)
+
+
+def make_tiny_vision_model() -> CLIPVisionModelWithProjection:
+    config = CLIPVisionConfig(hidden_size=32,
+                              intermediate_size=37,
+                              projection_dim=CLIPNSFWDetector.INPUT_SIZE,
+                              num_hidden_layers=2,
+                              num_attention_heads=4,
+                              image_size=32,
+                              patch_size=8)
+    torch.manual_seed(0)
+    return CLIPVisionModelWithProjection(config).eval()
+
+
+def test_merged_checkpoint(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    vision_model = make_tiny_vision_model()
+    monkeypatch.setattr(clip_laion_nsfw, "_load_pretrained_vision_model", lambda _: vision_model)
+    classifier = PortedCLIPClassifier(CLIPNSFWDetector.INPUT_SIZE)
+    classifier.mean.zero_()  # type: ignore
+    classifier.std.fill_(1)  # type: ignore
+    torch.save(classifier.state_dict(), tmp_path / "clip_autokeras_nsfw_torch.pth")
+
+    detector = CLIPNSFWDetector("b32", str(tmp_path)).eval()
+    assert (tmp_path / "clip_nsfw_detector_b32.pth").exists()
+    x = torch.rand(2, 3, 32, 32)
+    with torch.no_grad():
+        expected = classifier(torch.nn.functional.normalize(vision_model(pixel_values=x).image_embeds, dim=1))
+        assert torch.allclose(detector(x), expected)
+
+    # The second time the detector is loaded from the merged checkpoint only
+    (tmp_path / "clip_autokeras_nsfw_torch.pth").unlink()
+    monkeypatch.setattr(clip_laion_nsfw, "_load_pretrained_vision_model", None)
+    cached_detector = CLIPNSFWDetector("b32", str(tmp_path)).eval()
+    with torch.no_grad():
+        assert torch.allclose(cached_detector(x), expected)
+
+
+def test_vision_model_with_projection_fallback():
+    vision_model = make_tiny_vision_model()
+    fallback_vision_model = _CLIPVisionModelWithProjection(vision_model.config).eval()
+    # The weights have the same names, so that the merged checkpoints can be loaded with both models
+    fallback_vision_model.load_state_dict(vision_model.state_dict())
+    x = torch.rand(2, 3, 32, 32)
+    with torch.no_grad():
+        assert torch.allclose(fallback_vision_model(pixel_values=x).image_embeds,
+                              vision_model(pixel_values=x).image_embeds)
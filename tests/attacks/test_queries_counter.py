@@ -1,14 +1,22 @@
+from collections import Counter
 from dataclasses import replace
 
+import numpy as np
+import pytest
 import torch
 
-from src.attacks.queries_counter import AttackPhase, CurrentDistanceInfo, QueriesCounter
+from src.attacks.queries_counter import (AttackPhase, CurrentDistanceInfo, QueriesCounter, QueriesRun,
+                                         RunLengthDistances, TraceRecording)
 
 
 class DummyAttackPhase(AttackPhase):
     test = "test"
 
 
+class OtherDummyAttackPhase(AttackPhase):
+    other = "other"
+
+
 def test_queries_counter():
     counter = QueriesCounter(10)
     phase = DummyAttackPhase.test
@@ -66,3 +74,69 @@ def test_queries_counter_expand():
 def test_current_distance_info_expand():
     distance_info = CurrentDistanceInfo(DummyAttackPhase.test, True, 0.5, 0.5, 3)
     assert distance_info.expand_equivalent_queries() == [replace(distance_info, equivalent_simulated_queries=1)] * 3
+
+
+def test_run_length_distances():
+    phases = [DummyAttackPhase.test, OtherDummyAttackPhase.other]
+    distance_infos = [
+        CurrentDistanceInfo(phases[i % 2], i % 3 != 0, 10. - i, 10. - i, [3, 0, 1, 5, 2][i % 5]) for i in range(20)
+    ]
+    simulated_distances = RunLengthDistances.from_distance_infos(distance_infos)
+    expanded_distances = [info for d in distance_infos for info in d.expand_equivalent_queries()]
+    assert simulated_distances.expand() == expanded_distances
+    assert simulated_distances.total_queries == len(expanded_distances)
+    assert simulated_distances.total_unsafe_queries == sum(not info.safe for info in expanded_distances)
+    assert simulated_distances.queries_per_phase(safe=False) == dict(
+        Counter(info.phase for info in expanded_distances if not info.safe))
+    queries = np.arange(len(expanded_distances))
+    assert simulated_distances.best_distance_at(queries).tolist() == [info.best_distance for info in expanded_distances]
+    unsafe_positions = [i + 1 for i, info in enumerate(expanded_distances) if not info.safe]
+    n_unsafe = len(unsafe_positions)
+    assert simulated_distances.total_queries_at_unsafe(np.arange(1, n_unsafe + 1)).tolist() == unsafe_positions
+    assert simulated_distances.unsafe_only().expand() == [info for info in expanded_distances if not info.safe]
+
+
+def test_simulated_counter():
+    counter = QueriesCounter(None)
+    counter = counter.increase(DummyAttackPhase.test, torch.tensor([True, False]), torch.tensor([0.5, 0.4]), 3)
+    counter = counter.increase(DummyAttackPhase.test, torch.tensor([False]), torch.tensor([0.3]), 2)
+    simulated_counter = counter.simulated_counter(decompress_safe=True)
+    assert simulated_counter.distances == counter.distances
+    assert simulated_counter.queries == {DummyAttackPhase.test: 3}
+    assert simulated_counter.unsafe_queries == {DummyAttackPhase.test: 5}
+    assert simulated_counter.total_simulated_queries == counter.total_simulated_queries == 8
+    expanded_counter = counter.expand_simulated_distances(decompress_safe=True)
+    assert len(expanded_counter.distances) == 8
+    assert expanded_counter.queries == simulated_counter.queries
+    assert expanded_counter.unsafe_queries == simulated_counter.unsafe_queries
+
+
+def test_change_points_recording():
+    counters = {recording: QueriesCounter(None, recording=recording) for recording in TraceRecording}
+    for recording, counter in counters.items():
+        for i, phase in enumerate([DummyAttackPhase.test, OtherDummyAttackPhase.other, DummyAttackPhase.test]):
+            distances = torch.tensor([0.5, 0.6, 0.4, 0.3], dtype=torch.float64) / (i + 1)
+            counter = counter.increase(phase, torch.tensor([True, True, False]), distances[:3], 2)
+            counter = counter.increase(phase, torch.tensor([True]), distances[3:])
+        counters[recording] = counter
+    full_counter, change_points_counter = counters[TraceRecording.full], counters[TraceRecording.change_points]
+    # Only the distances of the last phase are kept
+    assert change_points_counter.distances == full_counter.distances[-4:]
+    assert change_points_counter.runs == full_counter.runs
+    assert change_points_counter.runs[:3] == [
+        QueriesRun(DummyAttackPhase.test, True, 2, 4),
+        QueriesRun(DummyAttackPhase.test, False, 1, 2),
+        QueriesRun(DummyAttackPhase.test, True, 1, 1),
+    ]
+    assert change_points_counter.change_points == full_counter.change_points
+    assert [query for query, _ in full_counter.change_points] == [0, 3, 4, 7, 11]
+    assert change_points_counter.queries == full_counter.queries
+    assert change_points_counter.unsafe_queries == full_counter.unsafe_queries
+    assert change_points_counter.total_simulated_queries == full_counter.total_simulated_queries == 21
+    assert change_points_counter.total_simulated_unsafe_queries == full_counter.total_simulated_unsafe_queries
+    assert (change_points_counter.simulated_counter(decompress_safe=True).queries ==
+            full_counter.simulated_counter(decompress_safe=True).queries)
+    with pytest.raises(ValueError):
+        change_points_counter.expand_simulated_distances()
+    trace = change_points_counter.to_trace()
+    assert isinstance(trace, dict) and trace["change_points"] == full_counter.change_points
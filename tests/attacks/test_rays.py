@@ -1,6 +1,37 @@
-from src.attacks.rays import compute_eggs_steps_to_try
+import pytest
+import torch
 
+from src.attacks.base import Bounds, SearchMode
+from src.attacks.queries_counter import QueriesCounter
+from src.attacks.rays import RayS
+from src.distances import l2
 
-def test_compute_eggs_steps_to_try():
-    assert compute_eggs_steps_to_try(100) == 14
-    assert compute_eggs_steps_to_try(1) == 1
+
+class RecordingRayS(RayS):
+    """Queries a boundary at `threshold` along the direction, and records the queried distances."""
+
+    def __init__(self, threshold: float):
+        super().__init__(None, l2, Bounds(), False, None, None, False, SearchMode.eggs_dropping, None, False, False)
+        self.threshold = threshold
+        self.queried_distances: list[float] = []
+
+    def get_x_adv(self, x: torch.Tensor, v: torch.Tensor, d: float) -> torch.Tensor:
+        return torch.tensor(d, dtype=torch.float64)
+
+    def is_correct_boundary_side(self, model, x_adv, y, target, queries_counter, attack_phase, original_x):
+        self.queried_distances.append(x_adv.item())
+        return torch.tensor(x_adv.item() >= self.threshold), queries_counter
+
+
+@pytest.mark.parametrize("last_safe_step,expected_steps", [(5, [0, 4, 7, 5, 6]), (10, [0, 4, 7, 9, 10]),
+                                                           (0, [0, 4, 1])])
+def test_eggs_dropping_search_two_eggs_schedule(last_safe_step: int, expected_steps: list[int]):
+    tol = 1e-3
+    # The search is over 10 steps, which are queried with jumps of 4, 3, 2 and 1 steps, and then one by one
+    best_distance = 10.5 * tol
+    attack = RecordingRayS(best_distance - (last_safe_step + 0.5) * tol)
+    x, y = torch.zeros(1, 1, 1, 1), torch.zeros(1, dtype=torch.long)
+    distance, _, _ = attack.eggs_dropping_search(None, x, y, None, x, best_distance,  # type: ignore
+                                                 QueriesCounter(None), tol)
+    assert [round((best_distance - d) / tol) for d in attack.queried_distances] == expected_steps
+    assert distance == pytest.approx(best_distance - last_safe_step * tol)
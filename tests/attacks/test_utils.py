@@ -0,0 +1,207 @@
+import math
+
+import pytest
+import torch
+from torch import nn
+
+from src.attacks.base import AdaptiveBatchSize, Bounds, SearchMode, make_sample_rngs
+from src.attacks.opt import OPT, OPTAttackPhase
+from src.attacks.utils import (EggsDroppingTable, choose_n_eggs, eggs_dropping_search, get_query_costs,
+                               opt_eggs_dropping_search, opt_line_search)
+from src.distances import l2
+from src.model_wrappers import TorchModelWrapper
+
+
+def test_eggs_dropping_table():
+    table = EggsDroppingTable(3, 1, 1)
+    for budget in range(20):
+        assert table.max_steps(budget, 1) == budget
+        assert table.max_steps(budget, 2) == budget * (budget + 1) // 2
+    # With enough eggs, it is a binary search
+    assert EggsDroppingTable(10, 1, 1).min_budget(2**10 - 1, 10) == 10
+    # A bad query can only be afforded if the budget covers it
+    table = EggsDroppingTable(2, 5, 1)
+    assert table.max_steps(4, 2) == 0
+    assert table.max_steps(5, 1) == 1
+    assert table.min_budget(10, 1) == 10 - 1 + 5
+
+
+def test_get_query_costs():
+    assert get_query_costs(1.) == (1, 1)
+    assert get_query_costs(2.5) == (5, 2)
+    with pytest.raises(ValueError):
+        get_query_costs(0.)
+
+
+def two_eggs_schedule(n_steps: int, last_safe_step: int) -> list[int]:
+    """Steps queried by the classic two eggs search: jumps of `B`, `B - 1`, ... steps, with `B * (B + 1) / 2 >=
+    n_steps`, until an unsafe step, then the steps after the last safe one, one by one."""
+    jump = math.ceil((-1 + math.sqrt(1 + 8 * n_steps)) / 2)
+    queried_steps, safe_step, step = [], 0, 0
+    while step < n_steps and step <= last_safe_step:
+        safe_step, step = step, min(step + jump, n_steps)
+        queried_steps.append(step)
+        jump -= 1
+    if step > last_safe_step:
+        queried_steps += range(safe_step + 1, min(last_safe_step + 1, step - 1) + 1)
+    return queried_steps
+
+
+def test_two_eggs_schedule():
+    queried_steps = []
+    assert eggs_dropping_search(10, lambda step: queried_steps.append(step) or step <= 5) == (5, False)
+    assert queried_steps == [4, 7, 5, 6]
+    # For 2 steps, a line search is used, as it has the same worst-case cost
+    for n_steps in [1] + list(range(3, 60)):
+        for last_safe_step in range(n_steps + 1):
+            queried_steps = []
+
+            def is_safe(step: int) -> bool:
+                queried_steps.append(step)
+                return step <= last_safe_step
+
+            assert eggs_dropping_search(n_steps, is_safe) == (last_safe_step, False)
+            assert queried_steps == two_eggs_schedule(n_steps, last_safe_step)
+
+
+def test_choose_n_eggs():
+    assert choose_n_eggs(2**10 - 1, 20, 1.) == 10
+    assert choose_n_eggs(1000, 20, 1000.) == 1
+    assert 1 < choose_n_eggs(1000, 20, 10.) < 10
+
+
+@pytest.mark.parametrize("max_eggs,bad_query_cost_ratio", [(1, 1.), (2, 1.), (3, 5.), (10, 1.), (4, 0.5)])
+def test_eggs_dropping_search(max_eggs: int, bad_query_cost_ratio: float):
+    n_steps = 50
+    bad_query_cost, good_query_cost = get_query_costs(bad_query_cost_ratio)
+    n_eggs = choose_n_eggs(n_steps, max_eggs, bad_query_cost_ratio)
+    worst_case_cost = EggsDroppingTable(max_eggs, bad_query_cost, good_query_cost).min_budget(n_steps, n_eggs)
+    for last_safe_step in range(n_steps + 1):
+        queries = []
+
+        def is_safe(step: int) -> bool:
+            queries.append(step <= last_safe_step)
+            return step <= last_safe_step
+
+        assert eggs_dropping_search(n_steps, is_safe, max_eggs, bad_query_cost_ratio) == (last_safe_step, False)
+        n_bad_queries = queries.count(False)
+        assert n_bad_queries <= n_eggs
+        assert n_bad_queries * bad_query_cost + queries.count(True) * good_query_cost <= worst_case_cost
+
+
+def test_eggs_dropping_search_stops_early():
+    last_safe_step, stopped_early = eggs_dropping_search(100, lambda step: True, should_stop=lambda step: step >= 20)
+    assert stopped_early and last_safe_step >= 20
+
+
+class SumThresholdModel(nn.Module):
+    """Positive class iff the sum of the pixels is larger than `threshold`."""
+
+    def __init__(self, threshold: float) -> None:
+        super().__init__()
+        self.threshold = threshold
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:  # type: ignore
+        return (x.flatten(1).sum(1, keepdim=True) - self.threshold) * 100
+
+
+def make_opt(search: SearchMode, n_searches: int) -> OPT:
+    return OPT(None, l2, Bounds(), False, None, None, 1, 0.2, 0.001, search, 10, search, search, n_searches, 1000,
+               100, 1, True)
+
+
+@pytest.mark.parametrize("n_searches", [1, 2, 3])
+def test_opt_line_search_n_searches(n_searches: int):
+    threshold = 3.
+    model = TorchModelWrapper(SumThresholdModel(threshold), n_class=2)
+    x = torch.zeros(1, 3, 4, 4)
+    theta = torch.ones_like(x) / math.sqrt(x.numel())
+    boundary_lbd = threshold / math.sqrt(x.numel())
+    attack = make_opt(SearchMode.line, n_searches)
+    lbd, queries_counter = opt_line_search(attack, model, x, torch.tensor([0]), None, theta,
+                                           attack._make_queries_counter(), 1., OPTAttackPhase.search,
+                                           OPTAttackPhase.direction_probing, None, n_searches, 1000, 100)
+    assert boundary_lbd <= lbd <= boundary_lbd + 2 / 1000
+    assert queries_counter.total_unsafe_queries <= n_searches
+    assert queries_counter.total_simulated_queries >= queries_counter.total_queries
+
+
+@pytest.mark.parametrize("max_eggs,bad_query_cost_ratio", [(2, 1.), (10, 1.), (10, 100.)])
+def test_opt_eggs_dropping_search(max_eggs: int, bad_query_cost_ratio: float):
+    threshold = 3.
+    model = TorchModelWrapper(SumThresholdModel(threshold), n_class=2)
+    x = torch.zeros(1, 3, 4, 4)
+    theta = torch.ones_like(x) / math.sqrt(x.numel())
+    boundary_lbd = threshold / math.sqrt(x.numel())
+    attack = make_opt(SearchMode.eggs_dropping, 1)
+    attack.max_eggs = max_eggs
+    attack.bad_query_cost_ratio = bad_query_cost_ratio
+    lbd, queries_counter = opt_eggs_dropping_search(attack, model, x, torch.tensor([0]), None, theta,
+                                                    attack._make_queries_counter(), 1., OPTAttackPhase.search,
+                                                    OPTAttackPhase.direction_probing, None, 1000)
+    assert boundary_lbd <= lbd <= boundary_lbd + 2 / 1000
+    assert queries_counter.total_unsafe_queries <= max_eggs
+
+
+def test_adaptive_batch_size():
+    batch_sizes = AdaptiveBatchSize()
+    assert batch_sizes.first("a", 100) == 8
+    assert batch_sizes.next(8, 100) == 16
+    assert batch_sizes.next(64, 100) == 100
+    batch_sizes.update("a", 3)
+    assert batch_sizes.first("a", 100) == 3
+    assert batch_sizes.first("b", 100) == 8
+    batch_sizes.update("a", 300)
+    assert batch_sizes.first("a", 100) == 100
+    disabled_batch_sizes = AdaptiveBatchSize(enabled=False)
+    assert disabled_batch_sizes.first("a", 100) == 100
+    assert disabled_batch_sizes.next(8, 100) == 100
+
+
+@pytest.mark.parametrize("n_searches", [1, 2])
+def test_opt_line_search_adaptive_batch_size(n_searches: int):
+    x = torch.zeros(1, 3, 4, 4)
+    theta = torch.ones_like(x) / math.sqrt(x.numel())
+    results = {}
+    for adaptive in [False, True]:
+        model = TorchModelWrapper(SumThresholdModel(3.), n_class=2)
+        attack = make_opt(SearchMode.line, n_searches)
+        attack.line_search_batch_sizes = AdaptiveBatchSize(adaptive)
+        queries_counter = attack._make_queries_counter()
+        lbds = []
+        # The searches start close to the boundary (at 0.866), as it happens within an attack
+        for initial_lbd in [0.88, 0.87, 0.875]:
+            lbd, queries_counter = opt_line_search(attack, model, x, torch.tensor([0]), None, theta, queries_counter,
+                                                   initial_lbd, OPTAttackPhase.search,
+                                                   OPTAttackPhase.direction_probing, None, n_searches, 1000, 100)
+            lbds.append(lbd)
+        results[adaptive] = lbds, queries_counter, model.num_queries
+    assert results[True][0] == results[False][0]
+    assert results[True][1] == results[False][1]
+    assert results[True][2] < results[False][2]
+
+
+def test_make_sample_rngs():
+    rngs, same_rngs, other_rngs = make_sample_rngs(0, 3), make_sample_rngs(0, 3), make_sample_rngs(0, 4)
+    assert torch.equal(torch.randn(10, generator=rngs.torch_generator),
+                       torch.randn(10, generator=same_rngs.torch_generator))
+    assert rngs.numpy_generator.integers(1000, size=10).tolist() == same_rngs.numpy_generator.integers(
+        1000, size=10).tolist()
+    assert not torch.equal(torch.randn(10, generator=make_sample_rngs(0, 3).torch_generator),
+                           torch.randn(10, generator=other_rngs.torch_generator))
+
+
+def test_sample_rngs_reproducibility():
+    model = TorchModelWrapper(SumThresholdModel(0.5), n_class=2)
+    x = torch.zeros(1, 3, 4, 4)
+    results = []
+    for sample_index, global_seed in [(0, 0), (0, 1), (1, 0)]:
+        attack = make_opt(SearchMode.binary, 1)
+        attack.num_directions = 5
+        attack.set_sample_rngs(make_sample_rngs(0, sample_index))
+        # The global RNG state does not matter
+        torch.manual_seed(global_seed)
+        _, queries_counter, distance, _, _ = attack(model, x, torch.tensor([0]))
+        results.append((queries_counter, distance))
+    assert results[0] == results[1]
+    assert results[0] != results[2]
@@ -0,0 +1,126 @@
+import threading
+
+import pytest
+import torch
+from torch import nn
+
+from src.image_utils import from_uint8
+from src.model_wrappers import TorchModelWrapper
+from src.model_wrappers.general_model import QueriesInterrupted, dequantize_and_normalize
+from src.model_wrappers.strong_preprocessing import StrongPreprocessing
+
+
+class OutOfMemoryLinear(nn.Module):
+    """Runs out of memory when given more than `max_batch_size` inputs, and logs the size of the batches it gets."""
+
+    def __init__(self, n_class: int, max_batch_size: int) -> None:
+        super().__init__()
+        torch.manual_seed(0)
+        self.linear = nn.Linear(12, n_class)
+        self.max_batch_size = max_batch_size
+        self.batch_sizes: list[int] = []
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:  # type: ignore
+        if len(x) > self.max_batch_size:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        self.batch_sizes.append(len(x))
+        return self.linear(x.flatten(1))
+
+
+@pytest.mark.parametrize("n_class", [1, 5])
+def test_predict_label_out_of_memory(n_class: int):
+    wrapper_n_class = 2 if n_class == 1 else n_class
+    x = torch.rand(10, 3, 2, 2)
+    expected_labels = TorchModelWrapper(OutOfMemoryLinear(n_class, 10), wrapper_n_class).predict_label(x)
+    inner_model = OutOfMemoryLinear(n_class, 3)
+    model = TorchModelWrapper(inner_model, wrapper_n_class)
+    assert torch.equal(model.predict_label(x), expected_labels)
+    assert inner_model.batch_sizes == [2, 2, 2, 2, 2]
+    assert model.num_queries == 10
+    assert model.micro_batch_size == 2
+    # The micro-batch size found is kept for the next queries
+    model.predict_label(x)
+    assert inner_model.batch_sizes[5:] == [2, 2, 2, 2, 2]
+
+
+def test_predict_label_micro_batch_size():
+    inner_model = OutOfMemoryLinear(5, 10)
+    model = TorchModelWrapper(inner_model, 5)
+    model.micro_batch_size = 4
+    x = torch.rand(10, 3, 2, 2)
+    assert torch.equal(model.predict_label(x), TorchModelWrapper(inner_model, 5).predict_label(x))
+    assert inner_model.batch_sizes[:3] == [4, 4, 2]
+    assert model.num_queries == 10
+
+
+def test_predict_label_other_errors_are_raised():
+    model = TorchModelWrapper(OutOfMemoryLinear(5, 10), 5)
+    with pytest.raises(RuntimeError):
+        model.predict_label(torch.rand(10, 3, 2, 3))
+
+
+def test_predict_label_interrupt():
+    inner_model = OutOfMemoryLinear(5, 10)
+    model = TorchModelWrapper(inner_model, 5)
+    model.interrupt = threading.Event()
+    x = torch.rand(2, 3, 2, 2)
+    model.predict_label(x)
+    model.interrupt.set()
+    with pytest.raises(QueriesInterrupted):
+        model.predict_label(x)
+    # The interrupted queries are neither run nor counted
+    assert inner_model.batch_sizes == [2]
+    assert model.num_queries == 2
+
+
+class LoggingStrongPreprocessing(StrongPreprocessing):
+
+    def __init__(self) -> None:
+        super().__init__(jpeg_quality=None)
+        self.batch_sizes: list[int] = []
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        self.batch_sizes.append(len(images))
+        return super().__call__(images)
+
+
+def test_strong_preprocessing_in_micro_batches():
+    x = torch.rand(10, 3, 2, 2)
+    model = TorchModelWrapper(OutOfMemoryLinear(5, 10), 5)
+    model.strong_preprocessing = StrongPreprocessing(jpeg_quality=None)
+    expected_labels = model.predict_label(x)
+    model = TorchModelWrapper(OutOfMemoryLinear(5, 3), 5)
+    strong_preprocessing = LoggingStrongPreprocessing()
+    model.strong_preprocessing = strong_preprocessing
+    assert torch.equal(model.predict_label(x), expected_labels)
+    # The whole batch is preprocessed first, then only the micro-batches which are retried
+    assert strong_preprocessing.batch_sizes == [10, 5, 2, 2, 2, 2, 2]
+
+
+@pytest.mark.parametrize("normalize", [False, True])
+def test_dequantize_and_normalize(normalize: bool):
+    x = torch.randint(0, 256, (4, 3, 2, 2), dtype=torch.uint8)
+    im_mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1) if normalize else None
+    im_std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1) if normalize else None
+    expected = x.to(torch.float32) / 255
+    if normalize:
+        expected = (expected - im_mean) / im_std
+    assert torch.allclose(dequantize_and_normalize(x, im_mean, im_std), expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("n_class", [1, 5])
+def test_predict_label_uint8_matches_float(n_class: int):
+    wrapper_n_class = 2 if n_class == 1 else n_class
+    model = TorchModelWrapper(OutOfMemoryLinear(n_class, 1000), wrapper_n_class, (0.485, 0.456, 0.406),
+                              (0.229, 0.224, 0.225))
+    x = torch.randint(0, 256, (1000, 3, 2, 2), dtype=torch.uint8, generator=torch.Generator().manual_seed(0))
+    # The labels of the `addcmul` dequantization are the same as the ones of the float images
+    assert torch.equal(model.predict_label(x), model.predict_label(from_uint8(x)))
+
+
+def test_predict_label_uint8():
+    model = TorchModelWrapper(OutOfMemoryLinear(5, 10), 5, (0.5, 0.5, 0.5), (0.2, 0.2, 0.2))
+    x = torch.randint(0, 256, (10, 3, 2, 2), dtype=torch.uint8)
+    assert torch.allclose(model(x), model(x.to(torch.float32) / 255), atol=1e-5)
+    assert model.predict_label(x).shape == (10, )
+    assert model.num_queries == 10
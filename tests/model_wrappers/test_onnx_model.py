@@ -0,0 +1,42 @@
+from pathlib import Path
+
+import pytest
+import torch
+from torch import nn
+
+pytest.importorskip("onnxruntime")
+
+from src.model_wrappers import TorchModelWrapper  # noqa: E402
+from src.model_wrappers.onnx_model import OnnxModelWrapper, export_onnx_model  # noqa: E402
+
+
+def make_model(n_class: int) -> nn.Module:
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Conv2d(3, 8, 3), nn.ReLU(), nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(8, n_class))
+
+
+@pytest.mark.parametrize("n_class", [1, 5])
+def test_onnx_model_wrapper(tmp_path: Path, n_class: int):
+    model = make_model(n_class).eval()
+    model_path = tmp_path / "model.onnx"
+    export_onnx_model(model, model_path, input_size=16)
+    wrapper_kwargs = {"n_class": 2 if n_class == 1 else n_class, "im_mean": (0.5, 0.5, 0.5), "im_std": (0.2, 0.2, 0.2)}
+    torch_model = TorchModelWrapper(model, **wrapper_kwargs)
+    onnx_model = OnnxModelWrapper(model_path, **wrapper_kwargs, intra_op_num_threads=1)
+
+    # Different batch sizes, to test that the buffers are re-allocated and re-used correctly
+    for batch_size in [4, 8, 2]:
+        x = torch.rand(batch_size, 3, 16, 16)
+        assert torch.allclose(onnx_model(x), torch_model(x), atol=1e-5)
+        assert torch.equal(onnx_model.predict_label(x), torch_model.predict_label(x))
+    assert onnx_model.num_queries == 14
+    assert onnx_model.predict_label(torch.rand(3, 16, 16)).shape == (1, )
+    assert onnx_model.num_queries == 15
+    # uint8 images are dequantized and normalized in the same step
+    x_uint8 = torch.randint(0, 256, (4, 3, 16, 16), dtype=torch.uint8)
+    assert torch.allclose(onnx_model(x_uint8), torch_model(x_uint8.to(torch.float32) / 255), atol=1e-5)
+
+
+def test_onnx_model_wrapper_missing_model(tmp_path: Path):
+    with pytest.raises(FileNotFoundError):
+        OnnxModelWrapper(tmp_path / "missing.onnx")
@@ -0,0 +1,52 @@
+import pytest
+import torch
+from torch import nn
+
+from src.image_utils import encode_decode_batch
+from src.model_wrappers import TorchModelWrapper
+from src.model_wrappers.strong_preprocessing import StrongPreprocessing, center_crop, resize
+
+
+class LoggingIdentity(nn.Module):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.inputs: list[torch.Tensor] = []
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:  # type: ignore
+        self.inputs.append(x)
+        return x.flatten(1)[:, :2]
+
+
+@pytest.mark.parametrize("jpeg_quality", [None, 75])
+def test_batch_matches_per_image(jpeg_quality: int | None):
+    images = torch.rand(6, 3, 32, 32, generator=torch.Generator().manual_seed(0))
+    preprocessing = StrongPreprocessing(jpeg_quality, max_workers=2)
+    preprocessed = preprocessing(images)
+    assert preprocessed.size() == images.size()
+    assert preprocessed.min() >= 0 and preprocessed.max() <= 1
+    for image, preprocessed_image in zip(images, preprocessed):
+        assert torch.equal(preprocessing(image), preprocessed_image)
+        assert torch.equal(preprocessing(image.unsqueeze(0))[0], preprocessed_image)
+
+
+def test_steps():
+    images = torch.rand(2, 3, 32, 48, generator=torch.Generator().manual_seed(0))
+    assert resize(images, 16).size() == (2, 3, 16, 24)
+    assert resize(images, 32) is images
+    assert torch.equal(center_crop(images, 32), images[..., 8:40])
+    with pytest.raises(ValueError):
+        center_crop(images, 33)
+    expected = center_crop(resize(encode_decode_batch(images, "jpeg", 50), 40), 30)
+    assert torch.equal(StrongPreprocessing(50, 40, 30)(images), expected)
+
+
+def test_model_wrapper():
+    images = torch.rand(4, 3, 16, 16, generator=torch.Generator().manual_seed(0))
+    inner_model = LoggingIdentity()
+    model = TorchModelWrapper(inner_model, n_class=2)
+    model.strong_preprocessing = StrongPreprocessing(90)
+    model.micro_batch_size = 3
+    model.predict_label(images)
+    assert torch.equal(torch.cat(inner_model.inputs), StrongPreprocessing(90)(images))
+    assert model.num_queries == 4
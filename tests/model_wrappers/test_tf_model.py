@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+tf = pytest.importorskip("tensorflow")
+
+from src.image_utils import from_uint8, to_uint8  # noqa: E402
+from src.model_wrappers.tf_model import TFModelWrapper  # noqa: E402
+
+IM_MEAN = (0.1, 0.2, 0.3)
+IM_STD = (0.5, 0.25, 0.125)
+
+
+def make_keras_model(n_class: int) -> tf.keras.Model:
+    tf.random.set_seed(0)
+    return tf.keras.Sequential([
+        tf.keras.layers.Conv2D(4, 3, data_format="channels_last"),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(n_class)
+    ])
+
+
+def test_preprocess_channels_last():
+    model = TFModelWrapper(make_keras_model(3), n_class=3, im_mean=IM_MEAN, im_std=IM_STD, channels_last=True)
+    x = torch.rand(2, 3, 8, 8)
+    expected = ((x - torch.tensor(IM_MEAN).view(1, 3, 1, 1)) / torch.tensor(IM_STD).view(1, 3, 1, 1))
+    assert torch.allclose(model.preprocess(x), expected.permute(0, 2, 3, 1))
+
+
+def test_preprocess_channels_last_uint8():
+    model = TFModelWrapper(make_keras_model(3), n_class=3, im_mean=IM_MEAN, im_std=IM_STD, channels_last=True)
+    x_uint8 = to_uint8(torch.rand(2, 3, 8, 8))
+    assert torch.equal(model.preprocess(x_uint8), model.preprocess(from_uint8(x_uint8)))
+
+
+def test_predict_label_matches_keras():
+    keras_model = make_keras_model(3)
+    model = TFModelWrapper(keras_model, n_class=3, im_mean=IM_MEAN, im_std=IM_STD, channels_last=True)
+    x = torch.rand(4, 3, 8, 8)
+    expected_logits = torch.from_numpy(keras_model(model.preprocess(x).numpy()).numpy())
+    logits = model(x)
+    assert logits.device == x.device
+    assert torch.allclose(logits, expected_logits, atol=1e-5)
+    assert torch.equal(model.predict_label(x), expected_logits.argmax(1))
+    assert model.num_queries == 4
@@ -0,0 +1,67 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from src.attack_results import CHANGE_POINTS_TRACES_FILENAME, AttackResults, CurvesAggregator
+from src.attacks.hsja import HSJAttackPhase
+from src.attacks.queries_counter import QueriesCounter, TraceRecording
+from src.distance_arrays import MAX_BAD_QUERIES_TRADEOFF_PLOT, MAX_UNSAFE_QUERIES, pad_to_len
+
+
+def make_queries_counter(seed: int, recording: TraceRecording = TraceRecording.full) -> QueriesCounter:
+    generator = torch.Generator().manual_seed(seed)
+    counter = QueriesCounter(None, recording=recording)
+    for phase in [HSJAttackPhase.initialization, HSJAttackPhase.gradient_estimation_search_start,
+                  HSJAttackPhase.binary_search]:
+        safe = torch.rand(50, generator=generator) < 0.5
+        counter = counter.increase(phase, safe, torch.rand(50, generator=generator) * 10)
+    return counter
+
+
+def test_curves_aggregator(tmp_path: Path):
+    curves_aggregator = CurvesAggregator(tmp_path)
+    attack_results = AttackResults(tmp_path, curves_aggregator=curves_aggregator)
+    queries_counters = [make_queries_counter(seed) for seed in range(3)]
+    for i, queries_counter in enumerate(queries_counters):
+        attack_results = attack_results.update_with_success(1., queries_counter, {})
+        attack_results.save_results(verbose=False)
+        # The arrays can be loaded while the attack is running
+        assert np.load(tmp_path / "distances_array_unsafe_only.npy").shape == (i + 1, MAX_UNSAFE_QUERIES)
+    attack_results.save_results(verbose=False)
+    curves_aggregator.close()
+
+    distances_array = np.load(tmp_path / "distances_array_unsafe_only.npy")
+    tradeoff_array = np.load(tmp_path / "tradeoff_array.npy")
+    assert distances_array.shape == (3, MAX_UNSAFE_QUERIES)
+    assert tradeoff_array.shape == (3, MAX_BAD_QUERIES_TRADEOFF_PLOT)
+    for queries_counter, distances, tradeoff in zip(queries_counters, distances_array, tradeoff_array):
+        best_distances = [
+            d.best_distance for d in queries_counter.distances
+            if not d.safe and d.phase != HSJAttackPhase.gradient_estimation_search_start
+        ]
+        np.testing.assert_array_equal(distances, pad_to_len(best_distances, MAX_UNSAFE_QUERIES).astype(np.float32))
+        unsafe_queries = [i + 1 for i, d in enumerate(queries_counter.distances) if not d.safe]
+        np.testing.assert_array_equal(tradeoff[:len(unsafe_queries)], unsafe_queries)
+        assert not np.isnan(tradeoff).any()
+
+
+def test_curves_aggregator_change_points(tmp_path: Path):
+    arrays = {}
+    for recording in TraceRecording:
+        path = tmp_path / recording.value
+        path.mkdir()
+        attack_results = AttackResults(path, curves_aggregator=CurvesAggregator(path))
+        for seed in range(3):
+            attack_results = attack_results.update_with_success(1., make_queries_counter(seed, recording), {})
+            attack_results.save_results(verbose=False)
+        arrays[recording] = (np.load(path / "distances_array_unsafe_only.npy"), np.load(path / "tradeoff_array.npy"))
+    for full_array, change_points_array in zip(arrays[TraceRecording.full], arrays[TraceRecording.change_points]):
+        np.testing.assert_array_equal(full_array, change_points_array)
+    # Only the runs and the change points are saved
+    assert not (tmp_path / TraceRecording.change_points.value / "distances_traces.json").exists()
+    with (tmp_path / TraceRecording.change_points.value / CHANGE_POINTS_TRACES_FILENAME).open() as f:
+        traces = json.load(f)
+    assert len(traces) == 3
+    assert traces[0]["change_points"] == [list(change_point) for change_point in make_queries_counter(0).change_points]
@@ -0,0 +1,36 @@
+from pathlib import Path
+
+import numpy as np
+
+from src.best_distance_traces import BestDistanceTraces
+from src.distance_arrays import pad_to_len
+
+
+def make_samples(n_samples: int) -> list[np.ndarray]:
+    rng = np.random.default_rng(0)
+    samples = []
+    for _ in range(n_samples):
+        improvements = rng.random(rng.integers(1, 100)) < 0.2
+        samples.append(np.minimum.accumulate(np.where(improvements, rng.random(len(improvements)) * 10, 10.)))
+    return samples
+
+
+def test_matches_dense_arrays(tmp_path: Path):
+    samples = make_samples(50)
+    n_columns = 120
+    dense = np.stack([pad_to_len(sample, n_columns) for sample in samples]).astype(np.float32)
+    BestDistanceTraces.from_samples(samples).save(tmp_path / "traces.npz")
+    traces = BestDistanceTraces.load(tmp_path / "traces.npz")
+    assert len(traces) == len(samples)
+    assert len(traces.query_indices) < sum(map(len, samples))
+    np.testing.assert_array_equal(traces.to_dense(n_columns), dense)
+    np.testing.assert_array_equal(traces.best_distance_at(10, 20), dense[:20, 10])
+    np.testing.assert_array_equal(traces.best_distance_at([5, 0, 119], 20), dense[:20, [5, 0, 119]])
+    np.testing.assert_array_equal(traces.best_distance_at(10_000), dense[:, -1])
+    for distance in [0.5, 2., 20.]:
+        below = dense < distance
+        expected_first_queries = np.where(below.any(axis=1), np.argmax(below, axis=1), -1)
+        np.testing.assert_array_equal(traces.first_query_below(distance), expected_first_queries)
+        median_below = np.median(dense[:30], axis=0) < distance
+        expected_median_query = int(np.argmax(median_below)) if median_below.any() else None
+        assert traces.median_first_query_below(distance, n_columns, 30) == expected_median_query
@@ -0,0 +1,128 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from src.distance_arrays import (batched_interp, bootstrap_columnwise_median_ci, columnwise_median, columnwise_quantile,
+                                 extrapolate_rows, median_distance_per_cost, pad_to_len, total_queries_at_bad_queries,
+                                 NpyRowsWriter, load_array, write_rows_to_npy)
+
+
+def test_write_rows_to_npy(tmp_path: Path):
+    rows = [[3., 2., 1.], [5., 4.], [2., 2., 1., 0.5, 0.1]]
+    array = write_rows_to_npy(tmp_path / "array.npy", iter(rows), 4)
+    assert isinstance(array, np.memmap)
+    assert array.dtype == np.float32
+    expected = np.stack([pad_to_len(row, 4) for row in rows]).astype(np.float32)
+    np.testing.assert_array_equal(array, expected)
+    np.testing.assert_array_equal(np.load(tmp_path / "array.npy"), expected)
+
+
+def test_write_rows_to_npy_interrupted(tmp_path: Path):
+    write_rows_to_npy(tmp_path / "array.npy", [[1., 2.]], 2)
+
+    def failing_rows():
+        yield [3., 4.]
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        write_rows_to_npy(tmp_path / "array.npy", failing_rows(), 2)
+    # The previous array is kept, instead of a truncated one
+    np.testing.assert_array_equal(np.load(tmp_path / "array.npy"), [[1., 2.]])
+
+
+def test_npy_rows_writer(tmp_path: Path):
+    with NpyRowsWriter(tmp_path / "array.npy", 3, float) as writer:
+        writer.append([1., 2., 3.])
+        writer.flush()
+        np.testing.assert_array_equal(load_array(tmp_path / "array.npy"), [[1., 2., 3.]])
+        writer.append([4.])
+        # Rows appended after the last flush are not visible yet
+        assert load_array(tmp_path / "array.npy").shape == (1, 3)
+    np.testing.assert_array_equal(np.load(tmp_path / "array.npy"), [[1., 2., 3.], [4., 4., 4.]])
+
+
+def test_write_no_rows(tmp_path: Path):
+    assert write_rows_to_npy(tmp_path / "array.npy", [], 4).shape == (0, 4)
+
+
+@pytest.mark.parametrize("n_rows", [None, 7, 100])
+@pytest.mark.parametrize("max_chunk_bytes", [1, 4 * 20 * 3, 2**20])
+def test_columnwise_statistics(n_rows: int | None, max_chunk_bytes: int):
+    array = np.random.default_rng(0).random((20, 50)).astype(np.float32)
+    np.testing.assert_array_equal(columnwise_median(array, n_rows, max_chunk_bytes),
+                                  np.median(array[:n_rows], axis=0))
+    np.testing.assert_array_equal(columnwise_quantile(array, 0.9, n_rows, max_chunk_bytes),
+                                  np.quantile(array[:n_rows], 0.9, axis=0))
+    np.testing.assert_array_equal(columnwise_quantile(array, [0.1, 0.9], n_rows, max_chunk_bytes),
+                                  np.quantile(array[:n_rows], [0.1, 0.9], axis=0))
+
+
+def test_batched_interp():
+    rng = np.random.default_rng(0)
+    xp = np.cumsum(rng.random((5, 30)), axis=1)
+    fp = rng.random((5, 30))
+    x = np.linspace(-1, 20, 300)
+    expected = np.stack([np.interp(x, xp_row, fp_row, left=np.nan, right=np.nan) for xp_row, fp_row in zip(xp, fp)])
+    np.testing.assert_allclose(batched_interp(x, xp, fp), expected)
+
+
+def test_median_distance_per_cost():
+    rng = np.random.default_rng(0)
+    tradeoff_arrays = np.cumsum(rng.integers(1, 20, (3, 50, 100)), axis=2)
+    distances_arrays = np.minimum.accumulate(rng.random((3, 50, 100)), axis=2)
+    ratios = [1., 10., 100.]
+    costs = [200., 1000., 5000.]
+    median_total_queries = np.median(tradeoff_arrays, axis=1)
+    median_distances = np.median(distances_arrays, axis=1)
+    distances_per_cost = median_distance_per_cost(median_total_queries, median_distances, ratios, costs)
+    assert distances_per_cost.shape == (3, 3, 3)
+    for i, (tradeoff_array, distances_array) in enumerate(zip(tradeoff_arrays, distances_arrays)):
+        for j, ratio in enumerate(ratios):
+            # Same as `plot_distance_per_cost` with a query cost of 1 and a bad query cost of `ratio`
+            cost_array = tradeoff_array + np.arange(1, 101) * ratio
+            expected = np.interp(costs, np.median(cost_array, axis=0), np.median(distances_array, axis=0),
+                                 left=np.nan, right=np.nan)
+            np.testing.assert_allclose(distances_per_cost[i, j], expected)
+
+
+@pytest.mark.parametrize("n_rows", [29, 30])
+def test_bootstrap_columnwise_median_ci(n_rows: int):
+    array = np.random.default_rng(0).random((40, 30)).astype(np.float32)
+    columns = [0, 3, 29]
+    lower_bound, upper_bound = bootstrap_columnwise_median_ci(array, n_rows, columns, n_resamples=200, seed=1)
+    resampled_rows = np.random.default_rng(1).integers(0, n_rows, (200, n_rows))
+    resampled_medians = np.median(array[:n_rows][resampled_rows][:, :, columns], axis=1)
+    np.testing.assert_allclose(lower_bound, np.quantile(resampled_medians, 0.025, axis=0))
+    np.testing.assert_allclose(upper_bound, np.quantile(resampled_medians, 0.975, axis=0))
+    median = np.median(array[:n_rows, columns], axis=0)
+    assert (lower_bound <= median).all() and (median <= upper_bound).all()
+    chunked_bounds = bootstrap_columnwise_median_ci(array, n_rows, columns, 200, seed=1, max_chunk_bytes=1)
+    np.testing.assert_array_equal(chunked_bounds[0], lower_bound)
+    np.testing.assert_array_equal(chunked_bounds[1], upper_bound)
+
+
+def test_total_queries_at_bad_queries():
+    rng = np.random.default_rng(0)
+    unsafe_masks = [rng.random(rng.integers(0, 300)) < 0.3 for _ in range(50)]
+    total_queries = total_queries_at_bad_queries(unsafe_masks, 40)
+    assert total_queries.shape == (50, 40)
+    for unsafe_mask, sample_total_queries in zip(unsafe_masks, total_queries):
+        expected_total_queries = np.flatnonzero(unsafe_mask)[:40] + 1
+        np.testing.assert_array_equal(sample_total_queries[:len(expected_total_queries)], expected_total_queries)
+        assert np.isnan(sample_total_queries[len(expected_total_queries):]).all()
+
+
+def test_extrapolate_rows():
+    array = np.full((4, 30), np.nan)
+    array[0] = np.arange(30)
+    array[1, :20] = np.arange(20)**2
+    array[2, :5] = [1, 3, 4, 8, 9]
+    array[3, :1] = 1
+    extrapolated = extrapolate_rows(array, last_k=10)
+    np.testing.assert_array_equal(extrapolated[[0, 3]], array[[0, 3]])
+    for i, n_values in [(1, 20), (2, 5)]:
+        np.testing.assert_array_equal(extrapolated[i, :n_values], array[i, :n_values])
+        x = np.arange(n_values)[-10:]
+        slope, intercept = np.polyfit(x, array[i, x], 1)
+        np.testing.assert_allclose(extrapolated[i, n_values:], np.arange(n_values, 30) * slope + intercept)
@@ -0,0 +1,15 @@
+import pytest
+import torch
+
+from src.distances import l2, linf
+
+foolbox_distances = pytest.importorskip("foolbox.distances")
+
+
+@pytest.mark.parametrize("distance,foolbox_distance", [(l2, foolbox_distances.l2), (linf, foolbox_distances.linf)])
+def test_same_as_foolbox(distance, foolbox_distance):
+    generator = torch.Generator().manual_seed(0)
+    x = torch.rand(8, 3, 32, 32, generator=generator)
+    x_adv = torch.rand(8, 3, 32, 32, generator=generator)
+    assert torch.equal(distance(x, x_adv), foolbox_distance(x, x_adv))
+    assert distance.p == foolbox_distance.p
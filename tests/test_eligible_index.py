@@ -0,0 +1,82 @@
+from argparse import Namespace
+from pathlib import Path
+
+import torch
+from torch import nn
+from torch.utils import data
+
+from src.dataset import _seed_and_make_loader
+from src.eligible_index import (EligibleSampler, compute_eligible_indices, load_eligible_index, make_fingerprint,
+                                save_eligible_index)
+from src.model_wrappers import TorchModelWrapper
+
+
+class FirstPixelClassifier(nn.Module):
+    """Predicts class 1 if the first pixel is larger than 0.5, else class 0."""
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:  # type: ignore
+        return (x[:, 0, 0, 0] > 0.5).to(torch.float).unsqueeze(1) * 10 - 5
+
+
+def make_dataset() -> data.TensorDataset:
+    generator = torch.Generator().manual_seed(0)
+    return data.TensorDataset(torch.rand(20, 3, 2, 2, generator=generator),
+                              torch.randint(0, 2, (20, ), generator=generator))
+
+
+def test_compute_eligible_indices():
+    dataset = make_dataset()
+    model = TorchModelWrapper(FirstPixelClassifier(), n_class=2)
+    eligible_indices = compute_eligible_indices(model, dataset, torch.device("cpu"), batch_size=6, num_workers=0)
+    expected = [i for i, (x, y) in enumerate(dataset) if y == 1 and x[0, 0, 0] > 0.5]
+    assert eligible_indices == expected
+    assert model.num_queries == 0
+
+
+def test_eligible_sampler_keeps_order_and_rng():
+    dataset = make_dataset()
+    eligible_indices = [1, 4, 5, 11, 17]
+
+    # The loaders do not seed the global RNG, which should be consumed in the same way with and without filtering
+    torch.manual_seed(0)
+    loader = _seed_and_make_loader(dataset, 1, shuffle=True)
+    expected_order = []
+    for position, (x, _) in enumerate(loader):
+        index = next(i for i in range(len(dataset)) if torch.equal(dataset[i][0], x[0]))
+        if index in eligible_indices:
+            expected_order.append((position, index))
+    expected_rng = torch.rand(1)
+
+    torch.manual_seed(0)
+    loader = _seed_and_make_loader(dataset, 1, shuffle=True)
+    sampler = EligibleSampler(loader.sampler, eligible_indices)
+    filtered_loader = data.DataLoader(dataset, batch_size=1, sampler=sampler)
+    order = []
+    for x, _ in filtered_loader:
+        index = next(i for i in range(len(dataset)) if torch.equal(dataset[i][0], x[0]))
+        order.append((sampler.current_position, index))
+    assert order == expected_order
+    assert torch.equal(torch.rand(1), expected_rng)
+
+
+def test_save_and_load_eligible_index(tmp_path: Path):
+    args = Namespace(model_backend="torch", strong_preprocessing="0")
+    fingerprint = make_fingerprint(args, {"dataset": "test"})
+    path = tmp_path / "test_torch.json"
+    assert load_eligible_index(path, fingerprint) is None
+    save_eligible_index(path, [1, 2, 3], fingerprint)
+    assert load_eligible_index(path, fingerprint) == [1, 2, 3]
+    assert load_eligible_index(
+        path,
+        make_fingerprint(Namespace(model_backend="onnx", onnx_model_path=None, strong_preprocessing="0"),
+                         {"dataset": "test"})) is None
+    # An index built without the strong preprocessing, or with different settings, is not used
+    strong_preprocessing_args = Namespace(model_backend="torch",
+                                          strong_preprocessing="1",
+                                          strong_preprocessing_jpeg_quality=75,
+                                          strong_preprocessing_resize=None)
+    strong_preprocessing_fingerprint = make_fingerprint(strong_preprocessing_args, {"dataset": "test"})
+    assert load_eligible_index(path, strong_preprocessing_fingerprint) is None
+    save_eligible_index(path, [1, 2], strong_preprocessing_fingerprint)
+    strong_preprocessing_args.strong_preprocessing_jpeg_quality = 50
+    assert load_eligible_index(path, make_fingerprint(strong_preprocessing_args, {"dataset": "test"})) is None
@@ -0,0 +1,78 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torch import nn
+
+from src.attacks.base import Bounds, DirectionAttackPhase, SearchMode
+from src.attacks.rays import RayS
+from src.distances import linf
+from src.image_utils import Codec, discretize, encode_decode, encode_decode_batch, to_from_pil, to_uint8
+from src.model_wrappers import TorchModelWrapper
+
+
+def _pil_round_trip(image: torch.Tensor, format: str, quality: int | None = None) -> torch.Tensor:
+    pil_image = Image.fromarray(np.uint8(torch.round(image * 255).numpy().transpose(1, 2, 0)))
+    with io.BytesIO() as buf:
+        if quality is not None:
+            pil_image.save(buf, format=format, quality=quality)
+        else:
+            pil_image.save(buf, format=format)
+        buf.seek(0)
+        decoded = np.asarray(Image.open(buf).convert("RGB")).astype(np.float32).transpose(2, 0, 1)
+    return torch.from_numpy(decoded) / 255
+
+
+def test_discretize_matches_pil_round_trip():
+    images = torch.rand(4, 3, 16, 16, generator=torch.Generator().manual_seed(0))
+    expected = torch.stack([_pil_round_trip(image, "png") for image in images])
+    assert torch.equal(discretize(images), expected)
+    assert torch.equal(encode_decode_batch(images, "png"), expected)
+    assert torch.equal(to_from_pil(images[:1]), expected[:1])
+    assert torch.equal(encode_decode(images[:1]), expected[:1])
+    # Points on the grid are left as they are
+    assert torch.equal(discretize(expected), expected)
+
+
+@pytest.mark.parametrize("quality", [None, 50])
+def test_encode_decode_batch_lossy_matches_per_image(quality: int | None):
+    images = torch.rand(5, 3, 16, 16, generator=torch.Generator().manual_seed(0))
+    expected = torch.stack([_pil_round_trip(image, "jpeg", quality) for image in images])
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert torch.equal(encode_decode_batch(images, "jpeg", quality, executor), expected)
+    assert torch.equal(encode_decode_batch(images, "jpeg", quality), expected)
+    assert torch.equal(encode_decode_batch(images[0], "jpeg", quality), expected[0])
+
+
+def test_clamp_and_discretize():
+    images = torch.rand(3, 3, 8, 8, generator=torch.Generator().manual_seed(0)) * 1.2 - 0.1
+    attack = RayS(None, linf, Bounds(), True, None, None, False, SearchMode.binary, None, False, False)
+    assert torch.equal(attack.clamp_and_discretize(images), discretize(torch.clamp(images, 0, 1)))
+    attack.codec = Codec("jpeg", quality=75)
+    assert torch.equal(attack.clamp_and_discretize(images), encode_decode_batch(torch.clamp(images, 0, 1), "jpeg",
+                                                                                 75))
+    attack.discrete = False
+    assert torch.equal(attack.clamp_and_discretize(images), torch.clamp(images, 0, 1))
+
+
+def test_uint8_queries():
+    x = discretize(torch.rand(3, 8, 8, generator=torch.Generator().manual_seed(0)))
+    attack = RayS(None, linf, Bounds(), True, None, None, False, SearchMode.binary, None, False, False)
+    attack.uint8_queries = True
+    torch.manual_seed(0)
+    model = TorchModelWrapper(nn.Sequential(nn.Flatten(), nn.Linear(3 * 8 * 8, 1)), n_class=2)
+    queries = []
+    predict_label = model.predict_label
+    model.predict_label = lambda image: queries.append(image) or predict_label(image)  # type: ignore
+    x_adv = attack.get_x_adv(x, torch.ones_like(x), 3 / 255)
+    success, queries_counter = attack.is_correct_boundary_side(model, x_adv, torch.tensor([0]), None,
+                                                               attack._make_queries_counter(),
+                                                               DirectionAttackPhase.search, x)
+    assert queries[0].dtype == torch.uint8
+    assert torch.equal(queries[0], to_uint8(x_adv.unsqueeze(0)))
+    assert torch.allclose(model(queries[0]), model(x_adv), atol=1e-6)
+    assert queries_counter.total_queries == 1
+    assert torch.equal(success, predict_label(x_adv) != 0)
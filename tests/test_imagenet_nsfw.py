@@ -0,0 +1,38 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from src.imagenet_nsfw import ImageNetNSFW
+from src.utils import sha256sum
+
+
+@pytest.fixture
+def nsfw_root(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    outputs = np.linspace(1, 0, 10, dtype=np.float32)
+    imgs = np.array([[f"n01/image_{i}.JPEG", "0"] for i in range(10)])
+    outputs_path = tmp_path / "nsfw_imagenet" / "nsfw_imagenet_train_outputs.npz"
+    outputs_path.parent.mkdir()
+    np.savez(outputs_path, outputs=outputs, imgs=imgs)
+    monkeypatch.setattr(ImageNetNSFW, "_SHA256_HASHES", {"train": sha256sum(outputs_path)})
+    return tmp_path / "imagenet"
+
+
+def test_top_k_without_imagenet(nsfw_root: Path):
+    # The ImageNet directory does not exist, so it would fail if it were scanned
+    dataset = ImageNetNSFW(str(nsfw_root), top_k=3)
+    assert dataset.samples == [(str(nsfw_root / "train" / f"n01/image_{i}.JPEG"), 1) for i in range(3)]
+    assert dataset.targets == [1, 1, 1]
+    assert (nsfw_root.parent / "nsfw_imagenet" / "nsfw_imagenet_train_outputs.npz.sha256.json").exists()
+    assert (nsfw_root.parent / "nsfw_imagenet" / "nsfw_imagenet_train_outputs" / "imgs.npy").exists()
+    # The second time the cached hash and the unpacked outputs are used
+    assert ImageNetNSFW(str(nsfw_root), top_k=3).samples == dataset.samples
+
+
+def test_modified_outputs_are_verified(nsfw_root: Path):
+    ImageNetNSFW(str(nsfw_root), top_k=3)
+    outputs_path = nsfw_root.parent / "nsfw_imagenet" / "nsfw_imagenet_train_outputs.npz"
+    with outputs_path.open("ab") as f:
+        f.write(b"0")
+    with pytest.raises(ValueError):
+        ImageNetNSFW(str(nsfw_root), top_k=3)
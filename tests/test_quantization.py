@@ -0,0 +1,63 @@
+from pathlib import Path
+
+import torch
+from torch import nn
+from torch.utils import data
+
+from src.model_wrappers import TorchModelWrapper
+from src.quantization import QuantizationMode, get_calibration_images, quantize_model_wrapper
+
+
+class TinyConvNet(nn.Module):
+
+    def __init__(self, n_class: int = 3) -> None:
+        super().__init__()
+        self.conv = nn.Conv2d(3, 8, 3)
+        self.relu = nn.ReLU()
+        self.pool = nn.AdaptiveAvgPool2d(1)
+        self.fc = nn.Linear(8, n_class)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:  # type: ignore
+        return self.fc(torch.flatten(self.pool(self.relu(self.conv(x))), 1))
+
+
+def make_model_and_dataset() -> tuple[TorchModelWrapper, data.Dataset]:
+    torch.manual_seed(0)
+    model = TorchModelWrapper(TinyConvNet().eval(), n_class=3, im_mean=(0.5, 0.5, 0.5), im_std=(0.25, 0.25, 0.25))
+    dataset = data.TensorDataset(torch.rand(64, 3, 16, 16), torch.zeros(64, dtype=torch.long))
+    return model, dataset
+
+
+def test_get_calibration_images_does_not_change_global_rng():
+    _, dataset = make_model_and_dataset()
+    torch.manual_seed(42)
+    expected = torch.rand(1)
+    torch.manual_seed(42)
+    images = get_calibration_images(dataset, 8)
+    assert images.shape == (8, 3, 16, 16)
+    assert torch.equal(torch.rand(1), expected)
+    assert torch.equal(images, get_calibration_images(dataset, 8))
+
+
+def test_quantize_model_wrapper(tmp_path: Path):
+    model, dataset = make_model_and_dataset()
+    quantized_model = quantize_model_wrapper(model, dataset, "tiny", QuantizationMode.static, 16, tmp_path)
+    assert (tmp_path / "tiny_int8_static.pt").exists()
+    assert (tmp_path / "tiny_int8_static.json").exists()
+    x = torch.rand(4, 3, 16, 16)
+    labels = quantized_model.predict_label(x)
+    assert labels.shape == (4, )
+    assert quantized_model.num_queries == 4
+
+    # The second time the model is loaded from the cache
+    cached_quantized_model = quantize_model_wrapper(model, dataset, "tiny", QuantizationMode.static, 16, tmp_path)
+    assert torch.equal(cached_quantized_model.predict_label(x), labels)
+
+
+def test_quantize_model_wrapper_dynamic(tmp_path: Path):
+    model, dataset = make_model_and_dataset()
+    quantized_model = quantize_model_wrapper(model, dataset, "tiny", QuantizationMode.dynamic, 16, tmp_path)
+    x = torch.rand(4, 3, 16, 16)
+    labels = quantized_model.predict_label(x)
+    cached_quantized_model = quantize_model_wrapper(model, dataset, "tiny", QuantizationMode.dynamic, 16, tmp_path)
+    assert torch.equal(cached_quantized_model.predict_label(x), labels)
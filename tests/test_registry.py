@@ -0,0 +1,55 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from src import registry
+from src.setup import setup_attack
+
+REPO_ROOT = Path(__file__).parent.parent
+HEAVY_MODULES = ["foolbox", "eagerpy", "torch_dct", "transformers", "pytorch_lightning", "torchmetrics", "onnxruntime"]
+
+_IMPORT_SCRIPT = """
+import json
+import sys
+
+import main
+from src.setup import setup_attack
+setup_attack(main.make_parser().parse_args({args}))
+print(json.dumps({{"modules": sorted(sys.modules)}}))
+"""
+
+
+def run_import_script(args: list[str]) -> dict:
+    output = subprocess.run([sys.executable, "-c", _IMPORT_SCRIPT.format(args=args)],
+                            cwd=REPO_ROOT,
+                            capture_output=True,
+                            text=True,
+                            check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("attack,expected_heavy_modules,other_attack", [("rays", set(), "geoda"),
+                                                                        ("geoda", {"torch_dct"}, "rays")])
+def test_lazy_imports(attack: str, expected_heavy_modules: set[str], other_attack: str):
+    result = run_import_script(["--attack", attack, "--dataset", "resnet_imagenet", "--max-iter", "10"])
+    imported_heavy_modules = {module.split(".")[0] for module in result["modules"]} & set(HEAVY_MODULES)
+    assert imported_heavy_modules == expected_heavy_modules
+    # Only the module of the attack which is run is imported
+    assert f"src.attacks.{attack}" in result["modules"]
+    assert f"src.attacks.{other_attack}" not in result["modules"]
+
+
+def test_all_attacks_can_be_set_up():
+    from main import make_parser
+    for attack in registry.ATTACKS:
+        args = make_parser().parse_args(["--attack", attack, "--max-iter", "10", "--norm", "l2"])
+        assert setup_attack(args) is not None
+
+
+def test_invalid_attack():
+    from main import make_parser
+    with pytest.raises(ValueError):
+        setup_attack(make_parser().parse_args(["--attack", "invalid"]))
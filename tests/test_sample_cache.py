@@ -0,0 +1,38 @@
+from pathlib import Path
+
+import torch
+from torch.utils import data
+
+from src.sample_cache import SampleCacheDataset, build_sample_cache, is_sample_cache_valid, make_fingerprint
+
+
+class QuantizedImagesDataset(data.Dataset):
+    """Mimics a dataset of images loaded with `ToTensor`."""
+
+    def __init__(self, n_samples: int) -> None:
+        generator = torch.Generator().manual_seed(0)
+        self.images = torch.randint(0, 256, (n_samples, 3, 8, 8), generator=generator).to(torch.float32) / 255
+        self.labels = torch.randint(0, 10, (n_samples, ), generator=generator)
+        self.samples = [(f"image_{i}.JPEG", int(label)) for i, label in enumerate(self.labels)]
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def __getitem__(self, index: int) -> tuple[torch.Tensor, int]:
+        return self.images[index], int(self.labels[index])
+
+
+def test_sample_cache(tmp_path: Path):
+    dataset = QuantizedImagesDataset(10)
+    fingerprint = make_fingerprint("test", "/data", "val", "ToTensor()")
+    assert not is_sample_cache_valid(tmp_path, fingerprint)
+    build_sample_cache(dataset, tmp_path, fingerprint, batch_size=4, num_workers=0)
+    assert is_sample_cache_valid(tmp_path, fingerprint)
+    assert not is_sample_cache_valid(tmp_path, make_fingerprint("test", "/data", "val", "Resize(256)"))
+
+    cached_dataset = SampleCacheDataset(tmp_path)
+    assert len(cached_dataset) == len(dataset)
+    for i in range(len(dataset)):
+        image, label = cached_dataset[i]
+        assert torch.equal(image, dataset[i][0])
+        assert label == dataset[i][1]
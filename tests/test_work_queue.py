@@ -0,0 +1,87 @@
+import threading
+from pathlib import Path
+
+import pytest
+
+from src.work_queue import TaskStatus, WorkQueue, keep_lease
+
+
+def test_work_queue(tmp_path: Path):
+    queue = WorkQueue.create(tmp_path, {"num": 3}, [0, 2, 5], max_attempts=2)
+    assert WorkQueue(tmp_path).config == {"num": 3}
+    with pytest.raises(FileExistsError):
+        WorkQueue.create(tmp_path, {}, [])
+
+    assert queue.claim("a") == 0
+    assert queue.claim("b") == 2
+    # Only the worker which claimed a task can complete it
+    assert not queue.complete(0, "b")
+    assert queue.complete(0, "a")
+    assert queue.fail(2, "b", "error")
+    # The failed task is retried
+    assert queue.claim("a") == 2
+    assert queue.complete(2, "a")
+    assert queue.claim("a") == 5
+    assert queue.claim("b") is None
+    assert not queue.is_finished()
+    assert queue.complete(5, "a")
+    assert queue.is_finished()
+    assert queue.done_tasks() == [0, 2, 5]
+    assert queue.counts() == {TaskStatus.done: 3}
+
+
+def test_work_queue_expired_lease(tmp_path: Path):
+    WorkQueue.create(tmp_path, {}, [0], max_attempts=2)
+    queue = WorkQueue(tmp_path, max_clock_skew_seconds=0.)
+    assert queue.claim("a", lease_seconds=-1) == 0
+    # The lease expired, so the task is claimed again, and the first worker cannot complete it anymore
+    assert queue.claim("b", lease_seconds=-1) == 0
+    assert not queue.complete(0, "a")
+    assert not queue.heartbeat(0, "a")
+    # After `max_attempts`, the task is not retried anymore
+    assert queue.claim("c") is None
+    assert queue.is_finished()
+    assert queue.failed_tasks() == {0: "lease expired"}
+
+
+def test_work_queue_clock_skew(tmp_path: Path):
+    queue = WorkQueue.create(tmp_path, {}, [0])
+    # The lease expired 1 second ago according to the clock of this worker, which is within the clock skew margin
+    assert queue.claim("a", lease_seconds=-1) == 0
+    assert queue.claim("b") is None
+    assert queue.complete(0, "a")
+
+
+def test_work_queue_heartbeats(tmp_path: Path):
+    queue = WorkQueue.create(tmp_path, {}, [0])
+    assert queue.claim("a", lease_seconds=0.3) == 0
+    with keep_lease(queue, 0, "a", lease_seconds=0.3) as lease_lost:
+        threading.Event().wait(0.6)
+        assert queue.claim("b") is None
+    assert not lease_lost.is_set()
+    assert queue.complete(0, "a")
+
+
+def test_work_queue_concurrent_claims(tmp_path: Path):
+    queue = WorkQueue.create(tmp_path, {}, range(50))
+    claimed: list[int] = []
+
+    def claim_all(worker: str) -> None:
+        while (task_id := queue.claim(worker)) is not None:
+            claimed.append(task_id)
+            queue.complete(task_id, worker)
+
+    threads = [threading.Thread(target=claim_all, args=(f"worker-{i}", )) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == list(range(50))
+    assert queue.is_finished()
+
+
+def test_work_queue_results(tmp_path: Path):
+    queue = WorkQueue.create(tmp_path, {}, [3])
+    queue.save_result(3, {"outcome": "negative"})
+    assert queue.load_result(3) == {"outcome": "negative"}
+    assert list((tmp_path / "samples").iterdir()) == [queue.result_path(3)]